@@ -1,4 +1,4 @@
-from flask import Flask, g, render_template, jsonify, request, session, redirect, url_for, make_response
+from flask import Flask, g, render_template, jsonify, request, session, redirect, url_for, make_response, Response, stream_template, stream_with_context
 import requests
 import json
 import logging
@@ -9,13 +9,26 @@ import socket
 import hashlib
 import base64
 import secrets
+import itertools
 from urllib.parse import urlencode, urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
 from fhirpathpy import evaluate
-from fhirutils import fhir_get as _original_fhir_get, format_fhir_date, get_text_display, find_category, get_form_data
-from bundler import create_request_bundle
-from fhir_parser import extract_resources
-from graph_builder import build_graph
-from mermaid_generator import generate_mermaid
+from fhirutils import TTLCache, fhir_get as _original_fhir_get, format_fhir_date, get_text_display, find_category, get_form_data
+from bundler import create_request_bundle, fetch_directory
+from bundle_preview import cached_preview, preview_key, store_preview
+from bulk_bundler import BulkRun, max_workers as bulk_max_workers
+from narrative import add_narratives
+from patient_summary import (UNSUPPORTED_STATUSES, cached_summary, iter_summary, local_fallback_enabled,
+                             local_summary, summary_key)
+from bundle_submit import SubmitQueueFull, describe_response, get_bundle_submitter
+from bundle_integrity import check_bundle_references, operation_outcome
+from bundle_validation import timing_report, validate_bundle, validate_by_default
+from bundle_diagram import diagram_for
+from bundle_reader import BundleTooLarge, load_bundle, read_body
+from graph_exporters import FORMATS as DIAGRAM_FORMATS
+from graph_clustering import DiagramView
+from bundle_diff import diff_bundles, iter_diff_mermaid
+from terminology import get_terminology_service, start_cache_warmup
 
 
 app = Flask(__name__)
@@ -909,19 +922,32 @@ def get_patient(patient_id):
 
 @app.route('/fhir/Patient/<patient_id>/summary', methods=['GET'])
 def get_patient_summary(patient_id):
+    """
+    The patient's $summary in the JSON textarea. The upstream body is streamed
+    through unparsed and pretty-printed by the browser; summaries are cached
+    briefly per server, patient and credentials (see patient_summary). When the
+    server has no $summary operation, a summary is synthesised from searches.
+    """
     server_url = get_fhir_server_url()
     api_path = f"/Patient/{patient_id}/$summary"
     full_url = server_url.rstrip('/') + '/' + api_path.lstrip('/')
     auth_creds = get_fhir_auth_credentials()
+    key = summary_key(server_url, patient_id, auth_creds, get_fhir_bearer_token())
+    cached = cached_summary(key)
+    if cached is not None:
+        print(f"[Patient Summary] Served from cache: {full_url}")
+        return render_template('partials/json_textarea.html', bundle_json=cached, pretty_print=True)
     print(f"[Patient Summary] Server URL  : {server_url}")
     print(f"[Patient Summary] Full API call: GET {full_url}")
     print(f"[Patient Summary] Auth         : {'credentials provided' if auth_creds else 'no auth (unauthenticated)'}")
+    summary_creds = auth_creds
     try:
         response = fhir_get(
             api_path,
             fhir_server_url=server_url,
             auth_credentials=auth_creds,
-            timeout=60
+            timeout=60,
+            stream=True
         )
     except Exception as exc:
         print(f"[Patient Summary] EXCEPTION during request: {exc}")
@@ -942,12 +968,15 @@ def get_patient_summary(patient_id):
     # If we get a 401 AND we sent credentials, retry once without them.
     if response.status_code in (401, 403) and auth_creds is not None:
         print(f"[Patient Summary] 401 with credentials — retrying unauthenticated")
+        response.close()
+        summary_creds = None
         try:
             response = fhir_get(
                 api_path,
                 fhir_server_url=server_url,
                 auth_credentials=None,
-                timeout=60
+                timeout=60,
+                stream=True
             )
         except Exception as exc:
             print(f"[Patient Summary] EXCEPTION on unauthenticated retry: {exc}")
@@ -959,25 +988,42 @@ def get_patient_summary(patient_id):
         print(f"[Patient Summary] Retry response status: {response.status_code}")
 
     if response.status_code == 200:
-        bundle = response.json()       
-        bundle_json = json.dumps(bundle, indent=2)
-        return render_template('partials/json_textarea.html', bundle_json=bundle_json)
-    else:
+        chunks = iter_summary(response, key)
         try:
-            response_body = response.json()
-        except Exception:
-            response_body = response.text
-        print(f"[Patient Summary] Error response body: {response_body}")
-        error_message = {
-            "error": "Failed to fetch patient summary",
-            "debug": {
-                "server_url": server_url,
-                "api_call": f"GET {full_url}",
-                "http_status": response.status_code,
-                "response": response_body
+            # Read the first chunk before responding, so a connection that fails straight away is an error response
+            first = next(chunks, '')
+        except requests.RequestException as exc:
+            print(f"[Patient Summary] EXCEPTION reading response: {exc}")
+            error_message = {
+                "error": "Failed to fetch patient summary",
+                "debug": {"server_url": server_url, "api_call": f"GET {full_url}", "exception": str(exc)}
             }
+            return render_template('partials/json_textarea.html', bundle_json=json.dumps(error_message, indent=2)), 502
+        return Response(stream_template('partials/json_textarea.html',
+                                        bundle_chunks=itertools.chain([first], chunks), pretty_print=True))
+
+    if response.status_code in UNSUPPORTED_STATUSES and local_fallback_enabled():
+        print(f"[Patient Summary] $summary not available (HTTP {response.status_code}) — synthesising locally")
+        bundle_json = local_summary(key, patient_id, server_url, summary_creds, get_fhir_bearer_token())
+        if bundle_json is not None:
+            response.close()
+            return render_template('partials/json_textarea.html', bundle_json=bundle_json, pretty_print=True)
+
+    try:
+        response_body = response.json()
+    except Exception:
+        response_body = response.text
+    print(f"[Patient Summary] Error response body: {response_body}")
+    error_message = {
+        "error": "Failed to fetch patient summary",
+        "debug": {
+            "server_url": server_url,
+            "api_call": f"GET {full_url}",
+            "http_status": response.status_code,
+            "response": response_body
         }
-        return render_template('partials/json_textarea.html', bundle_json=json.dumps(error_message, indent=2))
+    }
+    return render_template('partials/json_textarea.html', bundle_json=json.dumps(error_message, indent=2))
     
 
 @app.route('/fhir/Procedures/<patient_id>')
@@ -1642,91 +1688,228 @@ def create_diagnostic_request_bundle(patient_id):
     form_data = get_form_data(request)
     form_data['patient_id'] = patient_id
     # Log the processed form data in a readable format
-    logging.info(f"Form data: {json.dumps(form_data, indent=2)}")
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("Form data: %s", json.dumps(form_data, indent=2))
 
     #with open('./json/service_request_bundle.json', 'r', encoding='utf-8') as f:
     #    bundle = json.load(f)
-    bundle = create_request_bundle(form_data=form_data, fhir_server_url=get_fhir_server_url(), auth_credentials=get_fhir_auth_credentials())
-    bundle_json = json.dumps(bundle, indent=2)
+    server_url = get_fhir_server_url()
+    auth_credentials = get_fhir_auth_credentials()
+    # Resolve the requester first: its version is part of the preview cache key
+    requester_id = form_data.get('requester')
+    directory = fetch_directory([requester_id], server_url, auth_credentials) if requester_id else {}
+    key = preview_key(form_data, server_url, directory)
+    bundle_json = cached_preview(key)
+    if bundle_json is None:
+        bundle = create_request_bundle(form_data=form_data, fhir_server_url=server_url,
+                                       auth_credentials=auth_credentials, directory=directory)
+        bundle_json = store_preview(key, bundle)
+    else:
+        logging.info("Bundle preview served from cache")
     return render_template('partials/json_textarea.html', bundle_json=bundle_json), 200
 
 
+@app.route('/fhir/diagnosticrequest/bundler/bulk', methods=['POST'])
+def create_diagnostic_request_bundles_bulk():
+    """
+    Generate one transaction bundle per NDJSON order spec in the request body.
+    Streams the bundles back as NDJSON, ending with a {"report": ...} line.
+    Optional ?workers=N sets the size of the process pool (at most
+    BULK_BUNDLER_MAX_WORKERS); ?validate=true validates every bundle against
+    the FHIR models in the workers.
+    """
+    workers = request.args.get('workers', type=int)
+    if workers is not None:
+        workers = min(workers, bulk_max_workers())
+    run = BulkRun(request.get_data().splitlines(), workers=workers,
+                  fhir_server_url=get_fhir_server_url(), auth_credentials=get_fhir_auth_credentials(),
+                  validate=request.args.get('validate') == 'true')
+    if not len(run):
+        return jsonify({'error': 'No order specs supplied'}), 400
+    max_orders = int(os.environ.get('BULK_BUNDLER_MAX_ORDERS', 10000))
+    if len(run) > max_orders:
+        return jsonify({'error': f'Too many order specs ({len(run)} > {max_orders})'}), 413
+
+    def generate():
+        yield from run
+        yield json.dumps({'report': run.report}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @app.route('/fhir/bundle/submit', methods=['POST'])
 def submit_bundle():
-    """POST a FHIR Bundle (transaction/batch) to the connected FHIR server."""
+    """
+    POST a FHIR Bundle (transaction/batch) to the connected FHIR server.
+    With ?narrative=true, resources without a narrative get one before sending.
+    With ?async=true, the upload runs as a background job: the response is
+    202 with a job id to poll at /fhir/bundle/submit/<job_id>.
+    ?strip_narrative=true / ?strip_last_updated=true trim the upload.
+    The bundle's references are checked locally first (?skip_check=true to skip);
+    failures return 400 with an OperationOutcome. With ?validate=true (or
+    BUNDLE_VALIDATE=true) the bundle is also validated against the FHIR models.
+    Bodies over BUNDLE_MAX_BYTES or BUNDLE_MAX_ENTRIES are refused with 413.
+    """
     try:
-        bundle = request.get_json()
+        try:
+            raw = read_body(request.stream, request.content_length)
+            bundle = load_bundle(raw) if raw.strip() else None
+        except BundleTooLarge as e:
+            return jsonify({'success': False, 'error': str(e)}), 413
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         if not bundle:
             return jsonify({'success': False, 'error': 'No JSON body provided'}), 400
 
         if bundle.get('resourceType') != 'Bundle':
             return jsonify({'success': False, 'error': 'JSON is not a FHIR Bundle'}), 400
 
+        if request.args.get('narrative') == 'true':
+            added = add_narratives(bundle.get('entry', []), overwrite=False)
+            logging.info("Added narrative text to %d resources before submit", added)
+            if added:
+                raw = None
+
+        # Fail broken bundles locally instead of after a server round-trip and rollback
+        if request.args.get('skip_check') != 'true':
+            issues = check_bundle_references(bundle)
+            if issues:
+                summary = '; '.join(issue['diagnostics'] for issue in issues[:3])
+                if len(issues) > 3:
+                    summary += f' (and {len(issues) - 3} more)'
+                return jsonify({'success': False,
+                                'error': f'Bundle failed the reference integrity check: {summary}',
+                                'outcome': operation_outcome(issues)}), 400
+
+        if request.args.get('validate', 'true' if validate_by_default() else 'false') == 'true':
+            issues = validate_bundle(bundle)
+            if issues:
+                return jsonify({'success': False,
+                                'error': f'Bundle failed validation with {len(issues)} issues',
+                                'outcome': operation_outcome(issues)}), 400
+
         server_url = get_fhir_server_url().rstrip('/')
         auth_creds = get_fhir_auth_credentials()
         bearer = get_fhir_bearer_token()
+        submitter = get_bundle_submitter()
 
-        headers = {
-            'Content-Type': 'application/fhir+json',
-            'Accept': 'application/fhir+json'
-        }
-
-        kwargs = {'headers': headers, 'json': bundle, 'timeout': 30}
-        if bearer:
-            headers['Authorization'] = f'Bearer {bearer}'
-        elif auth_creds:
-            kwargs['auth'] = auth_creds
+        # Optional upload trimming; unset options fall back to the submitter defaults
+        # The posted bytes are sent on unless the bundle was changed above
+        options = {'raw': raw}
+        for param, option in (('strip_narrative', 'strip_narrative'), ('strip_last_updated', 'strip_last_updated')):
+            if param in request.args:
+                options[option] = request.args.get(param) == 'true'
 
-        logging.info(f"Submitting Bundle ({bundle.get('type', 'unknown')}) to {server_url}")
-        resp = requests.post(server_url, **kwargs)
+        if request.args.get('async') == 'true':
+            try:
+                job = submitter.submit(bundle, server_url, auth=auth_creds, bearer=bearer, **options)
+            except SubmitQueueFull as e:
+                return jsonify({'success': False, 'error': str(e)}), 503
+            job['status_url'] = url_for('submit_bundle_status', job_id=job['job_id'])
+            return jsonify(job), 202
 
-        try:
-            resp_json = resp.json()
-        except Exception:
-            resp_json = {'raw': resp.text[:2000]}
-
-        success = 200 <= resp.status_code < 300
-        result = {
-            'success': success,
-            'http_status': resp.status_code,
-            'response': resp_json
-        }
-        if not success:
-            result['error'] = f"FHIR server returned HTTP {resp.status_code}"
-        return jsonify(result), 200
+        resp, upload = submitter.post(bundle, server_url, auth=auth_creds, bearer=bearer, **options)
+        return jsonify(describe_response(resp, upload)), 200
 
     except Exception as e:
         logging.error(f"Bundle submit error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/fhir/bundle/submit/<job_id>', methods=['GET'])
+def submit_bundle_status(job_id):
+    """Report the status (and, once finished, the server response) of a submission job."""
+    job = get_bundle_submitter().job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f'Unknown or expired submission job {job_id}'}), 404
+    return jsonify(job), 200
+
+
+@app.route('/fhir/bundle/validate', methods=['POST'])
+def validate_bundle_structure():
+    """
+    Validate a FHIR Bundle against the FHIR models locally, without a server.
+    Returns the issues as an OperationOutcome and the validation cost per resource type.
+    """
+    bundle = request.get_json(silent=True)
+    if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+        return jsonify({'success': False, 'error': 'JSON is not a FHIR Bundle'}), 400
+    timings = {}
+    issues = validate_bundle(bundle, timings)
+    return jsonify({'success': True, 'valid': not issues,
+                    'outcome': operation_outcome(issues), 'timings': timing_report(timings)}), 200
+
+
+def _diagram_format():
+    """The ?format= of a diagram request (default mermaid); ValueError if unknown."""
+    fmt = request.args.get('format', 'mermaid')
+    if fmt not in DIAGRAM_FORMATS:
+        raise ValueError(f"Unknown format '{fmt}' (expected one of {', '.join(DIAGRAM_FORMATS)})")
+    return fmt
+
+
+def _diagram_view():
+    """
+    The view of a diagram request: ?cluster=true|false (default: only large
+    bundles), ?groups=true and ?expand=<collapsed node id>[,...] (repeatable).
+    """
+    cluster = request.args.get('cluster')
+    expand = frozenset(node_id for value in request.args.getlist('expand')
+                       for node_id in value.split(',') if node_id)
+    return DiagramView(cluster=None if cluster is None else cluster == 'true',
+                       subgraphs=request.args.get('groups') == 'true',
+                       expand=expand)
+
+
+def _diagram_response(diagram, fmt, view):
+    """
+    A streamed diagram response. The first chunk is produced before the
+    response is returned, so an exporter that fails straight away still gets
+    the route's error handling; a failure after that can only cut the body
+    short, so it is logged before the stream is aborted.
+    """
+    chunks = diagram.stream(fmt, view=view)
+    first = next(chunks, '')
+
+    def generate():
+        yield first
+        try:
+            yield from chunks
+        except Exception as e:
+            logging.error(f"Error streaming {fmt} diagram, response cut short: {str(e)}")
+            raise
+
+    return Response(generate(), mimetype=DIAGRAM_FORMATS[fmt].mimetype)
+
+
 @app.route('/bundle/mermaid', methods=['POST'])
 def generate_bundle_mermaid():
     """
-    Generate a Mermaid diagram from a FHIR bundle.
+    Generate a diagram from a FHIR bundle.
     Accepts JSON bundle in request body.
-    Returns Mermaid diagram text.
+    Returns Mermaid diagram text by default; ?format=dot|json|cytoscape selects
+    Graphviz DOT, a compact JSON graph or Cytoscape.js elements instead.
+    Large bundles are clustered (see _diagram_view for ?cluster, ?groups and
+    ?expand). Responses carry an ETag; a request whose If-None-Match matches
+    (same bundle, format and view as last time) gets 304 Not Modified.
+    Bodies over BUNDLE_MAX_BYTES or BUNDLE_MAX_ENTRIES are refused with 413.
     """
     try:
-        bundle = request.get_json()
-        if not bundle:
-            return "Error: No bundle provided", 400
-        
-        # Extract resources from bundle
-        resources = extract_resources(bundle)
-        
-        if not resources:
-            return "Error: No resources found in bundle", 400
-        
-        # Build graph from resources
-        graph = build_graph(resources)
-        
-        # Generate mermaid diagram
-        bundle_title = "Diagnostic Request Bundle"
-        mermaid_text = generate_mermaid(graph, bundle_title)
-        
-        return mermaid_text, 200, {'Content-Type': 'text/plain'}
-    
+        fmt = _diagram_format()
+        view = _diagram_view()
+        diagram = diagram_for(read_body(request.stream, request.content_length))
+        etag = diagram.etag_for(fmt, view)
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = _diagram_response(diagram, fmt, view)
+        response.set_etag(etag)
+        return response
+
+    except BundleTooLarge as e:
+        return f"Error: {str(e)}", 413
+    except ValueError as e:
+        return f"Error: {str(e)}", 400
     except Exception as e:
         logging.error(f"Error generating mermaid diagram: {str(e)}")
         return f"Error: {str(e)}", 500
@@ -1735,32 +1918,58 @@ def generate_bundle_mermaid():
 @app.route('/bundle/mermaid/download', methods=['POST'])
 def download_bundle_mermaid():
     """
-    Generate a Mermaid diagram from a FHIR bundle and return it as a downloadable file.
-    Accepts JSON bundle in request body.
-    Returns Mermaid diagram text as attachment.
+    Generate a diagram from a FHIR bundle and return it as a downloadable file.
+    Accepts JSON bundle in request body and the same query parameters as /bundle/mermaid.
+    Returns the diagram as an attachment (from the diagram cache after a draw).
     """
     try:
-        bundle = request.get_json()
-        if not bundle:
-            return "Error: No bundle provided", 400
-
-        resources = extract_resources(bundle)
-        if not resources:
-            return "Error: No resources found in bundle", 400
-
-        graph = build_graph(resources)
-        mermaid_text = generate_mermaid(graph, "Diagnostic Request Bundle")
-
-        response = make_response(mermaid_text)
-        response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-        response.headers['Content-Disposition'] = 'attachment; filename="fhir-bundle-diagram.mmd"'
+        fmt = _diagram_format()
+        view = _diagram_view()
+        diagram = diagram_for(read_body(request.stream, request.content_length))
+        response = _diagram_response(diagram, fmt, view)
+        response.headers['Content-Disposition'] = \
+            f'attachment; filename="fhir-bundle-diagram.{DIAGRAM_FORMATS[fmt].extension}"'
+        response.set_etag(diagram.etag_for(fmt, view))
         return response
 
+    except BundleTooLarge as e:
+        return f"Error: {str(e)}", 413
+    except ValueError as e:
+        return f"Error: {str(e)}", 400
     except Exception as e:
         logging.error(f"Error downloading mermaid diagram: {str(e)}")
         return f"Error: {str(e)}", 500
 
 
+@app.route('/bundle/diff', methods=['POST'])
+def diff_bundle_pair():
+    """
+    Compare two FHIR bundles.
+    Accepts {"left": bundle, "right": bundle, "ignore": [JSON Pointer, ...]?}.
+    Returns the entries aligned across both bundles with a JSON Patch per
+    changed entry; ?format=mermaid returns a Mermaid diagram with added,
+    removed and changed resources coloured instead.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({'success': False, 'error': 'Expected {"left": bundle, "right": bundle}'}), 400
+    left, right = body.get('left'), body.get('right')
+    if not all(isinstance(bundle, dict) and bundle.get('resourceType') == 'Bundle' for bundle in (left, right)):
+        return jsonify({'success': False, 'error': 'left and right must both be FHIR Bundles'}), 400
+    ignore = body.get('ignore') or []
+    if not isinstance(ignore, list) or not all(isinstance(pointer, str) and pointer.startswith('/') for pointer in ignore):
+        return jsonify({'success': False, 'error': 'ignore must be a list of JSON Pointers'}), 400
+
+    try:
+        if request.args.get('format') == 'mermaid':
+            # Rendered here rather than streamed, so a failure is still a 500 and not a truncated 200
+            return Response(''.join(iter_diff_mermaid(left, right, ignore)), mimetype='text/plain')
+        return jsonify({'success': True, **diff_bundles(left, right, ignore)}), 200
+    except Exception as e:
+        logging.error(f"Error comparing bundles: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @app.route('/fhir/OrderSets')
 @login_required
 def get_order_sets():
@@ -1884,6 +2093,9 @@ def save_order_sets():
         with open(imaging_path, 'w', encoding='utf-8') as f:
             _json.dump(imaging_data, f, indent=4, ensure_ascii=False)
         logging.info(f"Imaging order sets saved: {list(updated_imaging_sets.keys())}")
+
+        # Re-warm terminology caches for any new tests in the saved sets
+        start_cache_warmup(order_sets_dir)
         
         return jsonify({
             'status': 'success',
@@ -1904,219 +2116,106 @@ def get_order_sets_modal():
     return render_template('order_sets_config.html')
 
 
-@app.route('/fhir/diagvalueset/expand')
-def diag_valueset_expand():
-    """
-    Expands a ValueSet for Pathology or Radiology test names using a terminology server.
-    Query params:
-      - type: 'Pathology' or 'Radiology'
-      - q: search string
-    """
-    request_cat = request.args.get('requestCategory', '').lower()
-    query = request.args.get('testName', '').strip()
-    ###logging.info(f'Request Category:[{request_cat}] should be one of pathology, radiology')
-    ###logging.info(f'testName:[{query}]')
-    if not request_cat or not query or request_cat not in ['pathology', 'radiology']:
-        return render_template('partials/test_names.html', testNames=[])
-    # Map test type to ValueSet URL (update these URLs to match your terminology server)
-    valueset_map = {
-        'pathology': 'http://pathologyrequest.example.com.au/ValueSet/boosted',   #  SNOMED Pathology Test ValueSet
-        'radiology': 'http://radiologyrequest.example.com.au/ValueSet/boosted',   #  SNOMED Radiology Test ValueSet
-    }
-    valueset_url = valueset_map[request_cat]
-
-    terminology_server = "https://r4.ontoserver.csiro.au/fhir" 
-    expand_url = f"{terminology_server}/ValueSet/$expand"
-    params = {
-        "url": valueset_url,
-        "filter": query,
-        "count": 15
-    }
-
-    try:
-        logging.info(f'Request URL: {expand_url}?url={params.get("url")}&filter={params.get("filter")}&count={params.get("count")}')
-        resp = requests.get(expand_url, params=params, timeout=10)
-        logging.info(f'Response status: {resp.status_code}')
-        resp.raise_for_status()
-        data = resp.json()
-        logging.info(f'Response data keys: {list(data.keys())}')
-        testNames = []
-        contains = data.get("expansion", {}).get("contains", [])
-        logging.info(f'Found {len(contains)} test names for query "{query}"')
-        for item in contains:
-            code = item.get("code", "")
-            display = item.get("display") or code
-            if display:
-                testNames.append({
-                    "code": code,
-                    "display": display
-                })
-        return render_template('partials/test_names.html', testNames=testNames)
-    except requests.exceptions.RequestException as e:
-        logging.error(f'Request error in diag_valueset_expand: {str(e)}')
-        if hasattr(e, 'response') and e.response is not None:
-            logging.error(f'Response status: {e.response.status_code}')
-            logging.error(f'Response text: {e.response.text}')
-        return render_template('partials/test_names.html', testNames=[])
-    except Exception as e:
-        logging.error(f'General error in diag_valueset_expand: {str(e)}')
-        logging.error(f'Error type: {type(e).__name__}')
-        return render_template('partials/test_names.html', testNames=[])
-
-@app.route('/fhir/reasonvalueset/expand')
-def reason_valueset_expand():
-    """
-    Expands a ValueSet for the Reason for Requesting Pathology or Radiology tests using a terminology server.
-    Query params:
-      - q: search string
-    """
-    query = request.args.get('reason', '').strip()
-
-    terminology_server = "https://r4.ontoserver.csiro.au/fhir" 
-    expand_url = f"{terminology_server}/ValueSet/$expand"
-    vs = "https://healthterminologies.gov.au/fhir/ValueSet/reason-for-request-1"
-    params = {
-        "url": vs,
-        "filter": query,
-        "count": 10
-    }
-    try:
-        ###logging.info(f'{expand_url}?url={params.get("url")}&filter={params.get("filter")}&count={params.get("count")}')
-        resp = requests.get(expand_url, params=params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        ###logging.info(data)
-        reasons = []
-        contains = data.get("expansion", {}).get("contains", [])
-        for item in contains:
-            code = item.get("code", "")
-            display = item.get("display") or code
-            if display:
-                reasons.append({
-                    "code": code,
-                    "display": display
-                })
-        return render_template('partials/reasons.html', reasons=reasons)
-    except Exception as e:
-        print(e.with_traceback)
-        return render_template('partials/reasons.html', reasons=[])
-
-
-@app.route('/fhir/specimentype/expand')
-def specimen_type_expand():
-    """
-    Expands the AU Specimen Type ValueSet for specimen type selection.
-    Query params:
-      - specimenType: search string
-    """
-    query = request.args.get('specimenType', '').strip()
-    if not query:
-        return '<option value="">Start typing to search specimen types...</option>'
-    
-    valueset_url = 'https://healthterminologies.gov.au/fhir/ValueSet/specimen-type-1'
-    terminology_server = "https://r4.ontoserver.csiro.au/fhir" 
-    expand_url = f"{terminology_server}/ValueSet/$expand"
-    params = {
-        "url": valueset_url,
-        "filter": query,
-        "count": 15
-    }
+# Typeahead pickers backed by the shared terminology service. Each entry
+# registers a GET route that expands a named ValueSet from terminology.VALUESETS
+# and renders the result through a partial; adding a picker is a new entry here.
+#   param         - query-string field holding the search text
+#   valueset      - ValueSet name, or {selector value: ValueSet name}
+#   selector      - query-string field choosing between ValueSets
+#   require_query - return the empty response when there is no search text
+#   empty_html / error_html - literal responses (otherwise the partial with no items)
+VALUESET_PICKERS = [
+    {
+        'endpoint': 'diag_valueset_expand',
+        'rule': '/fhir/diagvalueset/expand',
+        'param': 'testName',
+        'valueset': {'pathology': 'pathology-tests', 'radiology': 'radiology-tests'},
+        'selector': 'requestCategory',
+        'require_query': True,
+        'template': 'partials/test_names.html',
+        'items_var': 'testNames',
+    },
+    {
+        'endpoint': 'reason_valueset_expand',
+        'rule': '/fhir/reasonvalueset/expand',
+        'param': 'reason',
+        'valueset': 'reason-for-request',
+        'require_query': False,
+        'template': 'partials/reasons.html',
+        'items_var': 'reasons',
+    },
+    {
+        'endpoint': 'specimen_type_expand',
+        'rule': '/fhir/specimentype/expand',
+        'param': 'specimenType',
+        'valueset': 'specimen-type',
+        'require_query': True,
+        'template': 'partials/valueset_options.html',
+        'items_var': 'items',
+        'empty_html': '<option value="">Start typing to search specimen types...</option>',
+        'error_html': '<option value="">Error loading specimen types</option>',
+    },
+    {
+        'endpoint': 'collection_method_expand',
+        'rule': '/fhir/collectionmethod/expand',
+        'param': 'collectionMethod',
+        'valueset': 'collection-method',
+        'require_query': True,
+        'template': 'partials/valueset_options.html',
+        'items_var': 'items',
+        'empty_html': '<option value="">Start typing to search collection methods...</option>',
+        'error_html': '<option value="">Error loading collection methods</option>',
+    },
+    {
+        'endpoint': 'body_site_expand',
+        'rule': '/fhir/bodysite/expand',
+        'param': 'bodySite',
+        'valueset': 'body-site',
+        'require_query': True,
+        'template': 'partials/valueset_options.html',
+        'items_var': 'items',
+        'empty_html': '<option value="">Start typing to search body sites...</option>',
+        'error_html': '<option value="">Error loading body sites</option>',
+    },
+]
+
+
+def _make_valueset_picker_view(picker):
+    """Build the view function for one VALUESET_PICKERS entry."""
+    def render(items):
+        return render_template(picker['template'], **{picker['items_var']: items})
+
+    def view():
+        query = request.args.get(picker['param'], '').strip()
+        valueset = picker['valueset']
+        if isinstance(valueset, dict):
+            valueset = valueset.get(request.args.get(picker['selector'], '').lower())
+
+        if not valueset or (picker['require_query'] and not query):
+            return picker['empty_html'] if 'empty_html' in picker else render([])
 
-    try:
-        resp = requests.get(expand_url, params=params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        
-        options = []
-        contains = data.get("expansion", {}).get("contains", [])
-        for item in contains:
-            code = item.get("code", "")
-            display = item.get("display") or code
-            if display:
-                options.append(f'<option value="{display}" data-code="{code}">{display}</option>')
-        
-        return ''.join(options)
-    except Exception as e:
-        print(f"Error expanding specimen type ValueSet: {e}")
-        return '<option value="">Error loading specimen types</option>'
+        try:
+            return get_terminology_service().render_fragment(
+                valueset, query, render, variant=picker['endpoint'])
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Request error in {picker['endpoint']}: {e}")
+            if e.response is not None:
+                logging.error(f'Response status: {e.response.status_code}')
+        except Exception as e:
+            logging.error(f"General error in {picker['endpoint']}: {type(e).__name__}: {e}")
+        return picker['error_html'] if 'error_html' in picker else render([])
 
+    view.__name__ = picker['endpoint']
+    view.__doc__ = f"Expands the {picker['valueset']} ValueSet for the '{picker['param']}' picker."
+    return view
 
-@app.route('/fhir/collectionmethod/expand')
-def collection_method_expand():
-    """
-    Expands the AU Specimen Collection Procedure ValueSet for collection method selection.
-    Query params:
-      - collectionMethod: search string
-    """
-    query = request.args.get('collectionMethod', '').strip()
-    if not query:
-        return '<option value="">Start typing to search collection methods...</option>'
-    
-    valueset_url = 'https://healthterminologies.gov.au/fhir/ValueSet/specimen-collection-procedure-1'
-    terminology_server = "https://r4.ontoserver.csiro.au/fhir" 
-    expand_url = f"{terminology_server}/ValueSet/$expand"
-    params = {
-        "url": valueset_url,
-        "filter": query,
-        "count": 15
-    }
 
-    try:
-        resp = requests.get(expand_url, params=params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        
-        options = []
-        contains = data.get("expansion", {}).get("contains", [])
-        for item in contains:
-            code = item.get("code", "")
-            display = item.get("display") or code
-            if display:
-                options.append(f'<option value="{display}" data-code="{code}">{display}</option>')
-        
-        return ''.join(options)
-    except Exception as e:
-        print(f"Error expanding collection method ValueSet: {e}")
-        return '<option value="">Error loading collection methods</option>'
+for _picker in VALUESET_PICKERS:
+    app.add_url_rule(_picker['rule'], _picker['endpoint'], _make_valueset_picker_view(_picker))
 
-
-@app.route('/fhir/bodysite/expand')
-def body_site_expand():
-    """
-    Expands the AU Body Site ValueSet for body site selection.
-    Query params:
-      - bodySite: search string
-    """
-    query = request.args.get('bodySite', '').strip()
-    if not query:
-        return '<option value="">Start typing to search body sites...</option>'
-    
-    valueset_url = 'https://healthterminologies.gov.au/fhir/ValueSet/body-site-1'
-    terminology_server = "https://r4.ontoserver.csiro.au/fhir" 
-    expand_url = f"{terminology_server}/ValueSet/$expand"
-    params = {
-        "url": valueset_url,
-        "filter": query,
-        "count": 15
-    }
-
-    try:
-        resp = requests.get(expand_url, params=params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        
-        options = []
-        contains = data.get("expansion", {}).get("contains", [])
-        for item in contains:
-            code = item.get("code", "")
-            display = item.get("display") or code
-            if display:
-                options.append(f'<option value="{display}" data-code="{code}">{display}</option>')
-        
-        return ''.join(options)
-    except Exception as e:
-        print(f"Error expanding body site ValueSet: {e}")
-        return '<option value="">Error loading body sites</option>'
+# Warm the terminology cache from the order sets in the background at startup
+if os.environ.get('TESTING') != 'true':
+    start_cache_warmup(os.path.join(os.path.dirname(__file__), 'order_sets'))
 
 
 @app.route('/fhir/Demographics')
@@ -2712,6 +2811,90 @@ def debug_tasks():
         return jsonify({"error": str(e)}), 500
 
 
+# ServiceRequest ids per _id search when resolving task board focus resources
+SERVICE_REQUEST_SEARCH_CHUNK = 50
+
+
+def _search_service_requests(sr_ids, fhir_server_url, auth):
+    """One ServiceRequest?_id=a,b,c search. Returns {id: ServiceRequest} for those found ({} if it failed)."""
+    try:
+        resp = requests.get(f"{fhir_server_url}/ServiceRequest",
+                            params=[('_id', ','.join(sr_ids)), ('_count', str(len(sr_ids)))], auth=auth, timeout=8)
+        if resp.status_code != 200:
+            logging.warning(f"ServiceRequest search for {len(sr_ids)} ids failed: {resp.status_code}")
+            return {}
+        found = {}
+        for entry in resp.json().get('entry', []):
+            resource = entry.get('resource', {})
+            if resource.get('resourceType') == 'ServiceRequest':
+                found[resource.get('id', '')] = resource
+        return found
+    except Exception as e:
+        logging.warning(f"ServiceRequest search for {len(sr_ids)} ids failed: {e}")
+        return {}
+
+
+def fetch_service_requests(sr_ids, fhir_server_url, auth):
+    """
+    Fetch ServiceRequests by id with one _id search per SERVICE_REQUEST_SEARCH_CHUNK
+    ids, the searches running concurrently. Returns {id: ServiceRequest} for those found.
+    """
+    sr_ids = list(dict.fromkeys(filter(None, sr_ids)))
+    chunks = [sr_ids[start:start + SERVICE_REQUEST_SEARCH_CHUNK]
+              for start in range(0, len(sr_ids), SERVICE_REQUEST_SEARCH_CHUNK)]
+    if len(chunks) <= 1:
+        return _search_service_requests(chunks[0], fhir_server_url, auth) if chunks else {}
+    found = {}
+    with ThreadPoolExecutor(max_workers=min(len(chunks), 4), thread_name_prefix='service-requests') as executor:
+        for result in executor.map(lambda chunk: _search_service_requests(chunk, fhir_server_url, auth), chunks):
+            found.update(result)
+    return found
+
+
+# Includes the task board asks for: each task's ServiceRequest and Patient, and group tasks' children
+TASK_BOARD_INCLUDES = (('_include', 'Task:focus'), ('_include', 'Task:patient'), ('_revinclude', 'Task:part-of'))
+
+# Replies to the search with includes that mean a server does not support them (anything else may be transient)
+TASK_INCLUDE_UNSUPPORTED_STATUSES = (400, 403, 422, 501)
+
+# FHIR server base URL -> the TASK_BOARD_INCLUDES it supports
+_task_include_support = TTLCache(maxsize=256, ttl=86400)
+
+
+def task_board_includes(fhir_server_url, auth):
+    """
+    The TASK_BOARD_INCLUDES a server supports, read once per server from the
+    Task searchInclude / searchRevInclude of its CapabilityStatement and
+    cached. A server that declares none is assumed to support them all until a
+    search with them fails (get_tasks_by_org then caches that it has none).
+    """
+    supported = _task_include_support.get(fhir_server_url)
+    if supported is not None:
+        return supported
+    supported = TASK_BOARD_INCLUDES
+    try:
+        resp = requests.get(f"{fhir_server_url}/metadata", headers={'Accept': 'application/fhir+json'},
+                            auth=auth, timeout=10)
+        if resp.status_code != 200:
+            raise ValueError(f"HTTP {resp.status_code}")
+        declared = {'_include': set(), '_revinclude': set()}
+        for rest in resp.json().get('rest', []):
+            for resource in rest.get('resource', []):
+                if resource.get('type') == 'Task':
+                    declared['_include'].update(resource.get('searchInclude', []))
+                    declared['_revinclude'].update(resource.get('searchRevInclude', []))
+        if declared['_include'] or declared['_revinclude']:
+            supported = tuple((param, value) for param, value in TASK_BOARD_INCLUDES
+                              if value in declared[param] or '*' in declared[param])
+    except Exception as e:
+        # Not known yet: assume support, and check the CapabilityStatement again in a few minutes
+        logging.warning(f"Could not read Task include support of {fhir_server_url}: {e}")
+        _task_include_support.set(fhir_server_url, supported, ttl=300)
+        return supported
+    _task_include_support.set(fhir_server_url, supported)
+    return supported
+
+
 @app.route('/api/tasks/by-org', methods=['GET'])
 @login_required
 def get_tasks_by_org():
@@ -2739,49 +2922,37 @@ def get_tasks_by_org():
             logging.info(f"Auth username: {auth[0]}")
         
         # Query tasks with owner org identifier - no status filter, show all tasks
-        # Start with minimal params matching your working Postman query
         task_url = f"{fhir_server_url}/Task"
         params_list = [
             ('owner:Organization.identifier', f"http://ns.electronichealth.net.au/id/hi/hpio/1.0|{org_identifier}"),
             ('_tag', 'http://terminology.hl7.org.au/CodeSystem/resource-tag|fulfilment-task-group')
         ]
+        if limit:
+            params_list.append(('_count', str(limit)))
+        if offset > 0:
+            params_list.append(('_offset', str(offset)))
         
-        # Try initial request without includes to test if that's the problem
-        logging.info(f"Fetching tasks for org {org_identifier}, offset={offset}, limit={limit}")
-        logging.info(f"Initial query params (no includes): {params_list}")
-        resp = requests.get(task_url, params=params_list, auth=auth, timeout=10)
+        # One search, with whichever includes this server is known to support
+        includes = task_board_includes(fhir_server_url, auth)
+        logging.info(f"Fetching tasks for org {org_identifier}, offset={offset}, limit={limit}, includes={includes}")
+        resp = requests.get(task_url, params=params_list + list(includes), auth=auth, timeout=10)
         
         logging.info(f"FHIR API URL called: {resp.url}")
         logging.info(f"Response status: {resp.status_code}")
         
+        if resp.status_code != 200 and includes:
+            logging.warning(f"Request with includes failed: {resp.status_code}, retrying without includes")
+            failed_status = resp.status_code
+            resp = requests.get(task_url, params=params_list, auth=auth, timeout=10)
+            if resp.status_code == 200 and failed_status in TASK_INCLUDE_UNSUPPORTED_STATUSES:
+                # Only the includes were the problem: leave them out for this server from now on
+                _task_include_support.set(fhir_server_url, ())
+        
         if resp.status_code != 200:
             logging.warning(f"Failed to fetch tasks: {resp.status_code}")
             logging.warning(f"Response body: {resp.text[:1000]}")
             return jsonify({"error": f"Failed to fetch tasks: {resp.status_code}", "details": resp.text[:300]}), resp.status_code
         
-        # If successful, try with includes in a second request
-        params_with_includes = params_list + [
-            ('_include', 'Task:focus'),
-            ('_include', 'Task:patient'),
-            ('_revinclude', 'Task:part-of')  # Include child tasks that reference these group tasks
-        ]
-        
-        if limit:
-            params_with_includes.append(('_count', str(limit)))
-        if offset > 0:
-            params_with_includes.append(('_offset', str(offset)))
-        
-        logging.info(f"Now retrying with includes: {params_with_includes}")
-        resp = requests.get(task_url, params=params_with_includes, auth=auth, timeout=10)
-        
-        logging.info(f"With includes - FHIR API URL: {resp.url}")
-        
-        if resp.status_code != 200:
-            logging.warning(f"Request with includes failed: {resp.status_code}, trying without includes")
-            # Fall back to response without includes from first call
-            resp = requests.get(task_url, params=params_list, auth=auth, timeout=10)
-        
-
         data = resp.json()
         entries = data.get('entry', [])
         total_count = data.get('total', 0)
@@ -2824,6 +2995,17 @@ def get_tasks_by_org():
         
         logging.info(f"Found {len(child_task_map)} group tasks with children: {list(child_task_map.keys())[:5]}")
         
+        # Fetch every focus ServiceRequest the _include did not return, in one batch
+        missing_sr_ids = set()
+        for entry in entries:
+            resource = entry.get('resource', {})
+            focus_ref = resource.get('focus', {}).get('reference', '') if resource.get('resourceType') == 'Task' else ''
+            if 'ServiceRequest/' in focus_ref and focus_ref.split('/')[-1] not in sr_map:
+                missing_sr_ids.add(focus_ref.split('/')[-1])
+        if missing_sr_ids:
+            logging.info(f"Fetching {len(missing_sr_ids)} ServiceRequests not returned by _include")
+            sr_map.update(fetch_service_requests(sorted(missing_sr_ids), fhir_server_url, auth))
+        
         # Third pass: process tasks with full context
         for entry in entries:
             resource = entry.get('resource', {})
@@ -2928,21 +3110,7 @@ def get_tasks_by_org():
                         else:
                             logging.debug(f"Task {task_id}: SR {single_sr_id} has no coding array, skipping text fallback")
                     else:
-                        # Try fetching individual SR
-                        logging.warning(f"Task {task_id}: ServiceRequest {single_sr_id} not in bundle, attempting direct fetch")
-                        try:
-                            sr_resp = requests.get(f"{fhir_server_url}/ServiceRequest/{single_sr_id}", auth=auth, timeout=8)
-                            if sr_resp.status_code == 200:
-                                single_sr = sr_resp.json()
-                                code_obj = single_sr.get('code', {})
-                                if code_obj.get('coding'):
-                                    for coding in code_obj.get('coding', []):
-                                        display = coding.get('display')
-                                        if display and display not in sr_code_displays:
-                                            sr_code_displays.append(display)
-                                            logging.info(f"Task {task_id}: Fetched SR {single_sr_id} code display: {display}")
-                        except Exception as e:
-                            logging.warning(f"Failed to fetch ServiceRequest {single_sr_id}: {e}")
+                        logging.warning(f"Task {task_id}: ServiceRequest {single_sr_id} not found")
                 # For group tasks, use first code display as summary (not text field)
                 service_request = sr_map.get(sr_ids[0]) if sr_ids else None
                 if service_request:
@@ -2972,32 +3140,8 @@ def get_tasks_by_org():
                 else:
                     logging.warning(f"Task {task_id}: ServiceRequest has no codings or text")
                 sr_description = service_request.get('intent', '')
-            else:
-                # If not included, try fetching the ServiceRequest directly (best-effort)
-                logging.warning(f"Task {task_id}: ServiceRequest {sr_id} not in bundle, attempting direct fetch")
-                if sr_id:
-                    try:
-                        sr_resp = requests.get(f"{fhir_server_url}/ServiceRequest/{sr_id}", auth=auth, timeout=8)
-                        logging.info(f"Task {task_id}: Direct SR fetch status={sr_resp.status_code}")
-                        if sr_resp.status_code == 200:
-                            service_request = sr_resp.json()
-                            code_obj = service_request.get('code', {})
-                            sr_code = code_obj.get('text', '')
-                            if not sr_code and code_obj.get('coding'):
-                                sr_code = code_obj['coding'][0].get('display', '')
-                            if code_obj.get('coding'):
-                                logging.info(f"Task {task_id}: Fetched SR has {len(code_obj.get('coding', []))} codings")
-                                for coding in code_obj.get('coding', []):
-                                    display = coding.get('display') or coding.get('code') or ''
-                                    if display:
-                                        sr_code_displays.append(display)
-                                        logging.info(f"Task {task_id}: Fetched SR code display: {display}")
-                            elif sr_code:
-                                sr_code_displays.append(sr_code)
-                                logging.info(f"Task {task_id}: Fetched SR code text: {sr_code}")
-                            sr_description = service_request.get('intent', '')
-                    except Exception as e:
-                        logging.warning(f"Failed to fetch ServiceRequest {sr_id}: {e}")
+            elif sr_id:
+                logging.warning(f"Task {task_id}: ServiceRequest {sr_id} not found")
             # Extract placer group number from ServiceRequest.requisition if not found in Task
             if service_request and not placer_group_number:
                 requisition = service_request.get('requisition', {})
@@ -0,0 +1,300 @@
+"""
+Bulk Bundler Module
+
+Generates eRequesting transaction bundles in bulk, e.g. to load-test a filler.
+Order specs arrive as NDJSON (one JSON object per line) and bundles are built
+with create_request_bundle across a process pool. Requesters and terminology
+are resolved once in the parent process and shared with every worker, so the
+workers never call out to a server. Results stream back as NDJSON in input
+order, followed by a throughput report. With validate, each bundle is also
+checked against the fhirclient models in the worker that built it (see
+bundle_validation) and the report includes the validation cost per resource.
+
+Order spec fields (anything else is passed through as a form field):
+    patient        Patient id (required)
+    requester      PractitionerRole id of the requester
+    organisation   Organization id of the filler
+    category       'Pathology' (default) or 'Radiology'
+    tests          list of {"code", "display", "text"} (or display strings)
+    reasons        list of {"code", "display"} (or display strings)
+    specimen       {"type", "method", "bodySite", "collectedDateTime"} plus
+                   optional "typeCode", "methodCode", "bodySiteCode"
+    copyTo         list of PractitionerRole ids
+
+Configuration (environment variables):
+    BULK_BUNDLER_WORKERS      worker processes (default: CPU count)
+    BULK_BUNDLER_MAX_ORDERS   maximum order specs accepted per request by the API
+    BULK_BUNDLER_MAX_WORKERS  most worker processes an API request may ask for
+                              (default: BULK_BUNDLER_WORKERS)
+
+Command line:
+    python bulk_bundler.py orders.ndjson -o bundles.ndjson --workers 4 [--validate]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from bundler import create_request_bundle, fetch_directory
+from bundle_validation import merge_timings, timing_report, validate_bundle
+from terminology import SNOMED_SYSTEM, _normalise_filter, get_terminology_service
+
+# Order spec shorthand -> diagnostic request form field
+SPEC_FIELDS = {
+    'patient': 'patient_id',
+    'category': 'requestCategory',
+    'tests': 'selectedTests',
+    'reasons': 'selectedReasons',
+}
+
+# Order spec "specimen" keys -> form fields
+SPECIMEN_FIELDS = {
+    'type': 'specimenType',
+    'typeCode': 'specimenTypeCode',
+    'method': 'collectionMethod',
+    'methodCode': 'collectionMethodCode',
+    'bodySite': 'bodySite',
+    'bodySiteCode': 'bodySiteCode',
+    'collectedDateTime': 'collectionDateTime',
+}
+
+# Specimen form field -> (code field, ValueSet used to resolve it)
+SPECIMEN_LOOKUPS = (
+    ('specimenType', 'specimenTypeCode', 'specimen-type'),
+    ('collectionMethod', 'collectionMethodCode', 'collection-method'),
+    ('bodySite', 'bodySiteCode', 'body-site'),
+)
+
+def default_workers() -> int:
+    return int(os.environ.get('BULK_BUNDLER_WORKERS', 0)) or os.cpu_count() or 1
+
+
+def max_workers() -> int:
+    """Upper bound on the ?workers= an API caller may request."""
+    return max(1, int(os.environ.get('BULK_BUNDLER_MAX_WORKERS', 0)) or default_workers())
+
+
+def order_spec_to_form_data(spec: Dict) -> Dict:
+    """Convert one order spec into the form data create_request_bundle expects."""
+    if not isinstance(spec, dict):
+        raise ValueError("Order spec must be a JSON object")
+    form_data = {}
+    for key, value in spec.items():
+        if key == 'specimen':
+            if value:
+                form_data['specimenCollected'] = 'true'
+                for spec_key, field in SPECIMEN_FIELDS.items():
+                    if value.get(spec_key):
+                        form_data[field] = value[spec_key]
+        else:
+            form_data[SPEC_FIELDS.get(key, key)] = value
+    if not form_data.get('patient_id'):
+        raise ValueError("Order spec has no patient")
+    return form_data
+
+
+def parse_order_specs(lines: Iterable) -> List[Tuple[int, Optional[Dict], Optional[str]]]:
+    """
+    Parse NDJSON order specs. Returns (line number, form data, error) for every
+    non-blank line; exactly one of form data and error is set.
+    """
+    orders = []
+    for line_number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            orders.append((line_number, order_spec_to_form_data(json.loads(line)), None))
+        except (ValueError, AttributeError) as e:
+            orders.append((line_number, None, str(e)))
+    return orders
+
+
+def resolve_directory(requester_ids: Iterable[str], fhir_server_url=None, auth_credentials=None) -> Dict:
+    """Fetch every distinct requester's PractitionerRole/Practitioner with batched _id searches."""
+    requester_ids = sorted(set(filter(None, requester_ids)))
+    if not requester_ids:
+        return {}
+    return fetch_directory(requester_ids, fhir_server_url, auth_credentials)
+
+
+def prepare_terminology(forms: List[Dict]) -> Tuple[Dict[str, list], bool]:
+    """
+    Resolve every specimen term and validate every test code the orders use,
+    in as few round-trips as possible. Returns a cache snapshot for the workers
+    and whether they should apply canonical test displays.
+    """
+    service = get_terminology_service()
+    lookups = {}
+    codes = set()
+    for form in forms:
+        if form.get('requestCategory', 'Pathology') == 'Pathology' and form.get('specimenCollected') == 'true':
+            for field, code_field, valueset in SPECIMEN_LOOKUPS:
+                term = str(form.get(field) or '').strip()
+                if term and not str(form.get(code_field) or '').strip():
+                    lookups[(service.valueset_url(valueset), _normalise_filter(term))] = (term, valueset)
+        tests = form.get('selectedTests') or []
+        if isinstance(tests, list):
+            codes.update(str(t.get('code') or '').strip() for t in tests if isinstance(t, dict))
+    codes.discard('')
+
+    resolved = service.resolve_codes(lookups) if lookups else {}
+    validate_codes = service.validate_codes
+    if validate_codes and codes:
+        displays = service.lookup_displays((SNOMED_SYSTEM, code) for code in codes)
+        if len(displays) < len(codes):
+            logging.warning("Bulk bundler: %d test codes could not be validated; keeping supplied displays",
+                            len(codes) - len(displays))
+            validate_codes = False
+
+    snapshot = service.export_cache()
+    # export_cache leaves out misses (the service keeps them only briefly), so
+    # the snapshot carries this run's empty answers explicitly; otherwise the
+    # workers would retry them for every bundle.
+    snapshot['resolved'].extend(resolved.items())
+    return snapshot, validate_codes
+
+
+_worker_directory: Dict = {}
+_worker_validate = False
+
+
+def _init_worker(directory: Dict, terminology_snapshot: Dict[str, list], validate_codes: bool,
+                 validate: bool = False):
+    """Process pool initializer: install the shared directory and terminology cache."""
+    global _worker_directory, _worker_validate
+    _worker_directory = directory
+    _worker_validate = validate
+    service = get_terminology_service()
+    service.load_cache(terminology_snapshot)
+    service.validate_codes = validate_codes
+
+
+def _build_bundle(form_data: Dict, directory: Optional[Dict] = None, validate: Optional[bool] = None):
+    """
+    Build one bundle, validating it if asked to. Returns (bundle JSON, entry
+    count, error, validation issues, validation timings).
+    """
+    try:
+        bundle = create_request_bundle(form_data, directory=_worker_directory if directory is None else directory)
+    except Exception as e:
+        return None, 0, str(e), None, None
+    timings = None
+    if _worker_validate if validate is None else validate:
+        timings = {}
+        issues = validate_bundle(bundle, timings)
+        if issues:
+            return None, 0, f"Bundle failed validation ({len(issues)} issues)", issues, timings
+    return json.dumps(bundle), len(bundle['entry']), None, None, timings
+
+
+class BulkRun:
+    """
+    One bulk generation run. Iterate it for NDJSON lines (one per order spec,
+    in input order; failed orders yield {"line": n, "error": ...}). Once
+    exhausted, `report` holds the throughput figures.
+    """
+
+    def __init__(self, lines: Iterable, workers: Optional[int] = None,
+                 fhir_server_url=None, auth_credentials=None, validate: bool = False):
+        self.orders = parse_order_specs(lines)
+        self.workers = default_workers() if workers is None else workers
+        self.validate = validate
+        self.fhir_server_url = fhir_server_url
+        self.auth_credentials = auth_credentials
+        self.report: Dict = {}
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __iter__(self) -> Iterator[str]:
+        started = time.perf_counter()
+        forms = [form for _, form, _ in self.orders if form is not None]
+        directory = resolve_directory((form.get('requester') for form in forms),
+                                      self.fhir_server_url, self.auth_credentials)
+        snapshot, validate_codes = prepare_terminology(forms)
+        prepared = time.perf_counter()
+
+        workers = max(1, min(self.workers, len(forms)))
+        bundles = errors = entries = 0
+        validation_timings = {}
+        results = self._results(forms, workers, directory, snapshot, validate_codes, self.validate)
+        for line_number, _, parse_error in self.orders:
+            if parse_error is None:
+                bundle_json, entry_count, error, issues, timings = next(results)
+                if timings:
+                    merge_timings(validation_timings, timings)
+            else:
+                bundle_json, entry_count, error, issues = None, 0, parse_error, None
+            if error is None:
+                bundles += 1
+                entries += entry_count
+                yield bundle_json + '\n'
+            else:
+                errors += 1
+                failure = {"line": line_number, "error": error}
+                if issues:
+                    failure["issue"] = issues
+                yield json.dumps(failure) + '\n'
+
+        finished = time.perf_counter()
+        build_seconds = finished - prepared
+        self.report = {
+            "orders": len(self.orders),
+            "bundles": bundles,
+            "errors": errors,
+            "entries": entries,
+            "workers": workers,
+            "requesters": len(directory),
+            "prepareSeconds": round(prepared - started, 3),
+            "buildSeconds": round(build_seconds, 3),
+            "bundlesPerSecond": round(bundles / build_seconds, 1) if build_seconds else None,
+            "entriesPerSecond": round(entries / build_seconds, 1) if build_seconds else None,
+        }
+        if self.validate:
+            self.report["validation"] = timing_report(validation_timings)
+        logging.info("Bulk bundler: %s", self.report)
+
+    @staticmethod
+    def _results(forms, workers, directory, snapshot, validate_codes, validate):
+        if workers == 1:
+            # Small runs are built in-process; the parent's caches are already warm
+            for form in forms:
+                yield _build_bundle(form, directory, validate)
+            return
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(directory, snapshot, validate_codes, validate)) as pool:
+            yield from pool.map(_build_bundle, forms, chunksize=max(1, len(forms) // (workers * 4)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate eRequesting bundles from NDJSON order specs")
+    parser.add_argument('orders', help="NDJSON file of order specs ('-' for stdin)")
+    parser.add_argument('-o', '--output', default='-', help="NDJSON output file (default: stdout)")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--server', default=None, help="FHIR server used to resolve requesters")
+    parser.add_argument('--validate', action='store_true', help="validate each bundle against the FHIR models")
+    args = parser.parse_args(argv)
+
+    if args.orders == '-':
+        run = BulkRun(sys.stdin, workers=args.workers, fhir_server_url=args.server, validate=args.validate)
+    else:
+        with open(args.orders, 'r', encoding='utf-8') as source:
+            run = BulkRun(source, workers=args.workers, fhir_server_url=args.server, validate=args.validate)
+    if args.output == '-':
+        sys.stdout.writelines(run)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            output.writelines(run)
+    print(json.dumps(run.report, indent=2), file=sys.stderr)
+    return 1 if run.report.get('errors') else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
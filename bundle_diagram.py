@@ -0,0 +1,137 @@
+"""
+Bundle Diagram Module
+
+Builds the diagram of a posted bundle (extract_resources -> build_graph ->
+an exporter from graph_exporters.FORMATS) once per distinct request body.
+The graph, its clustered/grouped views (graph_clustering) and each format
+rendered from them are kept in a small LRU keyed by a hash of the raw body,
+so Draw followed by Download, or redrawing an unchanged bundle, costs one
+hash and a lookup. The hash (plus the format and view) doubles as the ETag
+for conditional requests. Bodies are decoded with bundle_reader.load_bundle,
+keeping only each entry's fullUrl and resource, without its narrative.
+
+Configuration (environment variables):
+    BUNDLE_DIAGRAM_CACHE_SIZE   diagrams kept (default: 32)
+    BUNDLE_DIAGRAM_CACHE_TTL    seconds a diagram is kept (default: 600)
+"""
+
+import os
+import hashlib
+import threading
+from typing import Dict, Iterator, Optional, Tuple
+
+from bundle_reader import load_bundle
+from fhir_parser import extract_resources
+from fhirutils import TTLCache
+from graph_builder import Graph, build_graph
+from graph_clustering import DiagramView, apply_view, resolve_view
+from graph_exporters import FORMATS
+
+DEFAULT_TITLE = "Diagnostic Request Bundle"
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_VIEWS = 16  # clustered/grouped views kept per diagram
+
+_cache = TTLCache(maxsize=int(os.environ.get('BUNDLE_DIAGRAM_CACHE_SIZE', 32)),
+                  ttl=int(os.environ.get('BUNDLE_DIAGRAM_CACHE_TTL', 600)))
+
+
+class BundleDiagram:
+    """The graph of one bundle, its views and the text rendered from them so far."""
+
+    def __init__(self, etag: str, graph: Graph):
+        self.etag = etag
+        self.graph = graph
+        self._views: Dict[DiagramView, Graph] = {}
+        self._rendered: Dict[Tuple[str, str, DiagramView], str] = {}
+        self._lock = threading.Lock()
+
+    def etag_for(self, fmt: str = 'mermaid', view: Optional[DiagramView] = None) -> str:
+        """ETag of one format and view of this diagram."""
+        return f"{self.etag}-{fmt}{resolve_view(self.graph, view).etag_suffix()}"
+
+    def view_graph(self, view: Optional[DiagramView] = None) -> Graph:
+        """The graph as drawn in a view (the bundle's own graph for the plain view)."""
+        view = resolve_view(self.graph, view)
+        if view.is_plain:
+            return self.graph
+        with self._lock:
+            graph = self._views.get(view)
+        if graph is None:
+            graph = apply_view(self.graph, view)
+            with self._lock:
+                if len(self._views) >= MAX_VIEWS:
+                    self._views.clear()
+                    self._rendered = {key: text for key, text in self._rendered.items() if key[2].is_plain}
+                self._views[view] = graph
+        return graph
+
+    def stream(self, fmt: str = 'mermaid', title: str = DEFAULT_TITLE,
+               view: Optional[DiagramView] = None) -> Iterator[str]:
+        """
+        The diagram in a format from graph_exporters.FORMATS. The first time,
+        the exporter's output is yielded in STREAM_CHUNK_SIZE pieces as it is
+        produced and the text is kept; after that it is served whole.
+        """
+        view = resolve_view(self.graph, view)
+        with self._lock:
+            text = self._rendered.get((fmt, title, view))
+        if text is not None:
+            yield text
+            return
+        pieces = []
+        pending = []
+        pending_size = 0
+        for chunk in FORMATS[fmt].exporter(self.view_graph(view), title):
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= STREAM_CHUNK_SIZE:
+                piece = ''.join(pending)
+                pieces.append(piece)
+                pending, pending_size = [], 0
+                yield piece
+        piece = ''.join(pending)
+        pieces.append(piece)
+        yield piece
+        with self._lock:
+            self._rendered[(fmt, title, view)] = ''.join(pieces)
+
+    def render(self, fmt: str = 'mermaid', title: str = DEFAULT_TITLE,
+               view: Optional[DiagramView] = None) -> str:
+        return ''.join(self.stream(fmt, title, view))
+
+    def mermaid(self, title: str = DEFAULT_TITLE) -> str:
+        return self.render('mermaid', title)
+
+
+def body_etag(body: bytes) -> str:
+    """Strong ETag (unquoted) for a request body."""
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+def diagram_for(body: bytes) -> BundleDiagram:
+    """
+    The diagram for a raw bundle request body, built on first use.
+    Raises ValueError if the body is not a bundle with resources, and
+    BundleTooLarge (a ValueError) if it has more than BUNDLE_MAX_ENTRIES entries.
+    """
+    etag = body_etag(body)
+    diagram = _cache.get(etag)
+    if diagram is not None:
+        return diagram
+
+    # Only what the graph needs is kept of each entry
+    bundle = load_bundle(body, fields=('fullUrl', 'resource'), without_narrative=True) if body.strip() else None
+    if not bundle:
+        raise ValueError("No bundle provided")
+    resources = extract_resources(bundle)
+    if not resources:
+        raise ValueError("No resources found in bundle")
+
+    diagram = BundleDiagram(etag, build_graph(resources))
+    _cache.set(etag, diagram)
+    return diagram
+
+
+def clear_cache():
+    """Drop all cached diagrams."""
+    _cache.clear()
@@ -0,0 +1,404 @@
+"""
+Bundle Diff Module
+
+Compares two FHIR Bundles entry by entry - for example two generated orders,
+or a preview against what the server stored.
+
+Entries are aligned in linear time, in passes over the entries still
+unmatched on both sides:
+
+    1. fullUrl
+    2. identifier (system|value, per resource type)
+    3. resource type + code (code, else type, CodeableConcept codings)
+    4. resource type + what the entry references, through the entries
+       aligned so far (e.g. a Task by its focus ServiceRequest)
+    5. position among the remaining entries of the same resource type
+
+Keys that occur more than once in either bundle are ambiguous and skipped. References in the right-hand bundle that point at
+aligned entries, and the ids of aligned resources, are rewritten to the
+left-hand values first, so regenerated urn:uuid fullUrls and
+server-assigned ids do not show up as changes.
+
+Each changed entry gets a minimal RFC 6902 JSON Patch that turns the left
+resource into the right one.
+"""
+
+import copy
+from collections import defaultdict
+from functools import partial
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fhir_parser import extract_resources, get_resource_id, get_resource_type_display
+from graph_builder import build_graph
+from mermaid_generator import iter_mermaid, _sanitize_node_ids
+
+_STATUS_STYLES = {
+    "added": "fill:#e6f4ea,stroke:#1e8e3e,stroke-width:2px",
+    "removed": "fill:#fce8e6,stroke:#d93025,stroke-width:2px,stroke-dasharray: 5 5",
+    "changed": "fill:#fef7e0,stroke:#f9ab00,stroke-width:2px",
+}
+
+
+def diff_bundles(left: Dict[str, Any], right: Dict[str, Any], ignore: Sequence[str] = ()) -> Dict[str, Any]:
+    """
+    Compare two bundles. ignore lists JSON Pointers within a resource that are
+    left out of the comparison (e.g. /meta/lastUpdated).
+
+    Returns {"summary": {status: count}, "bundle": patch of the bundle itself
+    (without entries), "entries": [{"status", "resourceType", "label",
+    "matchedBy", "left", "right", "patch"?}]} with matched and removed
+    entries in left-hand order, then added entries in right-hand order.
+    """
+    summary = {"unchanged": 0, "changed": 0, "added": 0, "removed": 0}
+    results = []
+    for left_entry, right_entry, matched_by, status, patch in _compare(left, right, ignore):
+        resource = (right_entry or left_entry).get('resource') or {}
+        result = {"status": status,
+                  "resourceType": resource.get('resourceType'),
+                  "label": get_resource_type_display(resource),
+                  "matchedBy": matched_by,
+                  "left": left_entry.get('fullUrl') if left_entry else None,
+                  "right": right_entry.get('fullUrl') if right_entry else None}
+        if patch:
+            result["patch"] = patch
+        summary[status] += 1
+        results.append(result)
+
+    bundle_patch = json_patch({key: value for key, value in left.items() if key != 'entry'},
+                              {key: value for key, value in right.items() if key != 'entry'})
+    return {"summary": summary, "bundle": bundle_patch, "entries": results}
+
+
+def _compare(left: Dict[str, Any], right: Dict[str, Any], ignore: Sequence[str]) -> Iterator[Tuple]:
+    """(left entry, normalised right entry, matched by, status, patch) per aligned pair."""
+    left_entries = _entries(left)
+    right_entries = _entries(right)
+    pairs = align_entries(left_entries, right_entries)
+    right_entries = _normalise(left_entries, right_entries, pairs)
+    for left_index, right_index, matched_by in pairs:
+        if left_index is None:
+            yield None, right_entries[right_index], matched_by, "added", None
+        elif right_index is None:
+            yield left_entries[left_index], None, matched_by, "removed", None
+        else:
+            left_entry, right_entry = left_entries[left_index], right_entries[right_index]
+            patch = json_patch(_without(left_entry.get('resource'), ignore),
+                               _without(right_entry.get('resource'), ignore))
+            yield left_entry, right_entry, matched_by, "changed" if patch else "unchanged", patch
+
+
+def align_entries(left_entries: List[Dict], right_entries: List[Dict]) -> List[Tuple[Optional[int], Optional[int], Optional[str]]]:
+    """
+    Pair up the entries of two bundles (see the module docstring).
+    Returns (left index, right index, matched by) triples; an index is None
+    for an entry only in the other bundle, and so is matched by.
+    """
+    right_of: Dict[int, Tuple[int, str]] = {}
+    matched_right = set()
+    for matched_by in ("fullUrl", "identifier", "code", "references", "position"):
+        if matched_by == "references":
+            reference_map, _ = _alignment_maps(left_entries, right_entries,
+                                               ((left, right) for left, (right, _) in right_of.items()))
+            left_keys_of = _reference_keys
+            right_keys_of = partial(_reference_keys, reference_map=reference_map)
+        else:
+            left_keys_of = right_keys_of = _KEYS_OF[matched_by]
+        left_keys = _unique_keys(left_entries, left_keys_of, set(right_of))
+        right_keys = _unique_keys(right_entries, right_keys_of, matched_right)
+        for key, left_index in left_keys.items():
+            right_index = right_keys.get(key)
+            if right_index is not None:
+                right_of[left_index] = (right_index, matched_by)
+                matched_right.add(right_index)
+
+    pairs = []
+    for left_index in range(len(left_entries)):
+        right_index, matched_by = right_of.get(left_index, (None, None))
+        pairs.append((left_index, right_index, matched_by))
+    pairs.extend((None, right_index, None) for right_index in range(len(right_entries))
+                 if right_index not in matched_right)
+    return pairs
+
+
+def _entries(bundle: Dict[str, Any]) -> List[Dict]:
+    return [entry for entry in bundle.get('entry') or [] if isinstance(entry, dict)]
+
+
+def _resource_type(entry: Dict) -> Optional[str]:
+    resource = entry.get('resource')
+    return resource.get('resourceType') if isinstance(resource, dict) else None
+
+
+def _full_url_keys(entry: Dict) -> List:
+    full_url = entry.get('fullUrl')
+    return [full_url] if full_url else []
+
+
+def _identifier_keys(entry: Dict) -> List:
+    identifiers = (entry.get('resource') or {}).get('identifier')
+    if isinstance(identifiers, dict):
+        identifiers = [identifiers]
+    resource_type = _resource_type(entry)
+    return [(resource_type, identifier.get('system'), identifier.get('value'))
+            for identifier in identifiers or [] if isinstance(identifier, dict) and identifier.get('value')]
+
+
+def _code_keys(entry: Dict) -> List:
+    resource = entry.get('resource') or {}
+    concept = resource.get('code') or resource.get('type')
+    if not isinstance(concept, dict):
+        return []
+    codings = tuple(sorted((coding.get('system') or '', coding.get('code') or '')
+                           for coding in concept.get('coding') or [] if isinstance(coding, dict)))
+    if not codings:
+        return [(resource.get('resourceType'), concept.get('text'))] if concept.get('text') else []
+    return [(resource.get('resourceType'), codings)]
+
+
+def _reference_keys(entry: Dict, reference_map: Optional[Dict[str, str]] = None) -> List:
+    references = []
+    _collect_references(entry.get('resource'), references)
+    if not references:
+        return []
+    if reference_map:
+        references = [_map_reference(reference, reference_map) for reference in references]
+    return [(_resource_type(entry), tuple(sorted(references)))]
+
+
+def _collect_references(value: Any, references: List[str]):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'reference' and isinstance(item, str):
+                references.append(item)
+            else:
+                _collect_references(item, references)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_references(item, references)
+
+
+_KEYS_OF = {"fullUrl": _full_url_keys, "identifier": _identifier_keys, "code": _code_keys, "position": None}
+
+
+def _unique_keys(entries: List[Dict], keys_of, matched: set) -> Dict[Any, int]:
+    """
+    Key -> index of the one unmatched entry with that key (ambiguous keys
+    dropped). keys_of None keys entries by type and position within the type.
+    """
+    found: Dict[Any, int] = {}
+    ambiguous = set()
+    positions = defaultdict(int)
+    for index, entry in enumerate(entries):
+        if index in matched:
+            continue
+        if keys_of is None:
+            resource_type = _resource_type(entry)
+            keys = [(resource_type, positions[resource_type])]
+            positions[resource_type] += 1
+        else:
+            keys = set(keys_of(entry))
+        for key in keys:
+            if key in found:
+                ambiguous.add(key)
+            else:
+                found[key] = index
+    for key in ambiguous:
+        del found[key]
+    return found
+
+
+def _alignment_maps(left_entries: List[Dict], right_entries: List[Dict], matches) -> Tuple[Dict, Dict]:
+    """
+    For (left index, right index) matches: every form the right bundle may use
+    to point at a matched entry -> the left fullUrl, and right index -> the
+    left resource id where the ids differ.
+    """
+    reference_map = {}
+    id_map = {}
+    for left_index, right_index in matches:
+        left_entry, right_entry = left_entries[left_index], right_entries[right_index]
+        left_url = left_entry.get('fullUrl')
+        left_resource = left_entry.get('resource') or {}
+        right_resource = right_entry.get('resource') or {}
+        left_id = get_resource_id(left_resource, left_url or '')
+        if left_url:
+            right_forms = [right_entry.get('fullUrl')]
+            if right_resource.get('resourceType') and right_resource.get('id'):
+                right_forms.append(f"{right_resource['resourceType']}/{right_resource['id']}")
+            for form in right_forms:
+                if form and form != left_url:
+                    reference_map[form] = left_url
+        if right_resource.get('id') is not None and left_resource.get('id') != right_resource.get('id'):
+            id_map[right_index] = left_resource.get('id', left_id)
+    return reference_map, id_map
+
+
+def _normalise(left_entries: List[Dict], right_entries: List[Dict], pairs) -> List[Dict]:
+    """
+    Copies of the right-hand entries with references to aligned entries, and
+    the ids of aligned resources, rewritten to their left-hand values.
+    """
+    reference_map, id_map = _alignment_maps(
+        left_entries, right_entries,
+        ((left_index, right_index) for left_index, right_index, _ in pairs
+         if left_index is not None and right_index is not None))
+    normalised = []
+    for right_index, entry in enumerate(right_entries):
+        entry = _rewrite_references(entry, reference_map)
+        if right_index in id_map and isinstance(entry.get('resource'), dict):
+            entry['resource']['id'] = id_map[right_index]
+        normalised.append(entry)
+    return normalised
+
+
+def _rewrite_references(value: Any, reference_map: Dict[str, str]) -> Any:
+    """A copy of value with every Reference.reference in reference_map rewritten."""
+    if isinstance(value, dict):
+        copied = {}
+        for key, item in value.items():
+            if key == 'reference' and isinstance(item, str):
+                copied[key] = _map_reference(item, reference_map)
+            elif key == 'fullUrl' and isinstance(item, str):
+                copied[key] = reference_map.get(item, item)
+            else:
+                copied[key] = _rewrite_references(item, reference_map)
+        return copied
+    if isinstance(value, list):
+        return [_rewrite_references(item, reference_map) for item in value]
+    return value
+
+
+def _map_reference(reference: str, reference_map: Dict[str, str]) -> str:
+    mapped = reference_map.get(reference)
+    if mapped is not None:
+        return mapped
+    if 'urn:uuid:' in reference:
+        # Type/urn:uuid:... as written in USE_BROKEN_SMILECDR_MODE
+        prefix, uuid = reference.split('urn:uuid:', 1)
+        mapped = reference_map.get('urn:uuid:' + uuid)
+        if mapped is not None:
+            return prefix + mapped if mapped.startswith('urn:uuid:') else mapped
+    return reference
+
+
+def _without(resource: Any, pointers: Sequence[str]) -> Any:
+    """resource without the elements at the given JSON Pointers (a copy if any are given)."""
+    if not pointers or not isinstance(resource, dict):
+        return resource
+    resource = copy.deepcopy(resource)
+    for pointer in pointers:
+        parts = [_unescape(part) for part in pointer.split('/')[1:]]
+        parent = resource
+        for part in parts[:-1]:
+            parent = parent.get(part) if isinstance(parent, dict) else None
+        if isinstance(parent, dict) and parts:
+            parent.pop(parts[-1], None)
+    return resource
+
+
+def json_patch(source: Any, target: Any, path: str = '') -> List[Dict[str, Any]]:
+    """
+    RFC 6902 JSON Patch turning source into target, element by element:
+    objects are compared key by key, arrays past their common prefix and
+    suffix item by item, and only values that differ are replaced.
+    """
+    if source == target:
+        return []
+    if isinstance(source, dict) and isinstance(target, dict):
+        operations = []
+        for key, value in source.items():
+            if key not in target:
+                operations.append({"op": "remove", "path": f"{path}/{_escape(key)}"})
+        for key, value in target.items():
+            if key not in source:
+                operations.append({"op": "add", "path": f"{path}/{_escape(key)}", "value": value})
+            elif source[key] != value:
+                operations.extend(json_patch(source[key], value, f"{path}/{_escape(key)}"))
+        return operations
+    if isinstance(source, list) and isinstance(target, list):
+        return _list_patch(source, target, path)
+    return [{"op": "replace", "path": path, "value": target}]
+
+
+def _list_patch(source: List, target: List, path: str) -> List[Dict[str, Any]]:
+    start = 0
+    while start < len(source) and start < len(target) and source[start] == target[start]:
+        start += 1
+    source_end, target_end = len(source), len(target)
+    while source_end > start and target_end > start and source[source_end - 1] == target[target_end - 1]:
+        source_end -= 1
+        target_end -= 1
+    paired = min(source_end, target_end) - start
+
+    operations = []
+    for index in range(start, start + paired):
+        operations.extend(json_patch(source[index], target[index], f"{path}/{index}"))
+    # Removals from the highest index down, so earlier indexes stay valid
+    for index in range(source_end - 1, start + paired - 1, -1):
+        operations.append({"op": "remove", "path": f"{path}/{index}"})
+    for index in range(start + paired, target_end):
+        operations.append({"op": "add", "path": f"{path}/{index}", "value": target[index]})
+    return operations
+
+
+def apply_patch(document: Any, patch: List[Dict[str, Any]]) -> Any:
+    """Apply the add/remove/replace operations of a JSON Patch to a copy of document."""
+    document = copy.deepcopy(document)
+    for operation in patch:
+        parts = [_unescape(part) for part in operation['path'].split('/')[1:]]
+        if not parts:
+            document = copy.deepcopy(operation.get('value'))
+            continue
+        parent = document
+        for part in parts[:-1]:
+            parent = parent[int(part)] if isinstance(parent, list) else parent[part]
+        last = parts[-1]
+        if isinstance(parent, list):
+            index = len(parent) if last == '-' else int(last)
+            if operation['op'] == 'add':
+                parent.insert(index, copy.deepcopy(operation['value']))
+            elif operation['op'] == 'remove':
+                del parent[index]
+            else:
+                parent[index] = copy.deepcopy(operation['value'])
+        elif operation['op'] == 'remove':
+            del parent[last]
+        else:
+            parent[last] = copy.deepcopy(operation['value'])
+    return document
+
+
+def _escape(key: str) -> str:
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(part: str) -> str:
+    return part.replace('~1', '/').replace('~0', '~')
+
+
+def iter_diff_mermaid(left: Dict[str, Any], right: Dict[str, Any], ignore: Sequence[str] = (),
+                      bundle_title: str = "Bundle Diff") -> Iterator[str]:
+    """
+    Mermaid diagram of the right-hand bundle plus the entries removed from the
+    left, with added, removed and changed resources coloured.
+    """
+    entries = []
+    statuses = {}
+    for left_entry, right_entry, _, status, _ in _compare(left, right, ignore):
+        entry = right_entry or left_entry
+        entries.append(entry)
+        statuses[get_resource_id(entry.get('resource') or {}, entry.get('fullUrl', ''))] = status
+
+    graph = build_graph(extract_resources({"resourceType": "Bundle", "entry": entries}))
+    yield from iter_mermaid(graph, bundle_title)
+
+    sanitized_ids = _sanitize_node_ids(graph.ids)
+    by_status = defaultdict(list)
+    for sanitized_id, node_id in zip(sanitized_ids, graph.ids):
+        status = statuses.get(node_id)
+        if status in _STATUS_STYLES:
+            by_status[status].append(sanitized_id)
+    if by_status:
+        yield "\n\n    %% Diff status"
+        for status, node_ids in by_status.items():
+            yield f"\n    classDef {status} {_STATUS_STYLES[status]}\n    class {','.join(node_ids)} {status}"
@@ -0,0 +1,151 @@
+"""
+Bundle Integrity Module
+
+Local reference integrity check for transaction/batch Bundles, run before a
+bundle is submitted so broken bundles fail in milliseconds instead of after a
+server round-trip and rollback.
+
+One pass indexes every entry's fullUrl, resource Type/id and request url; a
+second pass walks every reference once. Both are linear in the size of the
+bundle. Issues are reported as OperationOutcome issues:
+
+    - references that resolve neither inside the bundle nor to a resource
+      type that is allowed to live on the server (BUNDLE_EXTERNAL_REFERENCE_TYPES)
+    - duplicate fullUrls
+    - a Task group that is not the last entry (fillers treat it as the trigger)
+
+Configuration (environment variables):
+    BUNDLE_EXTERNAL_REFERENCE_TYPES  comma-separated resource types that may be
+                                     referenced without being in the bundle
+"""
+
+import os
+import re
+from typing import Dict, List
+
+DEFAULT_EXTERNAL_REFERENCE_TYPES = ('Patient', 'PractitionerRole', 'Practitioner', 'Organization', 'Location')
+
+TASK_GROUP_PROFILE = "http://hl7.org.au/fhir/ereq/StructureDefinition/au-erequesting-task-group"
+TASK_GROUP_TAG = "fulfilment-task-group"
+
+# Type/id, optionally with a version: Patient/123, Patient/123/_history/2
+_RELATIVE_REFERENCE = re.compile(r'^([A-Z][A-Za-z]+)/([A-Za-z0-9\-.]{1,64})(?:/_history/[A-Za-z0-9\-.]{1,64})?$')
+# Server fullUrl ending in Type/id: https://example.org/fhir/Patient/123
+_ABSOLUTE_FULL_URL = re.compile(r'^https?://.*/([A-Z][A-Za-z]+/[A-Za-z0-9\-.]{1,64})$')
+# Type/urn:uuid:... as written in USE_BROKEN_SMILECDR_MODE
+_TYPED_URN = re.compile(r'^[A-Z][A-Za-z]+/(urn:uuid:.+)$')
+
+
+def external_reference_types():
+    configured = os.environ.get('BUNDLE_EXTERNAL_REFERENCE_TYPES')
+    if configured is None:
+        return frozenset(DEFAULT_EXTERNAL_REFERENCE_TYPES)
+    return frozenset(t.strip() for t in configured.split(',') if t.strip())
+
+
+def _issue(code: str, diagnostics: str, expression: str) -> Dict:
+    return {
+        "severity": "error",
+        "code": code,
+        "diagnostics": diagnostics,
+        "expression": [expression]
+    }
+
+
+def _is_task_group(resource: Dict) -> bool:
+    if resource.get('resourceType') != 'Task':
+        return False
+    meta = resource.get('meta') or {}
+    return (TASK_GROUP_PROFILE in (meta.get('profile') or ())
+            or any(tag.get('code') == TASK_GROUP_TAG for tag in meta.get('tag') or ()))
+
+
+def _references(value, path):
+    """Yield (path, reference) for every Reference.reference under value."""
+    stack = [(value, path)]
+    while stack:
+        value, path = stack.pop()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key == 'reference' and isinstance(item, str):
+                    yield path + '.reference', item
+                elif key != 'contained' and isinstance(item, (dict, list)):
+                    stack.append((item, f"{path}.{key}"))
+        elif isinstance(value, list):
+            for index, item in enumerate(value):
+                if isinstance(item, (dict, list)):
+                    stack.append((item, f"{path}[{index}]"))
+
+
+def check_bundle_references(bundle: Dict, external_types=None) -> List[Dict]:
+    """
+    Check a Bundle's internal consistency. Returns a list of OperationOutcome
+    issues, empty when every reference resolves and the entries are in order.
+    """
+    if external_types is None:
+        external_types = external_reference_types()
+    entries = bundle.get('entry') or []
+    issues = []
+
+    # Pass 1: index everything an entry can be referenced by
+    full_urls = {}
+    local_ids = set()
+    task_group_index = None
+    for index, entry in enumerate(entries):
+        full_url = entry.get('fullUrl')
+        if full_url:
+            if full_url in full_urls:
+                issues.append(_issue('duplicate', f"fullUrl {full_url} is also used by entry {full_urls[full_url]}",
+                                     f"Bundle.entry[{index}].fullUrl"))
+            else:
+                full_urls[full_url] = index
+            match = _ABSOLUTE_FULL_URL.search(full_url)
+            if match:
+                local_ids.add(match.group(1))
+        resource = entry.get('resource')
+        if isinstance(resource, dict):
+            if resource.get('resourceType') and resource.get('id'):
+                local_ids.add(f"{resource['resourceType']}/{resource['id']}")
+            if _is_task_group(resource):
+                task_group_index = index
+        request_url = (entry.get('request') or {}).get('url', '')
+        match = _RELATIVE_REFERENCE.match(request_url.split('?', 1)[0])
+        if match:
+            local_ids.add(f"{match.group(1)}/{match.group(2)}")
+
+    if task_group_index is not None and task_group_index != len(entries) - 1:
+        issues.append(_issue('business-rule', "The Task group must be the last entry in the bundle",
+                             f"Bundle.entry[{task_group_index}]"))
+
+    # Pass 2: every reference must resolve
+    for index, entry in enumerate(entries):
+        resource = entry.get('resource')
+        if not isinstance(resource, dict):
+            continue
+        contained = {f"#{c.get('id')}" for c in resource.get('contained') or () if isinstance(c, dict)}
+        for path, reference in _references(resource, f"Bundle.entry[{index}].resource"):
+            typed_urn = _TYPED_URN.match(reference)
+            if typed_urn:
+                reference = typed_urn.group(1)
+            if reference.startswith('urn:'):
+                if reference not in full_urls:
+                    issues.append(_issue('not-found', f"{reference} does not match any fullUrl in the bundle", path))
+            elif reference.startswith('#'):
+                if reference != '#' and reference not in contained:
+                    issues.append(_issue('not-found', f"{reference} does not match a contained resource", path))
+            elif reference.startswith(('http://', 'https://')) or '?' in reference:
+                continue  # absolute or conditional reference: resolved by the server
+            else:
+                match = _RELATIVE_REFERENCE.match(reference)
+                if not match:
+                    issues.append(_issue('invalid', f"{reference} is not a valid reference", path))
+                elif (f"{match.group(1)}/{match.group(2)}" not in local_ids
+                      and match.group(1) not in external_types):
+                    issues.append(_issue('not-found', f"{reference} is not in the bundle and {match.group(1)} "
+                                                      f"resources are not expected to exist on the server", path))
+    return issues
+
+
+def operation_outcome(issues: List[Dict]) -> Dict:
+    """Wrap integrity issues in an OperationOutcome resource."""
+    return {"resourceType": "OperationOutcome", "issue": issues}
@@ -0,0 +1,123 @@
+"""
+Bundle Preview Module
+
+Caches the serialised bundle shown in the diagnostic request preview.
+Clinicians often regenerate the preview with unchanged form data (e.g. after
+toggling the modal); an identical request is answered from the cache, with
+new resource ids, timestamp and requisition number spliced into the stored
+JSON, instead of rebuilding the bundle. The JSON is stored pre-split at every
+generated value, so a hit is a single join.
+
+Previews are content-addressed: the key is a hash of the processed form data,
+the FHIR server URL and the version of every directory resource (requester
+PractitionerRole and Practitioner) the bundle embeds, so a change to any of
+them is a miss.
+
+Configuration (environment variables):
+    BUNDLE_PREVIEW_CACHE_TTL    seconds a preview is reused (default: 300, 0 disables)
+    BUNDLE_PREVIEW_CACHE_SIZE   previews kept (default: 256)
+"""
+
+import os
+import json
+import uuid
+import hashlib
+from typing import Dict, List, Optional
+
+from bundler import get_localtime_bne, new_requisition_number
+from fhirutils import TTLCache
+
+PREVIEW_TTL = int(os.environ.get('BUNDLE_PREVIEW_CACHE_TTL', 300))
+_cache = TTLCache(maxsize=int(os.environ.get('BUNDLE_PREVIEW_CACHE_SIZE', 256)), ttl=max(PREVIEW_TTL, 1))
+
+
+def directory_versions(directory: Optional[Dict]):
+    """Version (meta.versionId, else meta.lastUpdated) of every resource in a bundler directory."""
+    versions = []
+    for role_id, resources in sorted((directory or {}).items()):
+        if resources is None:
+            versions.append((role_id, None))
+            continue
+        versions.append((role_id, [(r.get('resourceType'), r.get('id'),
+                                    (r.get('meta') or {}).get('versionId') or (r.get('meta') or {}).get('lastUpdated'))
+                                   for r in resources]))
+    return versions
+
+
+def preview_key(form_data: Dict, fhir_server_url: str, directory: Optional[Dict] = None) -> str:
+    """Canonical hash of everything a preview bundle is built from."""
+    canonical = json.dumps([form_data, fhir_server_url, directory_versions(directory)],
+                           sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _generated_values(bundle: Dict):
+    """The per-build values of a bundle: its uuids, timestamp and requisition number."""
+    uuids = {bundle['id']}
+    requisition_number = None
+    for entry in bundle.get('entry', []):
+        full_url = entry.get('fullUrl', '')
+        if full_url.startswith('urn:uuid:'):
+            uuids.add(full_url[len('urn:uuid:'):])
+        if requisition_number is None:
+            requisition_number = ((entry.get('resource') or {}).get('groupIdentifier') or {}).get('value')
+    return uuids, bundle.get('timestamp'), requisition_number
+
+
+def _split_at(text: str, tokens) -> List[str]:
+    """
+    Split text into [literal, token, literal, token, ..., literal] at every
+    occurrence of any of the tokens (the leftmost, then longest, match wins).
+    """
+    hits = []
+    for token in tokens:
+        index = text.find(token)
+        while index != -1:
+            hits.append((index, -len(token), token))
+            index = text.find(token, index + len(token))
+    hits.sort()
+    parts = []
+    position = 0
+    for index, _, token in hits:
+        if index < position:
+            continue  # inside a match already taken
+        parts.append(text[position:index])
+        parts.append(token)
+        position = index + len(token)
+    parts.append(text[position:])
+    return parts
+
+
+def store_preview(key: str, bundle: Dict) -> str:
+    """Serialise a freshly built preview bundle, caching it under key. Returns the JSON."""
+    bundle_json = json.dumps(bundle, indent=2)
+    if PREVIEW_TTL > 0:
+        uuids, timestamp, requisition_number = _generated_values(bundle)
+        parts = _split_at(bundle_json, uuids | {timestamp, requisition_number} - {None})
+        _cache.set(key, (parts, uuids, timestamp, requisition_number), ttl=PREVIEW_TTL)
+    return bundle_json
+
+
+def cached_preview(key: str) -> Optional[str]:
+    """
+    The cached preview for key with fresh uuids, timestamp and requisition
+    number substituted, or None on a miss.
+    """
+    cached = _cache.get(key)
+    if cached is None:
+        return None
+    parts, uuids, timestamp, requisition_number = cached
+    replacements = {old: str(uuid.uuid4()) for old in uuids}
+    if timestamp:
+        replacements[timestamp] = get_localtime_bne()
+    if requisition_number:
+        replacements[requisition_number] = new_requisition_number()
+    parts = parts[:]
+    for index in range(1, len(parts), 2):
+        parts[index] = replacements[parts[index]]
+    return ''.join(parts)
+
+
+def clear_cache():
+    """Drop all cached previews."""
+    _cache.clear()
@@ -0,0 +1,169 @@
+"""
+Bundle Reader Module
+
+Reads posted FHIR bundles with bounded memory. The body is read from the
+request stream into memory, up to BUNDLE_MAX_BYTES (a larger Content-Length
+is refused before anything is read); the raw bytes and their decoded text
+are both held while the bundle is decoded. Decoding then goes one entry at a
+time: each entry of Bundle.entry is decoded on its own and only the entry
+fields the caller asks for are kept, so the parsed tree never holds more
+than the pieces actually used. Narratives (Resource.text, usually the bulk
+of a server-generated bundle) can be dropped the same way. Decoding stops as
+soon as a bundle has more than BUNDLE_MAX_ENTRIES entries.
+
+Decoding is strict: NaN, Infinity, numbers too large for a float and
+duplicate object keys are rejected, so the decoded bundle is exactly what
+the posted bytes say and the bytes can be forwarded as they are.
+
+Configuration (environment variables):
+    BUNDLE_MAX_BYTES     largest bundle body accepted, in bytes (default: 52428800)
+    BUNDLE_MAX_ENTRIES   most entries accepted in one bundle (default: 50000)
+"""
+
+import os
+import json
+import math
+from json.decoder import WHITESPACE
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+MAX_BODY_BYTES = int(os.environ.get('BUNDLE_MAX_BYTES', 50 * 1024 * 1024))
+MAX_ENTRIES = int(os.environ.get('BUNDLE_MAX_ENTRIES', 50000))
+READ_CHUNK_SIZE = 64 * 1024
+
+
+
+def _unique_keys(pairs: List[Tuple[str, object]]) -> Dict:
+    obj = dict(pairs)
+    if len(obj) != len(pairs):
+        seen = set()
+        duplicate = next(key for key, _ in pairs if key in seen or seen.add(key))
+        raise ValueError(f"duplicate key {duplicate!r}")
+    return obj
+
+
+def _reject_constant(name: str):
+    raise ValueError(f"{name} is not allowed")
+
+
+def _finite_float(text: str) -> float:
+    value = float(text)
+    if math.isinf(value):
+        raise ValueError(f"number {text} is out of range")
+    return value
+
+
+_decoder = json.JSONDecoder(object_pairs_hook=_unique_keys, parse_constant=_reject_constant,
+                            parse_float=_finite_float)
+
+
+class BundleTooLarge(ValueError):
+    """Raised when a bundle body or its entry count is over the configured limit (HTTP 413)."""
+
+
+def read_body(stream: BinaryIO, content_length: Optional[int] = None,
+              max_bytes: Optional[int] = None) -> bytes:
+    """
+    Read a request body of at most max_bytes (default BUNDLE_MAX_BYTES).
+    Raises BundleTooLarge without reading if the declared Content-Length is
+    over the limit, or as soon as more than max_bytes arrive.
+    """
+    max_bytes = MAX_BODY_BYTES if max_bytes is None else max_bytes
+    if content_length is not None and content_length > max_bytes:
+        raise BundleTooLarge(f"Bundle is {content_length} bytes (limit {max_bytes})")
+    chunks = []
+    size = 0
+    while True:
+        chunk = stream.read(min(READ_CHUNK_SIZE, max_bytes + 1 - size))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_bytes:
+            raise BundleTooLarge(f"Bundle is larger than {max_bytes} bytes")
+    return b''.join(chunks)
+
+
+def _skip(text: str, index: int) -> int:
+    return WHITESPACE.match(text, index).end()
+
+
+def _expect(text: str, index: int, char: str) -> int:
+    if text[index:index + 1] != char:
+        raise ValueError("Invalid JSON")
+    return index + 1
+
+
+def _decode(text: str, index: int):
+    try:
+        return _decoder.raw_decode(text, index)
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+
+
+def _decode_entries(text: str, index: int, fields: Optional[frozenset], without_narrative: bool,
+                    max_entries: int) -> Tuple[List, int]:
+    """The entry array starting at index, decoded one entry at a time, and the index after it."""
+    entries = []
+    index = _skip(text, _expect(text, index, '['))
+    if text[index:index + 1] == ']':
+        return entries, index + 1
+    while True:
+        if len(entries) >= max_entries:
+            raise BundleTooLarge(f"Bundle has more than {max_entries} entries")
+        entry, index = _decode(text, index)
+        if without_narrative and isinstance(entry, dict) and isinstance(entry.get('resource'), dict):
+            entry['resource'].pop('text', None)
+        if fields is None:
+            entries.append(entry)
+        elif isinstance(entry, dict):
+            entries.append({key: value for key, value in entry.items() if key in fields})
+        index = _skip(text, index)
+        if text[index:index + 1] == ']':
+            return entries, index + 1
+        index = _skip(text, _expect(text, index, ','))
+
+
+def load_bundle(body: bytes, fields: Optional[Iterable[str]] = None, without_narrative: bool = False,
+                max_entries: Optional[int] = None) -> Dict:
+    """
+    Decode a bundle body entry by entry. With fields (e.g. ('fullUrl',
+    'resource')), entries keep only those members and non-object entries are
+    dropped; without_narrative drops each entry resource's text. Raises
+    ValueError if the body is not a strict JSON object and BundleTooLarge if
+    it has more than max_entries (default BUNDLE_MAX_ENTRIES) entries.
+    """
+    max_entries = MAX_ENTRIES if max_entries is None else max_entries
+    fields = None if fields is None else frozenset(fields)
+    try:
+        text = body.decode('utf-8-sig') if isinstance(body, bytes) else body
+    except UnicodeDecodeError:
+        raise ValueError("Invalid JSON")
+
+    index = _skip(text, 0)
+    if text[index:index + 1] != '{':
+        _decode(text, index)
+        raise ValueError("JSON is not a FHIR Bundle")
+    bundle = {}
+    index = _skip(text, index + 1)
+    if text[index:index + 1] == '}':
+        index += 1
+    else:
+        while True:
+            if text[index:index + 1] != '"':
+                raise ValueError("Invalid JSON")
+            key, index = _decode(text, index)
+            if key in bundle:
+                raise ValueError(f"Invalid JSON: duplicate key {key!r}")
+            index = _skip(text, _expect(text, _skip(text, index), ':'))
+            if key == 'entry' and text[index:index + 1] == '[':
+                bundle[key], index = _decode_entries(text, index, fields, without_narrative, max_entries)
+            else:
+                bundle[key], index = _decode(text, index)
+            index = _skip(text, index)
+            if text[index:index + 1] == '}':
+                index += 1
+                break
+            index = _skip(text, _expect(text, index, ','))
+    if _skip(text, index) != len(text):
+        raise ValueError("Invalid JSON")
+    return bundle
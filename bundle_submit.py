@@ -0,0 +1,353 @@
+"""
+Bundle Submit Module
+
+Uploads transaction/batch Bundles to the connected FHIR server. One pooled
+HTTP session is shared by every upload, and uploads can run as background
+jobs on a bounded worker pool so a slow filler server does not tie up a web
+worker for the whole server-side commit.
+
+Before upload a bundle is minified, identical repeated PUT entries are
+dropped, and narratives / meta.lastUpdated can optionally be stripped. When
+none of that changes the bundle, the posted bytes are sent as they came
+(only whitespace between tokens removed) instead of being re-serialised. The
+body is gzip-compressed when the server advertises support for compressed
+request bodies (an Accept-Encoding response header, RFC 7694), which is
+checked once per server; a 415 answer turns compression off for that server.
+
+Configuration (environment variables):
+    BUNDLE_SUBMIT_WORKERS              concurrent background uploads
+    BUNDLE_SUBMIT_MAX_PENDING          queued + running jobs accepted before refusing new ones
+    BUNDLE_SUBMIT_TIMEOUT              timeout in seconds for background uploads
+    BUNDLE_SUBMIT_JOB_TTL              how long finished jobs can be polled, in seconds
+    BUNDLE_SUBMIT_GZIP                 'auto' (default, when advertised), 'true' (always) or 'false'
+    BUNDLE_SUBMIT_STRIP_NARRATIVE      default for stripping Resource.text before upload
+    BUNDLE_SUBMIT_STRIP_LAST_UPDATED   default for stripping meta.lastUpdated before upload
+"""
+
+import os
+import re
+import gzip
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from fhirutils import TTLCache
+
+# Timeout for uploads made inside the web request
+SYNC_TIMEOUT = 30
+
+GZIP_MODES = ('auto', 'true', 'false')
+
+# A JSON string, or whitespace between tokens
+_JSON_STRING_OR_SPACE = re.compile(rb'("[^"\\]*(?:\\.[^"\\]*)*")|[ \t\n\r]+')
+
+
+class SubmitQueueFull(Exception):
+    """Raised when the background upload queue is at BUNDLE_SUBMIT_MAX_PENDING."""
+
+
+def describe_response(resp: requests.Response, upload: Optional[Dict] = None) -> Dict:
+    """Summarise a FHIR server response (and the upload statistics) as returned to the browser."""
+    try:
+        resp_json = resp.json()
+    except Exception:
+        resp_json = {'raw': resp.text[:2000]}
+
+    success = 200 <= resp.status_code < 300
+    result = {
+        'success': success,
+        'http_status': resp.status_code,
+        'response': resp_json
+    }
+    if upload is not None:
+        result['upload'] = upload
+    if not success:
+        result['error'] = f"FHIR server returned HTTP {resp.status_code}"
+    return result
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, 'false').lower() == 'true'
+
+
+def _replace_references(value, replaced: Dict[str, str]):
+    """Return value with references to replaced fullUrls redirected, copying only what changes."""
+    if isinstance(value, dict):
+        changed = {}
+        for key, item in value.items():
+            if key == 'reference' and isinstance(item, str) and item in replaced:
+                changed[key] = replaced[item]
+            elif isinstance(item, (dict, list)):
+                new_item = _replace_references(item, replaced)
+                if new_item is not item:
+                    changed[key] = new_item
+        return dict(value, **changed) if changed else value
+    if isinstance(value, list):
+        items = [_replace_references(item, replaced) for item in value]
+        return items if any(new is not old for new, old in zip(items, value)) else value
+    return value
+
+
+def minify_json(body: bytes) -> bytes:
+    """Remove the whitespace between the tokens of a JSON document, leaving strings untouched."""
+    return _JSON_STRING_OR_SPACE.sub(rb'\1', body.removeprefix(b'\xef\xbb\xbf'))
+
+
+def prepare_upload(bundle: Dict, strip_narrative: bool = False,
+                   strip_last_updated: bool = False) -> Tuple[Dict, Dict]:
+    """
+    Return the Bundle to upload and what was removed from it.
+
+    The input is never modified: entries and resources that change are
+    copied. A PUT entry whose url and resource repeat an earlier entry is
+    dropped and references to its fullUrl point at the kept entry instead.
+    """
+    entries = []
+    puts = {}
+    replaced = {}
+    stats = {'removed_entries': 0, 'stripped_narratives': 0, 'stripped_last_updated': 0}
+    for entry in bundle.get('entry', []):
+        resource = entry.get('resource')
+        if isinstance(resource, dict):
+            meta = resource.get('meta')
+            strip_text = strip_narrative and 'text' in resource
+            strip_meta = strip_last_updated and isinstance(meta, dict) and 'lastUpdated' in meta
+            if strip_text or strip_meta:
+                resource = dict(resource)
+                if strip_text:
+                    del resource['text']
+                    stats['stripped_narratives'] += 1
+                if strip_meta:
+                    meta = {key: value for key, value in meta.items() if key != 'lastUpdated'}
+                    if meta:
+                        resource['meta'] = meta
+                    else:
+                        del resource['meta']
+                    stats['stripped_last_updated'] += 1
+                entry = dict(entry, resource=resource)
+
+            request_info = entry.get('request') or {}
+            if request_info.get('method') == 'PUT':
+                kept = puts.get(request_info.get('url'))
+                if kept is not None and kept[1] == resource:
+                    if entry.get('fullUrl') and kept[0]:
+                        replaced[entry['fullUrl']] = kept[0]
+                    stats['removed_entries'] += 1
+                    continue
+                puts.setdefault(request_info.get('url'), (entry.get('fullUrl'), resource))
+        entries.append(entry)
+
+    if replaced:
+        entries = [_replace_references(entry, replaced) for entry in entries]
+    prepared = dict(bundle)
+    if 'entry' in bundle:
+        prepared['entry'] = entries
+    return prepared, stats
+
+
+class BundleSubmitter:
+    """Pooled uploader with an in-memory store of background submission jobs."""
+
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None,
+                 timeout: Optional[float] = None, job_ttl: Optional[int] = None,
+                 compress: Optional[str] = None):
+        self.workers = workers or int(os.environ.get('BUNDLE_SUBMIT_WORKERS', 4))
+        self.max_pending = max_pending or int(os.environ.get('BUNDLE_SUBMIT_MAX_PENDING', 50))
+        self.timeout = timeout or float(os.environ.get('BUNDLE_SUBMIT_TIMEOUT', 300))
+        self.compress = (compress or os.environ.get('BUNDLE_SUBMIT_GZIP', 'auto')).lower()
+        if self.compress not in GZIP_MODES:
+            raise ValueError(f"BUNDLE_SUBMIT_GZIP must be one of {', '.join(GZIP_MODES)}")
+        self.strip_narrative = _env_flag('BUNDLE_SUBMIT_STRIP_NARRATIVE')
+        self.strip_last_updated = _env_flag('BUNDLE_SUBMIT_STRIP_LAST_UPDATED')
+        # Whether each server accepts gzip request bodies
+        self.gzip_support = TTLCache(maxsize=256, ttl=86400)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers * 2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bundle-submit')
+        self.jobs = TTLCache(maxsize=1000, ttl=job_ttl or int(os.environ.get('BUNDLE_SUBMIT_JOB_TTL', 3600)))
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def accepts_gzip(self, server_url: str, auth=None, bearer: Optional[str] = None) -> bool:
+        """
+        Whether to gzip request bodies for this server. In 'auto' mode the
+        server's CapabilityStatement response is checked once for an
+        Accept-Encoding header listing gzip, and the answer is cached (and
+        refreshed from the Accept-Encoding of later upload responses).
+        """
+        if self.compress == 'false':
+            return False
+        supported = self.gzip_support.get(server_url)
+        if self.compress == 'true':
+            # Always compress unless the server has refused it with a 415
+            return supported is not False
+        if supported is None:
+            headers = {'Accept': 'application/fhir+json'}
+            kwargs = {}
+            if bearer:
+                headers['Authorization'] = f'Bearer {bearer}'
+            elif auth:
+                kwargs['auth'] = auth
+            try:
+                resp = self.session.get(f"{server_url}/metadata", params={'_summary': 'true'},
+                                        headers=headers, timeout=10, **kwargs)
+                supported = self._learn_gzip_support(server_url, resp)
+            except Exception as e:
+                logging.warning(f"Could not check gzip support of {server_url}: {e}")
+            if supported is None:
+                # Not advertised (or not reachable): check again in a few minutes
+                supported = False
+                self.gzip_support.set(server_url, supported, ttl=300)
+        return supported
+
+    def _learn_gzip_support(self, server_url: str, resp: requests.Response) -> Optional[bool]:
+        advertised = resp.headers.get('Accept-Encoding')
+        if advertised is None:
+            return None
+        supported = 'gzip' in advertised.lower()
+        self.gzip_support.set(server_url, supported)
+        return supported
+
+    def post(self, bundle: Dict, server_url: str, auth=None, bearer: Optional[str] = None,
+             timeout: Optional[float] = None, strip_narrative: Optional[bool] = None,
+             strip_last_updated: Optional[bool] = None, raw: Optional[bytes] = None) -> Tuple[requests.Response, Dict]:
+        """
+        Prepare and POST a Bundle to the server base URL. raw is the JSON the
+        bundle was decoded from; it is sent (minified) when preparing the
+        upload changes nothing.
+        Returns the response and upload statistics (bytes before and after, entries removed).
+        """
+        prepared, upload = prepare_upload(
+            bundle,
+            strip_narrative=self.strip_narrative if strip_narrative is None else strip_narrative,
+            strip_last_updated=self.strip_last_updated if strip_last_updated is None else strip_last_updated)
+        if raw is not None and not any(upload.values()):
+            body = minify_json(raw)
+            upload['original_bytes'] = len(raw)
+        else:
+            body = json.dumps(prepared, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+            upload['original_bytes'] = len(json.dumps(bundle).encode('utf-8'))
+        headers = {
+            'Content-Type': 'application/fhir+json',
+            'Accept': 'application/fhir+json'
+        }
+        kwargs = {'timeout': timeout or SYNC_TIMEOUT}
+        if bearer:
+            headers['Authorization'] = f'Bearer {bearer}'
+        elif auth:
+            kwargs['auth'] = auth
+
+        upload['minified_bytes'] = len(body)
+        upload['compressed'] = False
+        resp = None
+        if self.accepts_gzip(server_url, auth=auth, bearer=bearer):
+            data = gzip.compress(body, compresslevel=6)
+            logging.info("Submitting Bundle (%s, %d bytes gzipped from %d) to %s",
+                         bundle.get('type', 'unknown'), len(data), len(body), server_url)
+            resp = self.session.post(server_url, data=data,
+                                     headers=dict(headers, **{'Content-Encoding': 'gzip'}), **kwargs)
+            if resp.status_code == 415:
+                logging.info("%s does not accept gzip request bodies; resending uncompressed", server_url)
+                self.gzip_support.set(server_url, False)
+                resp = None
+            else:
+                upload['compressed'] = True
+                upload['sent_bytes'] = len(data)
+        if resp is None:
+            logging.info("Submitting Bundle (%s, %d bytes) to %s", bundle.get('type', 'unknown'), len(body), server_url)
+            resp = self.session.post(server_url, data=body, headers=headers, **kwargs)
+            upload['sent_bytes'] = len(body)
+        if self.compress == 'auto':
+            self._learn_gzip_support(server_url, resp)
+
+        upload['saved_bytes'] = upload['original_bytes'] - upload['sent_bytes']
+        logging.info("Bundle upload to %s: %s", server_url, upload)
+        return resp, upload
+
+    def submit(self, bundle: Dict, server_url: str, auth=None, bearer: Optional[str] = None,
+               **options) -> Dict:
+        """
+        Queue a Bundle for upload and return its job record immediately.
+        Keyword options (strip_narrative, strip_last_updated, raw) are passed to post().
+        Raises SubmitQueueFull if too many uploads are already queued or running.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise SubmitQueueFull(f"{self._pending} bundle uploads already in progress")
+            self._pending += 1
+
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'status': 'queued',
+            'server_url': server_url,
+            'bundle_type': bundle.get('type', 'unknown'),
+            'entries': len(bundle.get('entry', [])),
+            'submitted': time.time(),
+        }
+        self.jobs.set(job['job_id'], job)
+        try:
+            self.executor.submit(self._run, job, bundle, server_url, auth, bearer, options)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return dict(job)
+
+    def job(self, job_id: str) -> Optional[Dict]:
+        """Return a snapshot of a job record, or None if it is unknown or has expired."""
+        job = self.jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    def _run(self, job: Dict, bundle: Dict, server_url: str, auth, bearer, options: Dict):
+        started = time.time()
+        self._update(job, status='running', started=started)
+        try:
+            resp, upload = self.post(bundle, server_url, auth=auth, bearer=bearer, timeout=self.timeout, **options)
+            result = describe_response(resp, upload)
+            self._update(job, status='completed' if result['success'] else 'failed', **result)
+        except Exception as e:
+            logging.error(f"Bundle submit job {job['job_id']} failed: {e}")
+            self._update(job, status='failed', success=False, error=str(e))
+        finally:
+            finished = time.time()
+            self._update(job, finished=finished, duration=round(finished - started, 3))
+            with self._lock:
+                self._pending -= 1
+
+    def _update(self, job: Dict, **fields):
+        # Replace rather than mutate so readers always see a consistent record
+        job = dict(self.jobs.get(job['job_id']) or job, **fields)
+        self.jobs.set(job['job_id'], job)
+
+
+_submitter: Optional[BundleSubmitter] = None
+_submitter_lock = threading.Lock()
+
+
+def get_bundle_submitter() -> BundleSubmitter:
+    """Return the process-wide BundleSubmitter, creating it on first use."""
+    global _submitter
+    if _submitter is None:
+        with _submitter_lock:
+            if _submitter is None:
+                _submitter = BundleSubmitter()
+    return _submitter
+
+
+def configure_bundle_submitter(**kwargs) -> BundleSubmitter:
+    """Replace the process-wide BundleSubmitter (e.g. with different pool settings)."""
+    global _submitter
+    with _submitter_lock:
+        _submitter = BundleSubmitter(**kwargs)
+    return _submitter
@@ -0,0 +1,178 @@
+"""
+Bundle Validation Module
+
+Opt-in offline structural validation of generated bundles against the
+fhirclient (FHIR R4) models, without a round-trip to a validator service.
+Every element of every resource is checked for:
+
+    - elements the model does not define
+    - JSON type (string, number, boolean, object) and date/time format
+    - cardinality: a list where the model expects one value, and vice versa
+    - mandatory elements that are missing
+
+Terminology bindings, profiles and invariants are not checked; use a
+validator service for those.
+
+The model class of each resourceType and the element table of each model
+class (see fhir_models) are built once and cached, so validating a resource walks only the
+elements it actually has instead of instantiating the model and every
+element the model declares.
+
+Configuration (environment variables):
+    BUNDLE_VALIDATE   validate bundles before they are submitted (default: false)
+"""
+
+import os
+import time
+from typing import Dict, List, Optional
+
+from fhirclient.models.fhirabstractbase import FHIRAbstractBase
+from fhirclient.models.fhirabstractresource import FHIRAbstractResource
+from fhirclient.models.fhirdate import FHIRDate
+from fhirclient.models.bundle import Bundle, BundleEntry
+
+from fhir_models import element_table, model_class
+
+
+def validate_by_default() -> bool:
+    return os.environ.get('BUNDLE_VALIDATE', 'false').lower() == 'true'
+
+
+def _issue(code: str, diagnostics: str, expression: str) -> Dict:
+    return {
+        "severity": "error",
+        "code": code,
+        "diagnostics": diagnostics,
+        "expression": [expression]
+    }
+
+
+def _json_type(value) -> str:
+    return {dict: 'object', list: 'array', str: 'string', bool: 'boolean'}.get(
+        type(value), 'number' if isinstance(value, (int, float)) else type(value).__name__)
+
+
+def _check_value(value, typ, path, issues):
+    if isinstance(typ, type) and issubclass(typ, FHIRAbstractBase):
+        if not isinstance(value, dict):
+            issues.append(_issue('structure', f"Expected an object, got {_json_type(value)}", path))
+        elif issubclass(typ, FHIRAbstractResource):
+            # Resource-typed elements (contained, entry.resource) are resolved by resourceType
+            cls = model_class(value.get('resourceType'))
+            if cls is None or not issubclass(cls, typ):
+                issues.append(_issue('structure', f"Unknown resourceType {value.get('resourceType')!r}", path))
+            else:
+                _check_element(value, cls, path, issues)
+        else:
+            _check_element(value, typ, path, issues)
+    elif isinstance(typ, type) and issubclass(typ, FHIRDate):
+        if not isinstance(value, str):
+            issues.append(_issue('structure', f"Expected a string, got {_json_type(value)}", path))
+        else:
+            try:
+                typ(value)
+            except (TypeError, ValueError):
+                issues.append(_issue('value', f"{value!r} is not a valid {typ.__name__[4:].lower()}", path))
+    elif typ is bool:
+        if not isinstance(value, bool):
+            issues.append(_issue('structure', f"Expected a boolean, got {_json_type(value)}", path))
+    elif typ in (int, float):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            issues.append(_issue('structure', f"Expected a number, got {_json_type(value)}", path))
+    elif not isinstance(value, typ):
+        expected = 'a string' if typ is str else typ.__name__
+        issues.append(_issue('structure', f"Expected {expected}, got {_json_type(value)}", path))
+
+
+def _check_element(data: Dict, cls, path: str, issues: List[Dict], skip=()):
+    elements, required = element_table(cls)
+    present = set()
+    for key, value in data.items():
+        if key == 'resourceType' or key in skip:
+            continue
+        spec = elements.get(key)
+        if spec is None:
+            # _element carries the id/extensions of a primitive
+            if not (key.startswith('_') and key[1:] in elements):
+                issues.append(_issue('structure', f"Unknown element '{key}' for {cls.__name__}", f"{path}.{key}"))
+            continue
+        typ, is_list, of_many = spec
+        present.add(of_many or key)
+        if is_list:
+            if not isinstance(value, list):
+                issues.append(_issue('structure', f"'{key}' must be an array", f"{path}.{key}"))
+                continue
+            for index, item in enumerate(value):
+                _check_value(item, typ, f"{path}.{key}[{index}]", issues)
+        elif isinstance(value, list):
+            issues.append(_issue('structure', f"'{key}' has a maximum cardinality of 1", f"{path}.{key}"))
+        else:
+            _check_value(value, typ, f"{path}.{key}", issues)
+    for name in sorted(required - present - set(skip)):
+        issues.append(_issue('required', f"Missing mandatory element '{name}' for {cls.__name__}", f"{path}.{name}"))
+
+
+def validate_resource(resource: Dict, path: Optional[str] = None) -> List[Dict]:
+    """Validate one resource. Returns OperationOutcome issues, empty when it is valid."""
+    resource_type = resource.get('resourceType') if isinstance(resource, dict) else None
+    path = path or resource_type or 'Resource'
+    cls = model_class(resource_type)
+    if cls is None:
+        return [_issue('structure', f"Unknown resourceType {resource_type!r}", path)]
+    issues = []
+    _check_element(resource, cls, path, issues)
+    return issues
+
+
+def validate_bundle(bundle: Dict, timings: Optional[Dict] = None) -> List[Dict]:
+    """
+    Validate a Bundle and every entry resource. Returns OperationOutcome
+    issues, empty when the bundle is valid. When a timings dict is given,
+    the count and seconds spent per resourceType are added to it as
+    {resourceType: [count, seconds]}.
+    """
+    issues = []
+    _check_element(bundle, Bundle, 'Bundle', issues, skip=('entry',))
+    entries = bundle.get('entry')
+    if entries is None:
+        return issues
+    if not isinstance(entries, list):
+        return issues + [_issue('structure', "'entry' must be an array", 'Bundle.entry')]
+    for index, entry in enumerate(entries):
+        path = f"Bundle.entry[{index}]"
+        if not isinstance(entry, dict):
+            issues.append(_issue('structure', f"Expected an object, got {_json_type(entry)}", path))
+            continue
+        _check_element(entry, BundleEntry, path, issues, skip=('resource',))
+        resource = entry.get('resource')
+        if resource is None:
+            continue
+        started = time.perf_counter()
+        issues.extend(validate_resource(resource, f"{path}.resource"))
+        if timings is not None:
+            resource_type = resource.get('resourceType') if isinstance(resource, dict) else None
+            counted = timings.setdefault(resource_type if isinstance(resource_type, str) else 'Unknown', [0, 0.0])
+            counted[0] += 1
+            counted[1] += time.perf_counter() - started
+    return issues
+
+
+def merge_timings(into: Dict, timings: Dict) -> Dict:
+    """Add one timings dict (as filled by validate_bundle) into another."""
+    for resource_type, (count, seconds) in timings.items():
+        counted = into.setdefault(resource_type, [0, 0.0])
+        counted[0] += count
+        counted[1] += seconds
+    return into
+
+
+def timing_report(timings: Dict) -> Dict:
+    """Per-resourceType validation cost: {resourceType: {"count", "totalMs", "meanMicros"}}."""
+    return {
+        resource_type: {
+            "count": count,
+            "totalMs": round(seconds * 1000, 3),
+            "meanMicros": round(seconds * 1e6 / count, 1) if count else None,
+        }
+        for resource_type, (count, seconds) in sorted(timings.items())
+    }
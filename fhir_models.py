@@ -0,0 +1,47 @@
+"""
+FHIR Models Module
+
+Introspection of the fhirclient (FHIR R4) model classes, shared by bundle
+validation and the diagram graph builder: the model class of a resourceType
+and the element table of a model class. Both are built once and cached.
+"""
+
+import re
+import importlib
+from functools import lru_cache
+
+from fhirclient.models.fhirabstractresource import FHIRAbstractResource
+
+_RESOURCE_TYPE = re.compile(r'^[A-Z][A-Za-z]+$')
+
+
+def model_class(resource_type):
+    """The fhirclient model class for a resourceType, or None if there is none."""
+    if not isinstance(resource_type, str) or not _RESOURCE_TYPE.match(resource_type):
+        return None
+    return _model_class(resource_type)
+
+
+@lru_cache(maxsize=None)
+def _model_class(resource_type: str):
+    try:
+        module = importlib.import_module(f"fhirclient.models.{resource_type.lower()}")
+    except ImportError:
+        return None
+    cls = getattr(module, resource_type, None)
+    return cls if isinstance(cls, type) and issubclass(cls, FHIRAbstractResource) else None
+
+
+@lru_cache(maxsize=None)
+def element_table(cls):
+    """
+    Element metadata of a model class: {json name: (type, is_list, choice
+    group)} and the set of mandatory elements (choice groups by group name).
+    """
+    elements = {}
+    required = set()
+    for _, json_name, typ, is_list, of_many, not_optional in cls().elementProperties():
+        elements[json_name] = (typ, is_list, of_many)
+        if not_optional:
+            required.add(of_many or json_name)
+    return elements, frozenset(required)
@@ -1,8 +1,11 @@
 import os
+import time
+import threading
 import requests
+from collections import OrderedDict
 from datetime import datetime
 from dotenv import load_dotenv
-from typing import Optional, Tuple, Union
+from typing import Any, Hashable, Optional, Tuple, Union
 
 # Internal sentinel: distinguishes "caller didn't pass auth" (use env fallback)
 # from "caller explicitly passed None" (force unauthenticated request).
@@ -119,4 +122,59 @@ def get_form_data(request):
         values = request.form.getlist(key)
         form_data[key] = values if len(values) > 1 else values[0]
     
-    return form_data
\ No newline at end of file
+    return form_data
+
+class TTLCache:
+    """
+    Small thread-safe LRU cache whose entries expire after `ttl` seconds.
+    Used for terminology expansions, rendered fragments and other
+    short-lived lookups that are shared between requests.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return self.get(key, _UNSET) is not _UNSET
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def items(self):
+        """Return a list of the live (key, value) pairs, oldest first."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (expires, value) in self._data.items() if expires >= now]
+
+    def update(self, pairs, ttl=None):
+        """Store every (key, value) pair, e.g. from another cache's items()."""
+        for key, value in pairs:
+            self.set(key, value, ttl)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -5,33 +5,197 @@ Constructs a directed graph from FHIR resources showing relationships between th
 Adapted from fhir-bundle-viz for use in Patient Dashboard.
 """
 
-from typing import Dict, List, Any, Set, Tuple, Optional
+import threading
+from array import array
+from collections.abc import Mapping, Sequence, Set as AbstractSet
+from functools import lru_cache
+from typing import Dict, Iterator, List, Any, Tuple, Optional
+from fhirclient.models.reference import Reference
+from fhirclient.models.identifier import Identifier
+from fhirclient.models.extension import Extension
+from fhirclient.models.fhirabstractbase import FHIRAbstractBase
+from fhirclient.models.fhirabstractresource import FHIRAbstractResource
+from fhir_models import element_table, model_class
 from fhir_parser import get_resource_type_display, get_resource_id, is_task_group, get_task_group_label
 
 
+# Node flag bits (Graph.flags)
+EXTERNAL = 1
+GROUP_TASK = 2
+CLUSTER = 4
+
+
 class Graph:
-    """Represents a directed graph of FHIR resources."""
+    """
+    Represents a directed graph of FHIR resources.
+    
+    Node IDs are interned to ints in the order they are added. Per node, the
+    label, resource type and flag bits (EXTERNAL, GROUP_TASK, CLUSTER) are
+    kept in parallel lists indexed by that int; edges are three array('I')
+    columns (source, target, interned edge label). Exporters work on these
+    directly. nodes, edges, external_refs, group_tasks, node_profiles and
+    node_types are read-only dict/list/set views for everything else.
+    """
     
     def __init__(self):
-        self.nodes: Dict[str, str] = {}  # node_id -> display_label
-        self.edges: List[Tuple[str, str, str]] = []  # (source_id, target_id, edge_label)
-        self.external_refs: Set[str] = set()  # Set of node IDs that are external references
-        self.group_tasks: Set[str] = set()  # Set of node IDs that are group Tasks
-        self.node_profiles: Dict[str, List[str]] = {}  # node_id -> list of profile URLs
-    
-    def add_node(self, node_id: str, label: str, is_external: bool = False, is_group_task: bool = False, profiles: Optional[List[str]] = None):
-        """Add a node to the graph."""
-        self.nodes[node_id] = label
+        self.ids: List[str] = []  # node index -> node_id
+        self.index: Dict[str, int] = {}  # node_id -> node index
+        self.labels: List[str] = []  # node index -> display_label
+        self.types: List[Optional[str]] = []  # node index -> resource type
+        self.flags = bytearray()  # node index -> EXTERNAL | GROUP_TASK | CLUSTER
+        self.profiles: Dict[int, List[str]] = {}  # node index -> list of profile URLs
+        self.edge_sources = array('I')
+        self.edge_targets = array('I')
+        self.edge_label_ids = array('I')  # edge -> index into edge_label_names
+        self.edge_label_names: List[str] = []
+        self._edge_label_index: Dict[str, int] = {}
+        self.clusters: Dict[str, List[str]] = {}  # collapsed node_id -> member node IDs
+        self.subgraphs: Dict[str, List[str]] = {}  # group node_id -> node IDs drawn with it
+    
+    def add_node(self, node_id: str, label: str, is_external: bool = False, is_group_task: bool = False,
+                 profiles: Optional[List[str]] = None, resource_type: Optional[str] = None) -> int:
+        """Add a node to the graph (or update it); returns its index."""
+        flags = (EXTERNAL if is_external else 0) | (GROUP_TASK if is_group_task else 0)
+        index = self.index.get(node_id)
+        if index is None:
+            index = len(self.ids)
+            self.index[node_id] = index
+            self.ids.append(node_id)
+            self.labels.append(label)
+            self.types.append(resource_type)
+            self.flags.append(flags)
+        else:
+            self.labels[index] = label
+            self.flags[index] |= flags
+            if resource_type:
+                self.types[index] = resource_type
         if profiles:
-            self.node_profiles[node_id] = profiles
-        if is_external:
-            self.external_refs.add(node_id)
-        if is_group_task:
-            self.group_tasks.add(node_id)
+            self.profiles[index] = profiles
+        return index
+    
+    def add_cluster(self, node_id: str, label: str, members: List[str], is_external: bool = False,
+                    resource_type: Optional[str] = None) -> int:
+        """Add a node standing for several collapsed nodes."""
+        index = self.add_node(node_id, label, is_external=is_external, resource_type=resource_type)
+        self.flags[index] |= CLUSTER
+        self.clusters[node_id] = members
+        return index
     
     def add_edge(self, source_id: str, target_id: str, label: str):
-        """Add a directed edge from source to target."""
-        self.edges.append((source_id, target_id, label))
+        """Add a directed edge from source to target (both must be nodes)."""
+        self.add_edge_at(self.index[source_id], self.index[target_id], self.edge_label_id(label))
+    
+    def add_edge_at(self, source: int, target: int, label_id: int):
+        """Add an edge by node indexes and interned label."""
+        self.edge_sources.append(source)
+        self.edge_targets.append(target)
+        self.edge_label_ids.append(label_id)
+    
+    def edge_label_id(self, label: str) -> int:
+        """Intern an edge label."""
+        label_id = self._edge_label_index.get(label)
+        if label_id is None:
+            label_id = self._edge_label_index[label] = len(self.edge_label_names)
+            self.edge_label_names.append(label)
+        return label_id
+    
+    def iter_edges(self) -> Iterator[Tuple[int, int, int]]:
+        """Edges as (source index, target index, label id)."""
+        return zip(self.edge_sources, self.edge_targets, self.edge_label_ids)
+    
+    @property
+    def nodes(self) -> Mapping[str, str]:
+        """node_id -> display_label"""
+        return _NodesView(self)
+    
+    @property
+    def edges(self) -> Sequence[Tuple[str, str, str]]:
+        """(source_id, target_id, edge_label)"""
+        return _EdgesView(self)
+    
+    @property
+    def external_refs(self) -> AbstractSet[str]:
+        """Node IDs that are external references"""
+        return _FlagView(self, EXTERNAL)
+    
+    @property
+    def group_tasks(self) -> AbstractSet[str]:
+        """Node IDs that are group Tasks"""
+        return _FlagView(self, GROUP_TASK)
+    
+    @property
+    def node_profiles(self) -> Mapping[str, List[str]]:
+        """node_id -> list of profile URLs"""
+        return {self.ids[index]: profiles for index, profiles in self.profiles.items()}
+    
+    @property
+    def node_types(self) -> Mapping[str, str]:
+        """node_id -> resource type"""
+        return {node_id: node_type for node_id, node_type in zip(self.ids, self.types) if node_type}
+
+
+class _NodesView(Mapping):
+    def __init__(self, graph: Graph):
+        self._graph = graph
+    
+    def __getitem__(self, node_id: str) -> str:
+        return self._graph.labels[self._graph.index[node_id]]
+    
+    def __contains__(self, node_id) -> bool:
+        return node_id in self._graph.index
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._graph.ids)
+    
+    def __len__(self) -> int:
+        return len(self._graph.ids)
+    
+    def items(self):
+        return zip(self._graph.ids, self._graph.labels)
+    
+    def values(self):
+        return iter(self._graph.labels)
+
+
+class _EdgesView(Sequence):
+    def __init__(self, graph: Graph):
+        self._graph = graph
+    
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        graph = self._graph
+        return (graph.ids[graph.edge_sources[position]], graph.ids[graph.edge_targets[position]],
+                graph.edge_label_names[graph.edge_label_ids[position]])
+    
+    def __len__(self) -> int:
+        return len(self._graph.edge_sources)
+    
+    def __iter__(self) -> Iterator[Tuple[str, str, str]]:
+        ids, names = self._graph.ids, self._graph.edge_label_names
+        for source, target, label_id in self._graph.iter_edges():
+            yield ids[source], ids[target], names[label_id]
+    
+    def __eq__(self, other) -> bool:
+        return list(self) == list(other)
+
+
+class _FlagView(AbstractSet):
+    def __init__(self, graph: Graph, flag: int):
+        self._graph = graph
+        self._flag = flag
+    
+    def __contains__(self, node_id) -> bool:
+        index = self._graph.index.get(node_id)
+        return index is not None and bool(self._graph.flags[index] & self._flag)
+    
+    def __iter__(self) -> Iterator[str]:
+        flag = self._flag
+        return (node_id for node_id, flags in zip(self._graph.ids, self._graph.flags) if flags & flag)
+    
+    def __len__(self) -> int:
+        flag = self._flag
+        return sum(1 for flags in self._graph.flags if flags & flag)
 
 
 def build_graph(resources: Dict[str, Dict[str, Any]]) -> Graph:
@@ -42,17 +206,20 @@ def build_graph(resources: Dict[str, Dict[str, Any]]) -> Graph:
     E.g., Patient → Observation (patient owns observation)
     """
     graph = Graph()
+    index = ReferenceIndex(resources)
     
     # First pass: Add all nodes for resources in the bundle
     for resource_id, resource_data in resources.items():
         resource = resource_data['resource']
         profiles = _extract_profiles(resource)
+        resource_type = resource.get('resourceType')
         if is_task_group(resource):
             label = get_task_group_label(resource)
-            graph.add_node(resource_id, label, is_external=False, is_group_task=True, profiles=profiles)
+            graph.add_node(resource_id, label, is_external=False, is_group_task=True, profiles=profiles,
+                           resource_type=resource_type)
         else:
             label = get_resource_type_display(resource)
-            graph.add_node(resource_id, label, is_external=False, profiles=profiles)
+            graph.add_node(resource_id, label, is_external=False, profiles=profiles, resource_type=resource_type)
     
     # Second pass: Extract references and create edges
     for resource_id, resource_data in resources.items():
@@ -61,7 +228,7 @@ def build_graph(resources: Dict[str, Dict[str, Any]]) -> Graph:
         
         for ref_type, ref_ids in references.items():
             for target_id in ref_ids:
-                resolved_id = resolve_reference(target_id, resources)
+                resolved_id = index.resolve(target_id)
                 
                 if resolved_id and resolved_id in resources:
                     # Referenced resource exists in bundle
@@ -69,9 +236,10 @@ def build_graph(resources: Dict[str, Dict[str, Any]]) -> Graph:
                 elif target_id:
                     # Referenced resource is external
                     external_node_id = _create_external_ref_id(target_id)
-                    if external_node_id not in graph.nodes:
+                    if external_node_id not in graph.index:
                         external_label = _create_external_ref_label(target_id)
-                        graph.add_node(external_node_id, external_label, is_external=True)
+                        graph.add_node(external_node_id, external_label, is_external=True,
+                                       resource_type=_external_ref_type(target_id))
                     
                     graph.add_edge(external_node_id, resource_id, ref_type)
     
@@ -79,98 +247,177 @@ def build_graph(resources: Dict[str, Dict[str, Any]]) -> Graph:
 
 
 def extract_references(resource: Dict[str, Any]) -> Dict[str, List[str]]:
-    """Extract all references from a FHIR resource."""
-    references = {}
-    
-    # Common reference fields
-    ref_fields = [
-        'subject', 'encounter', 'specimen', 'performer', 'requester',
-        'recorder', 'asserter', 'participant', 'location',
-        'serviceProvider', 'managingOrganization', 'organization',
-        'basedOn', 'partOf', 'focus', 'context', 'author',
-    ]
-    
-    for field in ref_fields:
-        value = resource.get(field)
-        if value:
-            refs = _extract_reference_value(value, field)
-            if refs:
-                references[field] = refs
-    
-    # Array reference fields
-    array_ref_fields = [
-        'result', 'hasMember', 'derivedFrom', 'reasonReference',
-        'insurance', 'careTeam', 'supportingInfo',
-    ]
-    
-    for field in array_ref_fields:
-        value = resource.get(field)
-        if value and isinstance(value, list):
-            all_refs = []
-            for item in value:
-                refs = _extract_reference_value(item, field)
-                if refs:
-                    all_refs.extend(refs)
-            if all_refs:
-                references[field] = all_refs
+    """
+    Extract all references from a FHIR resource, keyed by element path
+    (e.g. 'subject', 'collection.collector', 'input.valueReference').
     
+    Resource types with a FHIR R4 model are walked along their precompiled
+    reference paths only; anything else falls back to a generic walk.
+    """
+    references: Dict[str, List[str]] = {}
+    paths = reference_paths(resource.get('resourceType'))
+    if paths is None:
+        _walk_any(resource, '', references)
+    else:
+        _walk_paths(resource, paths, '', references)
     return references
 
 
-def _extract_reference_value(value: Any, field_name: str) -> List[str]:
-    """Extract reference ID(s) from a value."""
-    if not value:
-        return []
-    
-    if isinstance(value, dict) and 'reference' in value:
-        ref = value['reference']
-        return [ref] if ref else []
-    
+# Element types not followed when compiling reference paths: identifier
+# assigners and extensions are not relationships worth drawing, and a
+# Reference is a leaf, not something to descend into.
+_NOT_FOLLOWED = (Identifier, Extension, FHIRAbstractResource)
+
+# Classes whose paths are being compiled, to cut recursive elements
+# (e.g. Questionnaire.item.item); only touched under _compile_lock
+_COMPILING = ()
+_compile_lock = threading.Lock()
+_paths_by_type: Dict[Optional[str], Optional[Tuple]] = {}
+
+
+def reference_paths(resource_type: Optional[str]):
+    """
+    The reference paths of a resource type as a tree of
+    (json name, child paths or None for a Reference), compiled once per type
+    from the FHIR R4 element definitions. None if there is no model for the type.
+    """
+    try:
+        return _paths_by_type[resource_type]
+    except (KeyError, TypeError):
+        pass
+    cls = model_class(resource_type)
+    with _compile_lock:
+        paths = _element_reference_paths(cls) if cls is not None else None
+    if isinstance(resource_type, str):
+        _paths_by_type[resource_type] = paths
+    return paths
+
+
+@lru_cache(maxsize=None)
+def _element_reference_paths(cls) -> Tuple:
+    global _COMPILING
+    _COMPILING += (cls,)
+    try:
+        paths = []
+        elements, _ = element_table(cls)
+        for name, (typ, _, _) in elements.items():
+            if not isinstance(typ, type) or not issubclass(typ, FHIRAbstractBase):
+                continue
+            if issubclass(typ, Reference):
+                paths.append((name, None))
+            elif not issubclass(typ, _NOT_FOLLOWED) and typ not in _COMPILING:
+                children = _element_reference_paths(typ)
+                if children:
+                    paths.append((name, children))
+        return tuple(paths)
+    finally:
+        _COMPILING = _COMPILING[:-1]
+
+
+def _walk_paths(value: Dict[str, Any], paths: Tuple, prefix: str, references: Dict[str, List[str]]):
+    """Collect references along compiled paths, visiting only elements that can hold one."""
+    for name, children in paths:
+        item = value.get(name)
+        if not item:
+            continue
+        label = prefix + name
+        for element in (item if isinstance(item, list) else (item,)):
+            if not isinstance(element, dict):
+                continue
+            if children is None:
+                reference = element.get('reference')
+                if reference:
+                    references.setdefault(label, []).append(reference)
+            else:
+                _walk_paths(element, children, label + '.', references)
+
+
+def _walk_any(value: Any, prefix: str, references: Dict[str, List[str]]):
+    """Generic fallback: every Reference.reference anywhere outside contained/extension."""
     if isinstance(value, list):
-        refs = []
         for item in value:
-            if isinstance(item, dict) and 'reference' in item:
-                ref = item['reference']
-                if ref:
-                    refs.append(ref)
-        return refs
-    
-    return []
+            _walk_any(item, prefix, references)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'reference' and isinstance(item, str):
+                if item and prefix:
+                    references.setdefault(prefix[:-1], []).append(item)
+            elif key not in ('contained', 'extension', 'modifierExtension') and isinstance(item, (dict, list)):
+                _walk_any(item, prefix + key + '.', references)
 
 
-def resolve_reference(reference: str, resources: Dict[str, Dict[str, Any]]) -> str:
-    """Resolve a FHIR reference to a resource ID."""
-    if not reference:
-        return ""
+class ReferenceIndex:
+    """
+    Lookup tables for resolving references against the resources of one
+    bundle: by resource key, by fullUrl, by Type/id and by bare id. Built once
+    per bundle, so each reference resolves in O(1) instead of scanning every
+    fullUrl.
+    """
     
-    # Handle urn:uuid: format
-    if reference.startswith('urn:uuid:') or reference.startswith('Observation/urn:uuid:') or reference.startswith('DocumentReference/urn:uuid:') or reference.startswith('ServiceRequest/urn:uuid:') or reference.startswith('Coverage/urn:uuid:') or reference.startswith('Specimen/urn:uuid:') or reference.startswith('Task/urn:uuid:') or reference.startswith('Encounter/urn:uuid:'):
-        # Extract UUID from various formats
-        uuid_part = reference.split('urn:uuid:')[-1]
-        return uuid_part
+    def __init__(self, resources: Dict[str, Dict[str, Any]]):
+        self.resources = resources
+        self.by_full_url: Dict[str, str] = {}
+        self.by_type_id: Dict[str, str] = {}
+        self.by_id: Dict[str, str] = {}
+        # setdefault throughout: the first resource in the bundle wins, as before
+        for key, resource_data in resources.items():
+            resource = resource_data['resource']
+            full_url = resource_data.get('fullUrl', '')
+            if full_url:
+                self.by_full_url.setdefault(full_url, key)
+                if '/' in full_url and not full_url.startswith('urn:'):
+                    # e.g. https://server/fhir/Patient/123 -> Patient/123 and 123
+                    type_id = '/'.join(_strip_history(full_url).split('/')[-2:])
+                    self.by_type_id.setdefault(type_id, key)
+                    self.by_id.setdefault(type_id.split('/')[-1], key)
+            resource_type = resource.get('resourceType')
+            resource_id = resource.get('id')
+            if resource_type and resource_id:
+                self.by_type_id.setdefault(f"{resource_type}/{resource_id}", key)
+                self.by_id.setdefault(resource_id, key)
     
-    # Handle relative references like "Patient/12345"
-    if '/' in reference:
-        parts = reference.split('/')
-        if len(parts) >= 2:
-            resource_id = parts[-1]
-            
-            if resource_id in resources:
+    def resolve(self, reference: str) -> str:
+        """Resolve a FHIR reference to a resource key, or "" if it is not in the bundle."""
+        if not reference:
+            return ""
+        
+        # urn:uuid:..., also when prefixed with a resource type (Task/urn:uuid:...)
+        if 'urn:uuid:' in reference:
+            return reference.split('urn:uuid:')[-1]
+        
+        # Contained resources are not graphed
+        if reference.startswith('#'):
+            return ""
+        
+        if reference in self.resources:
+            return reference
+        
+        if '/' in reference:
+            key = self.by_full_url.get(reference)
+            if key is not None:
+                return key
+            # Relative (Patient/123) or absolute reference to a resource in the bundle
+            type_id = '/'.join(_strip_history(reference).split('/')[-2:])
+            resource_id = type_id.split('/')[-1]
+            if resource_id in self.resources:
                 return resource_id
-            
-            for res_id, res_data in resources.items():
-                full_url = res_data.get('fullUrl', '')
-                if full_url.endswith(reference) or full_url.endswith(resource_id):
-                    return res_id
-    
-    # Handle contained resources (skip for now)
-    if reference.startswith('#'):
+            return self.by_type_id.get(type_id) or self.by_id.get(resource_id, "")
+        
         return ""
-    
-    if reference in resources:
-        return reference
-    
-    return ""
+
+
+def _strip_history(reference: str) -> str:
+    """Patient/123/_history/2 -> Patient/123"""
+    return reference.split('/_history/', 1)[0]
+
+
+def resolve_reference(reference: str, resources: Dict[str, Dict[str, Any]],
+                      index: Optional[ReferenceIndex] = None) -> str:
+    """
+    Resolve a FHIR reference to a resource ID. Pass an index built once for
+    the bundle when resolving more than one reference.
+    """
+    return (index or ReferenceIndex(resources)).resolve(reference)
 
 
 def _create_external_ref_id(reference: str) -> str:
@@ -179,6 +426,14 @@ def _create_external_ref_id(reference: str) -> str:
     return f"ext-{safe_ref}"
 
 
+def _external_ref_type(reference: str) -> Optional[str]:
+    """Resource type of a relative or absolute reference (None for urn: and # references)."""
+    if reference.startswith(('urn:', '#')) or '/' not in reference:
+        return None
+    parts = _strip_history(reference).split('/')
+    return parts[-2] if len(parts) > 2 else parts[0]
+
+
 def _create_external_ref_label(reference: str) -> str:
     """Create a display label for an external reference."""
     if '/' in reference:
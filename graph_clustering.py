@@ -0,0 +1,230 @@
+"""
+Graph Clustering Module
+
+Keeps the diagram of a huge bundle small enough for Mermaid.js to lay out.
+Sits between build_graph and the exporters and returns a reduced Graph:
+
+    1. Same-type nodes with identical connections - e.g. the Observations of
+       one Encounter, each pointing at the same Patient, Encounter and
+       DiagnosticReport - collapse into one counted node ("Observation ×214").
+    2. While the graph is still larger than DIAGRAM_MAX_NODES, the most
+       numerous resource type collapses into a single node. Task groups and
+       members of expanded clusters are left out of this at first, and
+       collapse by type too if the graph is still too large. A diagram thus
+       has at most DIAGRAM_MAX_NODES nodes, or one per resource type when a
+       bundle has more types than that, whatever the size of the bundle;
+       only types expanded with ?expand= can take it over the limit.
+    3. Optionally, each ServiceRequest and Task group becomes a subgraph
+       holding the nodes that belong to it alone.
+
+Collapsed nodes have stable, Mermaid-safe IDs ("c" + 12 hex digits);
+passing one back in ?expand= draws its members individually.
+
+Configuration (environment variables):
+    DIAGRAM_MAX_NODES           node count above which a diagram is clustered (default: 150)
+    DIAGRAM_CLUSTER_MIN_SIZE    fewest identical nodes collapsed together (default: 3)
+"""
+
+import os
+import hashlib
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Union
+
+from graph_builder import Graph, CLUSTER, EXTERNAL, GROUP_TASK
+
+MAX_NODES = int(os.environ.get('DIAGRAM_MAX_NODES', 150))
+CLUSTER_MIN_SIZE = int(os.environ.get('DIAGRAM_CLUSTER_MIN_SIZE', 3))
+
+# Resources shared by every request in a bundle; never drawn inside a group
+_SHARED_TYPES = frozenset({'Patient', 'Practitioner', 'PractitionerRole', 'Organization',
+                           'Location', 'Encounter', 'Coverage'})
+
+
+class DiagramView(NamedTuple):
+    """
+    How a diagram is drawn. cluster=None clusters only graphs larger than
+    DIAGRAM_MAX_NODES; expand holds collapsed node IDs to draw expanded.
+    """
+    cluster: Optional[bool] = None
+    subgraphs: bool = False
+    expand: FrozenSet[str] = frozenset()
+
+    @property
+    def is_plain(self) -> bool:
+        return not self.cluster and not self.subgraphs
+
+    def etag_suffix(self) -> str:
+        """Suffix telling views of one bundle apart in ETags ('' for the plain diagram)."""
+        if self.is_plain:
+            return ''
+        key = f"{int(bool(self.cluster))}{int(self.subgraphs)}:{','.join(sorted(self.expand))}"
+        return '-' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]
+
+
+def resolve_view(graph: Graph, view: Optional[DiagramView] = None) -> DiagramView:
+    """Settle an automatic cluster choice for a graph (expand only applies when clustered)."""
+    view = view or DiagramView()
+    cluster = view.cluster if view.cluster is not None else len(graph.ids) > MAX_NODES
+    return DiagramView(cluster, view.subgraphs, view.expand if cluster else frozenset())
+
+
+def apply_view(graph: Graph, view: DiagramView) -> Graph:
+    """The graph as a resolved view draws it; the graph itself is not changed."""
+    if view.cluster:
+        graph = cluster_graph(graph, view.expand)
+    elif view.subgraphs:
+        graph = _shallow_copy(graph)
+    if view.subgraphs:
+        graph.subgraphs = group_subgraphs(graph)
+    return graph
+
+
+def cluster_id(node_type: str, member_ids: Iterable[str] = ()) -> str:
+    """Stable ID of a collapsed node: its type plus, for identical siblings, their IDs."""
+    key = node_type + '|' + '|'.join(sorted(member_ids))
+    return 'c' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+def _node_type(graph: Graph, index: int) -> str:
+    return graph.types[index] or ('Reference' if graph.flags[index] & EXTERNAL else 'Resource')
+
+
+def cluster_graph(graph: Graph, expand: FrozenSet[str] = frozenset(),
+                  max_nodes: Optional[int] = None, min_size: Optional[int] = None) -> Graph:
+    """
+    Collapse a graph as described in the module docstring. Task group nodes
+    are only collapsed by type, and only when the graph is still too large
+    without them. Edges between collapsed nodes are merged, and edges
+    between members of one collapsed node are dropped.
+    """
+    max_nodes = MAX_NODES if max_nodes is None else max_nodes
+    min_size = CLUSTER_MIN_SIZE if min_size is None else min_size
+    node_count = len(graph.ids)
+    flags = graph.flags
+
+    connections = [[] for _ in range(node_count)]
+    for source, target, label_id in graph.iter_edges():
+        connections[source].append((target, label_id, True))
+        connections[target].append((source, label_id, False))
+
+    # owner: node index -> itself, or the ID of the collapsed node it is in
+    owner: List[Union[int, str]] = list(range(node_count))
+    members: Dict[str, List[int]] = {}
+    cluster_types: Dict[str, str] = {}
+    pinned = set()
+
+    # 1. Identical siblings
+    siblings = defaultdict(list)
+    for index in range(node_count):
+        if not flags[index] & GROUP_TASK:
+            key = (_node_type(graph, index), flags[index] & EXTERNAL, frozenset(connections[index]))
+            siblings[key].append(index)
+    for (node_type, _, _), indexes in siblings.items():
+        if len(indexes) < min_size:
+            continue
+        collapsed_id = cluster_id(node_type, (graph.ids[index] for index in indexes))
+        if collapsed_id in expand:
+            pinned.update(indexes)
+            continue
+        members[collapsed_id] = indexes
+        cluster_types[collapsed_id] = node_type
+        for index in indexes:
+            owner[index] = collapsed_id
+
+    # 2. Whole types, most numerous first, until the graph is small enough; Task groups
+    #    and pinned nodes only join their type in a second round, if one is still needed
+    visible_count = len(dict.fromkeys(owner))
+    for include_held_back in (False, True):
+        by_type = defaultdict(list)
+        for visible_id in dict.fromkeys(owner):
+            if isinstance(visible_id, str):
+                by_type[cluster_types[visible_id]].append(visible_id)
+            elif include_held_back or not (flags[visible_id] & GROUP_TASK or visible_id in pinned):
+                by_type[_node_type(graph, visible_id)].append(visible_id)
+        for node_type, visible_ids in sorted(by_type.items(), key=lambda item: -len(item[1])):
+            if visible_count <= max_nodes or len(visible_ids) < 2:
+                break
+            collapsed_id = cluster_id(node_type)
+            if collapsed_id in expand:
+                continue
+            merged = [index for visible_id in visible_ids for index in members.pop(visible_id, [visible_id])]
+            members[collapsed_id] = merged
+            cluster_types[collapsed_id] = node_type
+            for index in merged:
+                owner[index] = collapsed_id
+            visible_count -= len(visible_ids) - 1
+
+    clustered = Graph()
+    new_index = [0] * node_count
+    for index, visible_id in enumerate(owner):
+        if visible_id == index:
+            new_index[index] = clustered.add_node(graph.ids[index], graph.labels[index],
+                                                  is_external=bool(flags[index] & EXTERNAL),
+                                                  is_group_task=bool(flags[index] & GROUP_TASK),
+                                                  profiles=graph.profiles.get(index),
+                                                  resource_type=graph.types[index])
+        elif visible_id in clustered.index:
+            new_index[index] = clustered.index[visible_id]
+        else:
+            member_indexes = members[visible_id]
+            new_index[index] = clustered.add_cluster(
+                visible_id, f"{cluster_types[visible_id]} ×{len(member_indexes)}",
+                [graph.ids[member] for member in member_indexes],
+                is_external=all(flags[member] & EXTERNAL for member in member_indexes),
+                resource_type=cluster_types[visible_id])
+
+    for label in graph.edge_label_names:
+        clustered.edge_label_id(label)
+    seen = set()
+    for source, target, label_id in graph.iter_edges():
+        edge = (new_index[source], new_index[target], label_id)
+        if edge in seen or (edge[0] == edge[1] and source != target):
+            continue
+        seen.add(edge)
+        clustered.add_edge_at(*edge)
+    return clustered
+
+
+def group_subgraphs(graph: Graph) -> Dict[str, List[str]]:
+    """
+    One group per Task group and per ServiceRequest not in a Task group:
+    group node ID -> the group node plus every node connected to that group
+    alone. Shared resources (Patient, practitioners, organisations...) stay
+    outside. Groups with nothing but their own node are left out.
+    """
+    neighbours = defaultdict(set)
+    for source, target, _ in graph.iter_edges():
+        if source != target:
+            neighbours[source].add(target)
+            neighbours[target].add(source)
+
+    flags = graph.flags
+    anchor_of = {}
+    for index, node_flags in enumerate(flags):
+        if node_flags & GROUP_TASK:
+            anchor_of[index] = index
+    for index, (node_type, node_flags) in enumerate(zip(graph.types, flags)):
+        if node_type == 'ServiceRequest' and not node_flags & CLUSTER:
+            task_groups = [n for n in neighbours[index] if flags[n] & GROUP_TASK]
+            anchor_of[index] = task_groups[0] if len(task_groups) == 1 else index
+
+    groups: Dict[int, List[int]] = {}
+    for index, anchor in anchor_of.items():
+        if anchor == index:
+            groups.setdefault(index, []).insert(0, index)
+        else:
+            groups.setdefault(anchor, []).append(index)
+    for index, node_type in enumerate(graph.types):
+        if index in anchor_of or node_type in _SHARED_TYPES:
+            continue
+        owners = {anchor_of[n] for n in neighbours[index] if n in anchor_of}
+        if len(owners) == 1:
+            groups[owners.pop()].append(index)
+    return {graph.ids[anchor]: [graph.ids[index] for index in indexes]
+            for anchor, indexes in groups.items() if len(indexes) > 1}
+
+
+def _shallow_copy(graph: Graph) -> Graph:
+    copy = Graph()
+    copy.__dict__.update(graph.__dict__)
+    return copy
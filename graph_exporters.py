@@ -0,0 +1,152 @@
+"""
+Graph Exporters Module
+
+Exports a bundle Graph in formats other than Mermaid, for bundles too large
+for Mermaid.js to lay out in the browser:
+
+    dot         Graphviz DOT, for `dot -Tsvg` or any Graphviz viewer
+    json        compact node/edge lists for client-side layout
+    cytoscape   Cytoscape.js elements JSON
+
+Collapsed nodes and groups (see graph_clustering) are carried over: DOT
+draws groups as clusters, the JSON graph lists them under "groups", and
+Cytoscape.js gets them as compound (parent) nodes.
+
+Every exporter is a generator that writes the graph in a single pass over its
+nodes and edges, so responses can be streamed as they are produced.
+"""
+
+import json
+from json.encoder import encode_basestring as _quote
+from typing import Callable, Dict, Iterator, NamedTuple, Optional
+
+from graph_builder import Graph, CLUSTER, EXTERNAL, GROUP_TASK
+from mermaid_generator import iter_mermaid, _convert_canonical_to_browsable_url
+
+_compact = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+
+def _node_kind(flags: int) -> str:
+    if flags & CLUSTER:
+        return "cluster"
+    if flags & EXTERNAL:
+        return "external"
+    if flags & GROUP_TASK:
+        return "taskGroup"
+    return "resource"
+
+
+def _profile_url(graph: Graph, index: int) -> Optional[str]:
+    profiles = graph.profiles.get(index)
+    return _convert_canonical_to_browsable_url(profiles[0]) or None if profiles else None
+
+
+def _node_json(graph: Graph, index: int, quoted_id: str, extra: str = '') -> str:
+    """{"id", "label", "kind", "size"?, "profile"?} for a node, plus any extra members."""
+    flags = graph.flags[index]
+    text = f'{{"id":{quoted_id},"label":{_quote(graph.labels[index])},"kind":"{_node_kind(flags)}"'
+    if flags & CLUSTER:
+        text += f',"size":{len(graph.clusters[graph.ids[index]])}'
+    profile = _profile_url(graph, index)
+    if profile:
+        text += f',"profile":{_quote(profile)}'
+    return text + extra + '}'
+
+
+def _dot_string(value: str) -> str:
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '') + '"'
+
+
+_DOT_NODE_STYLE = {
+    "resource": "",
+    "external": ', shape=ellipse, style="dashed,filled", fillcolor="#f0f0f0", color="#999999"',
+    "taskGroup": ', fillcolor="#ffe9a8", color="#b07a00", penwidth=2',
+    "cluster": ', shape=box3d, fillcolor="#e8f1fb", color="#2b6cb0", penwidth=2',
+}
+
+
+def iter_dot(graph: Graph, bundle_title: str = "FHIR Bundle Diagram") -> Iterator[str]:
+    """Graphviz DOT for a graph, as a stream of chunks."""
+    yield (f"digraph {_dot_string(bundle_title)} {{\n"
+           "    rankdir=LR;\n"
+           '    node [shape=box, style="rounded,filled", fillcolor="#ffffff", fontname="Helvetica"];\n'
+           '    edge [fontname="Helvetica", fontsize=10];\n')
+    quoted_ids = [_dot_string(node_id) for node_id in graph.ids]
+    for index, (quoted_id, label, flags) in enumerate(zip(quoted_ids, graph.labels, graph.flags)):
+        profile = _profile_url(graph, index)
+        link = f", URL={_dot_string(profile)}, target=\"_blank\"" if profile else ""
+        yield f"    {quoted_id} [label={_dot_string(label)}{_DOT_NODE_STYLE[_node_kind(flags)]}{link}];\n"
+    for number, (group_id, node_ids) in enumerate(graph.subgraphs.items()):
+        yield (f"    subgraph cluster_{number} {{\n"
+               f"        label={_dot_string(graph.nodes[group_id])};\n"
+               f"        style=dashed;\n"
+               f"        {'; '.join(quoted_ids[graph.index[node_id]] for node_id in node_ids)};\n"
+               "    }\n")
+    edge_labels = [_dot_string(edge_label) for edge_label in graph.edge_label_names]
+    for source, target, label_id in graph.iter_edges():
+        yield f"    {quoted_ids[source]} -> {quoted_ids[target]} [label={edge_labels[label_id]}];\n"
+    yield "}\n"
+
+
+def iter_json_graph(graph: Graph, bundle_title: str = "FHIR Bundle Diagram") -> Iterator[str]:
+    """
+    Compact JSON graph as a stream of chunks:
+    {"title", "nodes": [{"id", "label", "kind", "size"?, "profile"?}],
+     "groups"?: [{"id", "label", "nodes"}], "edges": [[source, target, label]]}
+    """
+    yield f'{{"title":{_compact(bundle_title)},"nodes":['
+    quoted_ids = [_quote(node_id) for node_id in graph.ids]
+    separator = ''
+    for index, quoted_id in enumerate(quoted_ids):
+        yield separator + _node_json(graph, index, quoted_id)
+        separator = ','
+    if graph.subgraphs:
+        yield '],"groups":' + _compact([{"id": group_id, "label": graph.nodes[group_id], "nodes": node_ids}
+                                        for group_id, node_ids in graph.subgraphs.items()])
+        yield ',"edges":['
+    else:
+        yield '],"edges":['
+    edge_labels = [_quote(edge_label) for edge_label in graph.edge_label_names]
+    separator = ''
+    for source, target, label_id in graph.iter_edges():
+        yield f'{separator}[{quoted_ids[source]},{quoted_ids[target]},{edge_labels[label_id]}]'
+        separator = ','
+    yield ']}'
+
+
+def iter_cytoscape(graph: Graph, bundle_title: str = "FHIR Bundle Diagram") -> Iterator[str]:
+    """Cytoscape.js JSON ({"data": {...}, "elements": {"nodes", "edges"}}) as a stream of chunks."""
+    yield f'{{"data":{{"name":{_compact(bundle_title)}}},"elements":{{"nodes":['
+    separator = ''
+    parent_of = {}
+    for group_id, node_ids in graph.subgraphs.items():
+        parent_id = f"group-{group_id}"
+        yield separator + _compact({"data": {"id": parent_id, "label": graph.nodes[group_id], "kind": "group"}})
+        separator = ','
+        parent_of.update((graph.index[node_id], f',"parent":{_quote(parent_id)}') for node_id in node_ids)
+    quoted_ids = [_quote(node_id) for node_id in graph.ids]
+    for index, quoted_id in enumerate(quoted_ids):
+        yield f'{separator}{{"data":{_node_json(graph, index, quoted_id, parent_of.get(index, ""))}}}'
+        separator = ','
+    yield '],"edges":['
+    edge_labels = [_quote(edge_label) for edge_label in graph.edge_label_names]
+    separator = ''
+    for number, (source, target, label_id) in enumerate(graph.iter_edges()):
+        yield (f'{separator}{{"data":{{"id":"e{number}","source":{quoted_ids[source]},'
+               f'"target":{quoted_ids[target]},"label":{edge_labels[label_id]}}}}}')
+        separator = ','
+    yield ']}}'
+
+
+class DiagramFormat(NamedTuple):
+    exporter: Callable[[Graph, str], Iterator[str]]
+    mimetype: str
+    extension: str
+
+
+FORMATS: Dict[str, DiagramFormat] = {
+    "mermaid": DiagramFormat(iter_mermaid, "text/plain", "mmd"),
+    "dot": DiagramFormat(iter_dot, "text/vnd.graphviz", "dot"),
+    "json": DiagramFormat(iter_json_graph, "application/json", "json"),
+    "cytoscape": DiagramFormat(iter_cytoscape, "application/json", "cyjs"),
+}
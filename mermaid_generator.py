@@ -6,8 +6,8 @@ Adapted from fhir-bundle-viz for use in Patient Dashboard.
 """
 
 import re
-from typing import Dict, Set
-from graph_builder import Graph
+from typing import Dict, Iterable, Iterator, List, Sequence
+from graph_builder import Graph, CLUSTER, EXTERNAL, GROUP_TASK
 
 
 def generate_mermaid(graph: Graph, bundle_title: str = "FHIR Bundle Diagram") -> str:
@@ -21,109 +21,128 @@ def generate_mermaid(graph: Graph, bundle_title: str = "FHIR Bundle Diagram") ->
     Returns:
         Mermaid diagram as a string
     """
-    lines = []
+    return ''.join(iter_mermaid(graph, bundle_title))
+
+
+def iter_mermaid(graph: Graph, bundle_title: str = "FHIR Bundle Diagram") -> Iterator[str]:
+    """
+    Generate Mermaid flowchart syntax from a graph as a stream of chunks,
+    in one pass over the node arrays and one over the edge arrays.
+    """
+    # Start with flowchart declaration (left-right layout) and the title as a comment
+    yield f"flowchart LR\n    %% {bundle_title}\n"
     
-    # Start with flowchart declaration (left-right layout)
-    lines.append("flowchart LR")
+    # Sanitized node IDs by node index
+    sanitized_ids = _sanitize_node_ids(graph.ids)
+    
+    # Internal nodes are written as they are met; external reference nodes
+    # (rounded stadium shape) are held back to follow them, and nodes in a
+    # subgraph are written inside its block. Collapsed nodes use the
+    # subroutine shape. Styled nodes are collected on the way.
+    subgraph_of = {graph.index[node_id]: group_id for group_id, node_ids in graph.subgraphs.items()
+                   for node_id in node_ids}
+    subgraph_lines = {group_id: [] for group_id in graph.subgraphs}
+    external_lines = []
+    external_node_ids = []
+    group_node_ids = []
+    cluster_node_ids = []
+    for index, (sanitized_id, label, flags) in enumerate(zip(sanitized_ids, graph.labels, graph.flags)):
+        escaped_label = _escape_mermaid_label(label)
+        if flags & CLUSTER:
+            line = f"\n    {sanitized_id}[[\"{escaped_label}\"]]"
+            cluster_node_ids.append(sanitized_id)
+        elif flags & EXTERNAL:
+            line = f"\n    {sanitized_id}([\"{escaped_label}\"])"
+            external_node_ids.append(sanitized_id)
+        else:
+            line = f"\n    {sanitized_id}[\"{escaped_label}\"]"
+        if flags & GROUP_TASK:
+            group_node_ids.append(sanitized_id)
+        if index in subgraph_of:
+            subgraph_lines[subgraph_of[index]].append(line)
+        elif flags & EXTERNAL and not flags & CLUSTER:
+            external_lines.append(line)
+        else:
+            yield line
     
-    # Add title as a comment
-    lines.append(f"    %% {bundle_title}")
-    lines.append("")
+    if external_lines:
+        yield "\n\n    %% External References"
+        yield ''.join(external_lines)
     
-    # Create sanitized node IDs mapping
-    node_id_map = _create_node_id_map(set(graph.nodes.keys()))
+    for group_id, lines in subgraph_lines.items():
+        group_index = graph.index[group_id]
+        yield (f"\n\n    subgraph sg_{sanitized_ids[group_index]}[\"{_escape_mermaid_label(graph.labels[group_index])}\"]"
+               + ''.join(lines) + "\n    end")
     
-    # Separate external and internal nodes
-    external_nodes = [(node_id, label) for node_id, label in graph.nodes.items() 
-                      if node_id in graph.external_refs]
-    internal_nodes = [(node_id, label) for node_id, label in graph.nodes.items() 
-                      if node_id not in graph.external_refs]
+    yield "\n"
     
-    # Add internal nodes
-    for node_id, label in internal_nodes:
-        sanitized_id = node_id_map[node_id]
-        escaped_label = _escape_mermaid_label(label)
-        lines.append(f"    {sanitized_id}[\"{escaped_label}\"]")
-    
-    # Add external reference nodes with rounded stadium shape
-    if external_nodes:
-        lines.append("")
-        lines.append("    %% External References")
-        for node_id, label in external_nodes:
-            sanitized_id = node_id_map[node_id]
-            escaped_label = _escape_mermaid_label(label)
-            # Use stadium shape (rounded ends) for external references
-            lines.append(f"    {sanitized_id}([\"{escaped_label}\"])")
-    
-    lines.append("")
-    
-    # Add edges with labels
-    for source_id, target_id, edge_label in graph.edges:
-        source_sanitized = node_id_map.get(source_id)
-        target_sanitized = node_id_map.get(target_id)
-        
-        if source_sanitized and target_sanitized:
-            escaped_edge_label = _escape_mermaid_label(edge_label)
-            lines.append(f"    {source_sanitized} -->|{escaped_edge_label}| {target_sanitized}")
+    # Add edges with labels (each distinct label escaped once)
+    edge_labels = [_escape_mermaid_label(edge_label) for edge_label in graph.edge_label_names]
+    for source, target, label_id in graph.iter_edges():
+        yield f"\n    {sanitized_ids[source]} -->|{edge_labels[label_id]}| {sanitized_ids[target]}"
     
     # Add styling for external reference nodes
-    if external_nodes:
-        lines.append("")
-        lines.append("    %% Styling for external references")
-        lines.append("    classDef externalRef fill:#f0f0f0,stroke:#999,stroke-width:2px,stroke-dasharray: 5 5")
-        external_node_ids = [node_id_map[node_id] for node_id, _ in external_nodes]
-        lines.append(f"    class {','.join(external_node_ids)} externalRef")
+    if external_node_ids:
+        yield ("\n\n    %% Styling for external references"
+               "\n    classDef externalRef fill:#f0f0f0,stroke:#999,stroke-width:2px,stroke-dasharray: 5 5"
+               f"\n    class {','.join(external_node_ids)} externalRef")
 
     # Add styling for Task group nodes
-    if graph.group_tasks:
-        lines.append("")
-        lines.append("    %% Styling for group tasks")
-        lines.append("    classDef taskGroup fill:#ffe9a8,stroke:#b07a00,stroke-width:2px")
-        group_node_ids = [node_id_map[node_id] for node_id in graph.group_tasks if node_id in node_id_map]
-        if group_node_ids:
-            lines.append(f"    class {','.join(group_node_ids)} taskGroup")
+    if group_node_ids:
+        yield ("\n\n    %% Styling for group tasks\n    classDef taskGroup fill:#ffe9a8,stroke:#b07a00,stroke-width:2px"
+               f"\n    class {','.join(group_node_ids)} taskGroup")
+
+    # Add styling for collapsed nodes (the page expands them on click)
+    if cluster_node_ids:
+        yield ("\n\n    %% Styling for collapsed nodes"
+               "\n    classDef collapsedGroup fill:#e8f1fb,stroke:#2b6cb0,stroke-width:2px"
+               f"\n    class {','.join(cluster_node_ids)} collapsedGroup")
 
     # Add click handlers for nodes with profile URLs
-    if graph.node_profiles:
-        lines.append("")
-        lines.append("    %% Interactive profile links")
-        for node_id, profiles in graph.node_profiles.items():
-            if node_id in node_id_map and profiles:
+    if graph.profiles:
+        yield "\n\n    %% Interactive profile links"
+        for index, profiles in graph.profiles.items():
+            if profiles:
                 # Use the first profile URL (most specific)
                 canonical_url = profiles[0]
                 browsable_url = _convert_canonical_to_browsable_url(canonical_url)
                 if browsable_url:
-                    sanitized_id = node_id_map[node_id]
                     profile_name = canonical_url.split('/')[-1]
                     # Escape quotes in the tooltip
                     tooltip = profile_name.replace('"', '\\"')
-                    lines.append(f'    click {sanitized_id} "{browsable_url}" "View {tooltip} profile" _blank')
-    
-    return '\n'.join(lines)
+                    yield f'\n    click {sanitized_ids[index]} "{browsable_url}" "View {tooltip} profile" _blank'
 
 
-def _create_node_id_map(node_ids: Set[str]) -> Dict[str, str]:
+def _create_node_id_map(node_ids: Iterable[str]) -> Dict[str, str]:
     """
     Create a mapping from original node IDs to Mermaid-safe IDs.
     
-    Mermaid node IDs should:
-    - Start with a letter
-    - Contain only alphanumeric characters and underscores
-    - Be unique
-    
     Args:
-        node_ids: Set of original node IDs (UUIDs)
+        node_ids: Original node IDs (UUIDs)
         
     Returns:
         Dictionary mapping original IDs to sanitized IDs
     """
-    id_map = {}
+    node_ids = list(node_ids)
+    return dict(zip(node_ids, _sanitize_node_ids(node_ids)))
+
+
+def _sanitize_node_ids(node_ids: Sequence[str]) -> List[str]:
+    """
+    Mermaid-safe IDs for a sequence of node IDs, in the same order.
+    
+    Mermaid node IDs should:
+    - Start with a letter
+    - Contain only alphanumeric characters and underscores
+    - Be unique
+    """
+    sanitized_ids = []
     counter = {}
     
     for node_id in node_ids:
         # Create a base ID by taking alphanumeric chars from UUID or external ID
         # Remove hyphens and ensure it starts with a letter
-        base = re.sub(r'[^a-zA-Z0-9]', '', node_id)
+        base = _NOT_ALPHANUMERIC.sub('', node_id)
         
         # Ensure it starts with a letter
         if base and not base[0].isalpha():
@@ -142,9 +161,12 @@ def _create_node_id_map(node_ids: Set[str]) -> Dict[str, str]:
             counter[base] += 1
             sanitized = f"{base}_{counter[base]}"
         
-        id_map[node_id] = sanitized
+        sanitized_ids.append(sanitized)
     
-    return id_map
+    return sanitized_ids
+
+
+_NOT_ALPHANUMERIC = re.compile(r'[^a-zA-Z0-9]')
 
 
 def _escape_mermaid_label(label: str) -> str:
@@ -0,0 +1,187 @@
+"""
+Narrative Module
+
+Generates the XHTML narrative (Resource.text) for resources in a request
+bundle. One Jinja template per resource type is compiled at import, and
+rendered narratives are cached by the content of the elements the template
+reads, so the many identical Tasks and Encounters of a large order, and
+orders repeated in bulk runs, render once.
+
+Narratives can be added while the bundle is built (addNarrative) or left
+until the bundle is submitted (add_narratives on the outgoing entries).
+"""
+
+import base64
+import binascii
+
+from jinja2 import Environment
+
+from fhirutils import TTLCache
+
+XHTML_NS = "http://www.w3.org/1999/xhtml"
+DISPLAY_SEQUENCE_URL = "http://hl7.org.au/fhir/ereq/StructureDefinition/au-erequesting-displaysequence"
+
+
+def get_display_value(value):
+    """Display text of a CodeableConcept, Coding list or Reference-like value."""
+    if isinstance(value, dict):
+        if "coding" in value and isinstance(value["coding"], list) and len(value["coding"]) > 0:
+            return value["coding"][0].get("display", value["coding"][0].get("code", ""))
+        elif "text" in value:
+            return value["text"]
+        elif "display" in value:
+            return value["display"]
+    elif isinstance(value, list) and len(value) > 0:
+        if isinstance(value[0], dict) and "coding" in value[0]:
+            return get_display_value(value[0])
+    return str(value) if value else ""
+
+
+def decode_text(data):
+    """Decode base64 text/plain attachment data, or None if it is not valid UTF-8 base64."""
+    try:
+        return base64.b64decode(data).decode('utf-8')
+    except (binascii.Error, ValueError):
+        return None
+
+
+_env = Environment(autoescape=True)
+_env.filters['display'] = get_display_value
+_env.filters['decode_text'] = decode_text
+_env.globals['DISPLAY_SEQUENCE_URL'] = DISPLAY_SEQUENCE_URL
+
+_STATUS = "<p><strong>Status:</strong> {{ r.status }}</p>"
+_INTENT = "<p><strong>Intent:</strong> {{ r.intent }}</p>"
+_CATEGORY = (
+    "{% set category = (r.category[0] if r.category else {})|display %}"
+    "{% if category %}<p><strong>Category:</strong> {{ category }}</p>{% endif %}"
+)
+
+# Template body per resource type, and the elements it reads (used for the cache key)
+NARRATIVE_TEMPLATES = {
+    "ServiceRequest": (
+        ("status", "intent", "code", "category", "extension", "reasonCode"),
+        _STATUS + _INTENT +
+        "<p><strong>Test:</strong> {{ r.code|display }}</p>" + _CATEGORY +
+        "{% for ext in r.extension or () if ext.url == DISPLAY_SEQUENCE_URL %}"
+        "<p><strong>Sequence:</strong> {{ ext.valueInteger }}</p>"
+        "{% endfor %}"
+        "{% if r.reasonCode %}"
+        "<p><strong>Reasons:</strong> {{ r.reasonCode|map('display')|join(', ') }}</p>"
+        "{% endif %}"
+    ),
+    "Encounter": (
+        ("status", "class"),
+        _STATUS + "<p><strong>Class:</strong> {{ r['class']|display }}</p>"
+    ),
+    "Specimen": (
+        ("type", "collection"),
+        "{% set type = r.type|display %}"
+        "{% if type %}<p><strong>Specimen Type:</strong> {{ type }}</p>{% endif %}"
+        "{% if r.collection %}"
+        "{% set method = r.collection.method|display %}"
+        "{% if method %}<p><strong>Collection Method:</strong> {{ method }}</p>{% endif %}"
+        "{% set site = r.collection.bodySite|display %}"
+        "{% if site %}<p><strong>Body Site:</strong> {{ site }}</p>{% endif %}"
+        "{% if 'collectedDateTime' in r.collection %}"
+        "<p><strong>Collection Date/Time:</strong> {{ r.collection.collectedDateTime }}</p>"
+        "{% endif %}"
+        "{% endif %}"
+    ),
+    "Task": (
+        ("status", "intent", "description"),
+        _STATUS + _INTENT +
+        "{% if r.description %}<p><strong>Description:</strong> {{ r.description }}</p>{% endif %}"
+    ),
+    "DocumentReference": (
+        ("status", "type", "content"),
+        _STATUS + "<p><strong>Type:</strong> {{ r.type|display }}</p>"
+        "{% if r.content %}"
+        "{% set attachment = r.content[0].attachment or {} %}"
+        "{% if attachment.title %}<p><strong>Title:</strong> {{ attachment.title }}</p>{% endif %}"
+        "{% if attachment.contentType %}<p><strong>Content Type:</strong> {{ attachment.contentType }}</p>{% endif %}"
+        "{% if attachment.data and attachment.contentType == 'text/plain' %}"
+        "{% set notes = attachment.data|decode_text %}"
+        "{% if notes is not none %}"
+        "<p><strong>Clinical Context:</strong></p>"
+        "<div style='border: 1px solid #ccc; padding: 10px; margin: 5px 0; background-color: #f9f9f9;'>{{ notes }}</div>"
+        "{% else %}"
+        "<p><strong>Content:</strong> Encoded clinical notes</p>"
+        "{% endif %}"
+        "{% endif %}"
+        "{% endif %}"
+    ),
+    "CommunicationRequest": (
+        ("status",),
+        _STATUS + "<p>Request for communication regarding patient care.</p>"
+    ),
+    "Consent": (
+        ("status", "scope", "category", "provision"),
+        _STATUS +
+        "{% set scope = r.scope|display %}"
+        "{% if scope %}<p><strong>Scope:</strong> {{ scope }}</p>{% endif %}" + _CATEGORY +
+        "{% if r.provision %}<p><strong>Provision:</strong> {{ r.provision.type }}</p>{% endif %}"
+    ),
+    "Coverage": (
+        ("status", "type"),
+        _STATUS +
+        "{% set type = r.type|display %}"
+        "{% if type %}<p><strong>Type:</strong> {{ type }}</p>{% endif %}"
+    ),
+}
+
+
+def _compile(body):
+    return _env.from_string(f'<div xmlns="{XHTML_NS}"><h3>{{{{ resource_type }}}}</h3>{body}</div>')
+
+
+_compiled = {resource_type: (fields, _compile(body)) for resource_type, (fields, body) in NARRATIVE_TEMPLATES.items()}
+_header_only = ((), _compile(""))
+
+_cache = TTLCache(maxsize=4096, ttl=3600)
+
+
+def narrative_key(resource):
+    """
+    Cache key for a resource's narrative: its type plus the repr of the
+    elements its template reads. Resources with equal content share a key.
+    """
+    resource_type = resource.get("resourceType", "")
+    fields, _ = _compiled.get(resource_type, _header_only)
+    return resource_type, repr([resource.get(field) for field in fields])
+
+
+def render_narrative(resource):
+    """
+    Return the narrative for a resource as {"status": "generated", "div": ...},
+    rendering it only if no resource with the same content has been seen.
+    """
+    key = narrative_key(resource)
+    div = _cache.get(key)
+    if div is None:
+        resource_type = resource.get("resourceType", "")
+        _, template = _compiled.get(resource_type, _header_only)
+        div = template.render(r=resource, resource_type=resource_type)
+        _cache.set(key, div)
+    return {"status": "generated", "div": div}
+
+
+def add_narratives(entries, overwrite=True):
+    """
+    Set Resource.text on every resource in a list of bundle entries.
+    With overwrite=False, resources that already have a narrative keep it.
+    Returns the number of narratives added.
+    """
+    added = 0
+    for entry in entries:
+        resource = entry.get("resource")
+        if not isinstance(resource, dict) or (not overwrite and resource.get("text")):
+            continue
+        resource["text"] = render_narrative(resource)
+        added += 1
+    return added
+
+
+def clear_cache():
+    """Drop all cached narratives."""
+    _cache.clear()
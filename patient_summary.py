@@ -0,0 +1,289 @@
+"""
+Patient Summary Module
+
+Serves a patient's $summary (an IPS document Bundle) into the JSON textarea
+without parsing it. The upstream body is streamed straight into the
+response, HTML-escaped chunk by chunk as it arrives, instead of being
+decoded with response.json() and re-serialised with json.dumps(indent=2);
+the browser pretty-prints it once it has arrived. Summaries are kept in a
+short-lived cache per server, patient and credentials, so clicking "Show
+Patient Summary" again is answered without another round-trip.
+
+Servers without the $summary operation get a summary synthesised locally
+(synthesise_summary): an IPS-shaped document Bundle whose Composition has a
+section per IPS section, filled from one search per resource type. The
+searches run concurrently and ask only for the elements a summary shows
+(_elements), so the summary takes as long as the slowest single search.
+Only the first page (PATIENT_SUMMARY_SEARCH_COUNT resources) of each search
+is used.
+
+Configuration (environment variables):
+    PATIENT_SUMMARY_CACHE_TTL         seconds a summary is reused (default: 60, 0 disables)
+    PATIENT_SUMMARY_CACHE_SIZE        summaries kept (default: 32)
+    PATIENT_SUMMARY_CACHE_MAX_BYTES   larger summaries are streamed but not cached (default: 8388608)
+    PATIENT_SUMMARY_LOCAL_FALLBACK    synthesise summaries the server cannot provide (default: true)
+    PATIENT_SUMMARY_SEARCH_COUNT      resources per section search (default: 100)
+    PATIENT_SUMMARY_SEARCH_WORKERS    concurrent section searches (default: 8)
+"""
+
+import os
+import json
+import uuid
+import codecs
+import hashlib
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+import requests
+from jinja2 import Environment
+
+from fhirutils import TTLCache, fhir_get
+from narrative import XHTML_NS, get_display_value
+
+SUMMARY_TTL = int(os.environ.get('PATIENT_SUMMARY_CACHE_TTL', 60))
+MAX_CACHED_BYTES = int(os.environ.get('PATIENT_SUMMARY_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+SEARCH_COUNT = int(os.environ.get('PATIENT_SUMMARY_SEARCH_COUNT', 100))
+SEARCH_WORKERS = int(os.environ.get('PATIENT_SUMMARY_SEARCH_WORKERS', 8))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Ends a summary whose upstream connection failed partway through; the text is
+# then not valid JSON, so the browser shows it as received, marker included
+INCOMPLETE_MARKER = "\n\n!! Patient summary incomplete: the FHIR server connection failed ({error})"
+
+# $summary answers meaning "this server has no such operation" (or no such patient,
+# which the local Patient read then reports the same way)
+UNSUPPORTED_STATUSES = (400, 404, 405, 422, 501)
+
+LOINC = "http://loinc.org"
+
+# IPS sections: (title, LOINC section code, [(resource type, search parameters, _elements)])
+SECTIONS = (
+    ("Allergies and Intolerances", "48765-2", [
+        ("AllergyIntolerance", "patient={patient}",
+         "clinicalStatus,verificationStatus,type,category,criticality,code,onsetDateTime,reaction,patient"),
+    ]),
+    ("Medication Summary", "10160-0", [
+        ("MedicationStatement", "subject={patient}",
+         "status,medicationCodeableConcept,medicationReference,effectiveDateTime,effectivePeriod,dosage,subject"),
+        ("MedicationRequest", "subject={patient}",
+         "status,intent,medicationCodeableConcept,medicationReference,authoredOn,dosageInstruction,subject"),
+    ]),
+    ("Problem List", "11450-4", [
+        ("Condition", "subject={patient}",
+         "clinicalStatus,verificationStatus,category,code,onsetDateTime,onsetPeriod,recordedDate,subject"),
+    ]),
+    ("History of Immunizations", "11369-6", [
+        ("Immunization", "patient={patient}", "status,vaccineCode,occurrenceDateTime,occurrenceString,patient"),
+    ]),
+    ("History of Procedures", "47519-4", [
+        ("Procedure", "subject={patient}", "status,code,performedDateTime,performedPeriod,subject"),
+    ]),
+    ("Results", "30954-2", [
+        ("Observation", "subject={patient}&category=laboratory",
+         "status,category,code,effectiveDateTime,valueQuantity,valueCodeableConcept,valueString,"
+         "interpretation,referenceRange,subject"),
+    ]),
+)
+
+_section_env = Environment(autoescape=True)
+_section_env.filters['display'] = get_display_value
+_SECTION_TEXT = _section_env.from_string(
+    f'<div xmlns="{XHTML_NS}"><ul>'
+    "{% for r in resources %}<li>"
+    "{{ (r.code or r.vaccineCode or r.medicationCodeableConcept or r.medicationReference)|display or r.resourceType }}"
+    "{% if r.status %} ({{ r.status }}){% endif %}</li>{% endfor %}"
+    "</ul></div>")
+_EMPTY_SECTION_TEXT = f'<div xmlns="{XHTML_NS}"><p>No information available</p></div>'
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+_cache = TTLCache(maxsize=int(os.environ.get('PATIENT_SUMMARY_CACHE_SIZE', 32)), ttl=max(SUMMARY_TTL, 1))
+
+
+def summary_key(fhir_server_url: str, patient_id: str, auth_credentials=None,
+                bearer_token: Optional[str] = None) -> str:
+    """Cache key of a patient's summary; includes the credentials, so users never share a summary."""
+    canonical = json.dumps([fhir_server_url.rstrip('/'), patient_id, auth_credentials, bearer_token],
+                           separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def cached_summary(key: str) -> Optional[str]:
+    """The cached summary JSON for key, or None on a miss."""
+    return _cache.get(key) if SUMMARY_TTL > 0 else None
+
+
+def iter_summary(response: requests.Response, key: Optional[str] = None) -> Iterator[str]:
+    """
+    The body of a streamed (stream=True) $summary response as text chunks,
+    decoded as they arrive. Once the whole body has been read it is cached
+    under key, unless it is larger than PATIENT_SUMMARY_CACHE_MAX_BYTES.
+
+    If the connection fails before any text has been yielded the
+    requests.RequestException propagates; after that the output ends with
+    INCOMPLETE_MARKER instead, and nothing is cached.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    pieces = [] if key is not None and SUMMARY_TTL > 0 else None
+    size = 0
+    started = False
+    try:
+        try:
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                text = decoder.decode(chunk)
+                if pieces is not None:
+                    size += len(chunk)
+                    if size > MAX_CACHED_BYTES:
+                        pieces = None
+                    else:
+                        pieces.append(text)
+                if text:
+                    started = True
+                    yield text
+            text = decoder.decode(b'', final=True)
+        except requests.RequestException as e:
+            if not started:
+                raise
+            print(f"[Patient Summary] Connection failed while streaming $summary: {e}")
+            yield INCOMPLETE_MARKER.format(error=type(e).__name__)
+            return
+        if text:
+            yield text
+        if pieces is not None:
+            pieces.append(text)
+            _cache.set(key, ''.join(pieces), ttl=SUMMARY_TTL)
+    finally:
+        response.close()
+
+
+def _search_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix='patient-summary')
+    return _executor
+
+
+def _get_json(path: str, fhir_server_url: str, auth_credentials, bearer_token: Optional[str]) -> Optional[Dict]:
+    """GET a FHIR path as JSON, or None if the request failed."""
+    try:
+        response = fhir_get(path, fhir_server_url=fhir_server_url, auth_credentials=auth_credentials,
+                            bearer_token=bearer_token, timeout=30)
+        if response.status_code != 200:
+            print(f"[Patient Summary] GET {path} returned {response.status_code}")
+            return None
+        return response.json()
+    except Exception as e:
+        print(f"[Patient Summary] GET {path} failed: {e}")
+        return None
+
+
+def _search(resource_type: str, params: str, elements: str, patient_id: str, fhir_server_url: str,
+            auth_credentials, bearer_token: Optional[str]) -> Optional[List[Dict]]:
+    """The resources of one section search, or None if it failed."""
+    path = (f"/{resource_type}?{params.format(patient=f'Patient/{patient_id}')}"
+            f"&_elements={elements}&_count={SEARCH_COUNT}")
+    searchset = _get_json(path, fhir_server_url, auth_credentials, bearer_token)
+    if searchset is None:
+        return None
+    return [entry['resource'] for entry in searchset.get('entry', [])
+            if (entry.get('resource') or {}).get('resourceType') == resource_type
+            and (entry.get('search') or {}).get('mode', 'match') == 'match']
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+
+
+def synthesise_summary(patient_id: str, fhir_server_url: str, auth_credentials=None,
+                       bearer_token: Optional[str] = None) -> Optional[Dict]:
+    """
+    Build an IPS-shaped document Bundle for a patient from the Patient and one
+    search per section resource type, run concurrently. A section whose
+    searches failed or found nothing says so (Composition.section.emptyReason).
+    Returns None if the Patient itself cannot be read.
+    """
+    base = fhir_server_url.rstrip('/')
+    executor = _search_executor()
+    patient_future = executor.submit(_get_json, f"/Patient/{patient_id}", fhir_server_url,
+                                     auth_credentials, bearer_token)
+    section_futures = [[executor.submit(_search, resource_type, params, elements, patient_id,
+                                        fhir_server_url, auth_credentials, bearer_token)
+                        for resource_type, params, elements in searches]
+                       for _, _, searches in SECTIONS]
+    patient = patient_future.result()
+    if not patient or patient.get('resourceType') != 'Patient':
+        for futures in section_futures:
+            for future in futures:
+                future.cancel()
+        return None
+
+    device_url = f"urn:uuid:{uuid.uuid4()}"
+    composition_url = f"urn:uuid:{uuid.uuid4()}"
+    entries = [{"fullUrl": f"{base}/Patient/{patient.get('id', patient_id)}", "resource": patient},
+               {"fullUrl": device_url, "resource": {
+                   "resourceType": "Device",
+                   "deviceName": [{"name": "Patient Dashboard (local $summary)", "type": "user-friendly-name"}]}}]
+    sections = []
+    for (title, code, _), futures in zip(SECTIONS, section_futures):
+        results = [future.result() for future in futures]
+        resources = [resource for found in results if found for resource in found]
+        section = {"title": title, "code": {"coding": [{"system": LOINC, "code": code}]}}
+        if resources:
+            section["text"] = {"status": "generated", "div": _SECTION_TEXT.render(resources=resources)}
+            section["entry"] = []
+            for resource in resources:
+                reference = f"{resource['resourceType']}/{resource.get('id')}"
+                section["entry"].append({"reference": reference})
+                entries.append({"fullUrl": f"{base}/{reference}", "resource": resource})
+        else:
+            # Nothing found: "nilknown" if every search worked, "unavailable" if one failed
+            reason = "unavailable" if any(found is None for found in results) else "nilknown"
+            section["text"] = {"status": "generated", "div": _EMPTY_SECTION_TEXT}
+            section["emptyReason"] = {"coding": [
+                {"system": "http://terminology.hl7.org/CodeSystem/list-empty-reason", "code": reason}]}
+        sections.append(section)
+
+    timestamp = _now()
+    composition = {
+        "resourceType": "Composition",
+        "status": "final",
+        "type": {"coding": [{"system": LOINC, "code": "60591-5", "display": "Patient summary Document"}]},
+        "subject": {"reference": f"Patient/{patient.get('id', patient_id)}"},
+        "date": timestamp,
+        "author": [{"reference": device_url}],
+        "title": "Patient Summary",
+        "section": sections,
+    }
+    return {
+        "resourceType": "Bundle",
+        "identifier": {"system": "urn:ietf:rfc:3986", "value": f"urn:uuid:{uuid.uuid4()}"},
+        "type": "document",
+        "timestamp": timestamp,
+        "entry": [{"fullUrl": composition_url, "resource": composition}] + entries,
+    }
+
+
+def local_summary(key: str, patient_id: str, fhir_server_url: str, auth_credentials=None,
+                  bearer_token: Optional[str] = None) -> Optional[str]:
+    """A synthesised summary as JSON, cached under key like a server's; None if the Patient cannot be read."""
+    bundle = synthesise_summary(patient_id, fhir_server_url, auth_credentials, bearer_token)
+    if bundle is None:
+        return None
+    bundle_json = json.dumps(bundle, separators=(',', ':'), ensure_ascii=False)
+    if SUMMARY_TTL > 0 and len(bundle_json) <= MAX_CACHED_BYTES:
+        _cache.set(key, bundle_json, ttl=SUMMARY_TTL)
+    return bundle_json
+
+
+def local_fallback_enabled() -> bool:
+    return os.environ.get('PATIENT_SUMMARY_LOCAL_FALLBACK', 'true').lower() == 'true'
+
+
+def clear_cache():
+    """Drop all cached summaries."""
+    _cache.clear()
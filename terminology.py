@@ -0,0 +1,549 @@
+"""
+Terminology Service Module
+
+One client for all ValueSet expansion against a FHIR terminology server.
+Holds the registry of named ValueSets used by the typeahead pickers, a pooled
+HTTP session shared by every caller, and TTL caches for expansions and for
+pre-rendered HTML fragments.
+
+Configuration (environment variables):
+    TERMINOLOGY_SERVER_URL       base URL of the terminology server
+    TERMINOLOGY_TIMEOUT          per-request timeout in seconds
+    TERMINOLOGY_MAX_CONCURRENCY  maximum in-flight requests to the server
+    TERMINOLOGY_CACHE_TTL        lifetime of cached expansions in seconds
+    TERMINOLOGY_CACHE_SIZE       maximum number of cached expansions/fragments
+    TERMINOLOGY_MISS_TTL         seconds a term that resolved to no code is remembered (default: 60)
+    TERMINOLOGY_WARMUP           set to 'false' to skip the order-set warm-up
+    TERMINOLOGY_WARMUP_CONCURRENCY  in-flight warm-up requests (default: a quarter of
+                                 TERMINOLOGY_MAX_CONCURRENCY, always leaving slots for lookups)
+    TERMINOLOGY_WARMUP_DIR       where the warm-up lock and cache snapshot live (default: temp dir)
+    TERMINOLOGY_VALIDATE_CODES   set to 'false' to trust displays sent with tests
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from fhirutils import TTLCache
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process warms its own cache
+    fcntl = None
+
+
+DEFAULT_TERMINOLOGY_SERVER = "https://r4.ontoserver.csiro.au/fhir"
+SNOMED_SYSTEM = "http://snomed.info/sct"
+
+# Registry of named ValueSets. Adding a picker only needs an entry here and a
+# matching entry in app.VALUESET_PICKERS.
+VALUESETS: Dict[str, Dict[str, object]] = {
+    'pathology-tests': {
+        'url': 'http://pathologyrequest.example.com.au/ValueSet/boosted',
+        'count': 15,
+    },
+    'radiology-tests': {
+        'url': 'http://radiologyrequest.example.com.au/ValueSet/boosted',
+        'count': 15,
+    },
+    'reason-for-request': {
+        'url': 'https://healthterminologies.gov.au/fhir/ValueSet/reason-for-request-1',
+        'count': 10,
+    },
+    'specimen-type': {
+        'url': 'https://healthterminologies.gov.au/fhir/ValueSet/specimen-type-1',
+        'count': 15,
+    },
+    'collection-method': {
+        'url': 'https://healthterminologies.gov.au/fhir/ValueSet/specimen-collection-procedure-1',
+        'count': 15,
+    },
+    'body-site': {
+        'url': 'https://healthterminologies.gov.au/fhir/ValueSet/body-site-1',
+        'count': 15,
+    },
+}
+
+
+# Well-known SNOMED CT codes for specimen details. Consulted before the
+# terminology server so common values never need a remote round-trip.
+SNOMED_FALLBACK_CODES: Dict[str, str] = {
+    # Specimen types
+    'blood': '119297000',
+    'serum': '119364003',
+    'plasma': '119361006',
+    'urine': '122575003',
+    'saliva': '119342007',
+    'stool': '119339001',
+    'swab': '258603007',
+    'tissue': '119376003',
+
+    # Collection methods
+    'venipuncture': '22778000',
+    'needle biopsy': '129314006',
+    'capillary blood sampling': '277762005',
+    'clean catch urine': '71181003',
+    'midstream urine': '258574006',
+
+    # Body sites
+    'arm': '53120007',
+    'left arm': '368208006',
+    'right arm': '368209003',
+    'finger': '7569003',
+    'hand': '85562004',
+    'leg': '61685007',
+    'neck': '45048000'
+}
+
+
+# Reason-for-request searches pre-expanded by the warm-up so the first
+# clinician of the day gets a warm typeahead.
+WARMUP_REASON_TERMS = (
+    'abdominal pain', 'anaemia', 'chest pain', 'cough', 'diabetes', 'fatigue',
+    'fever', 'headache', 'hypertension', 'pregnancy', 'shortness of breath',
+    'weight loss',
+)
+
+# Order set files and the test-name ValueSet their tests are searched in.
+ORDER_SET_FILES = (
+    ('pathology_common_orders.json', 'pathology-tests'),
+    ('imaging_common_orders.json', 'radiology-tests'),
+)
+
+
+def _normalise_filter(filter_text: str) -> str:
+    """Collapse whitespace and case so equivalent searches share a cache entry."""
+    return ' '.join((filter_text or '').split()).casefold()
+
+
+class TerminologyService:
+    """Pooled, cached ValueSet expansion client."""
+
+    def __init__(self, base_url: Optional[str] = None, timeout: Optional[float] = None,
+                 max_concurrency: Optional[int] = None, cache_ttl: Optional[int] = None,
+                 cache_size: Optional[int] = None):
+        self.base_url = (base_url or os.environ.get('TERMINOLOGY_SERVER_URL')
+                         or DEFAULT_TERMINOLOGY_SERVER).rstrip('/')
+        self.timeout = timeout if timeout is not None else float(os.environ.get('TERMINOLOGY_TIMEOUT', 10))
+        self.max_concurrency = max_concurrency or int(os.environ.get('TERMINOLOGY_MAX_CONCURRENCY', 8))
+        # The warm-up never holds every slot, so interactive lookups are not queued behind it
+        warmup = int(os.environ.get('TERMINOLOGY_WARMUP_CONCURRENCY', 0)) or self.max_concurrency // 4
+        self.warmup_concurrency = max(1, min(warmup, self.max_concurrency - 1))
+        ttl = cache_ttl if cache_ttl is not None else int(os.environ.get('TERMINOLOGY_CACHE_TTL', 3600))
+        size = cache_size or int(os.environ.get('TERMINOLOGY_CACHE_SIZE', 2048))
+        self.validate_codes = os.environ.get('TERMINOLOGY_VALIDATE_CODES', 'true').lower() != 'false'
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+
+        self.cache_ttl = ttl
+        self.miss_ttl = min(ttl, int(os.environ.get('TERMINOLOGY_MISS_TTL', 60)))
+        self.expansions = TTLCache(maxsize=size, ttl=ttl)
+        self.fragments = TTLCache(maxsize=size, ttl=ttl)
+        self.resolved = TTLCache(maxsize=size, ttl=ttl)
+        self.displays = TTLCache(maxsize=size * 4, ttl=ttl)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+    def valueset_url(self, valueset: str) -> str:
+        """Return the canonical URL for a registered ValueSet name (or pass a URL through)."""
+        entry = VALUESETS.get(valueset)
+        return entry['url'] if entry else valueset
+
+    def get(self, path: str, params=None) -> requests.Response:
+        """GET a path on the terminology server through the shared pool."""
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        with self._slots:
+            return self.session.get(url, params=params, timeout=self.timeout)
+
+    def expand(self, valueset: str, filter_text: str = '', count: Optional[int] = None) -> List[Dict[str, str]]:
+        """
+        Expand a registered ValueSet (or ValueSet URL) with a text filter.
+
+        Returns a list of {'system', 'code', 'display'} dicts. Results are cached
+        per (ValueSet, filter, count); request errors propagate to the caller.
+        """
+        entry = VALUESETS.get(valueset, {})
+        count = count or entry.get('count', 15)
+        key = (self.valueset_url(valueset), _normalise_filter(filter_text), count)
+        cached = self.expansions.get(key)
+        if cached is not None:
+            return cached
+
+        params = {"url": key[0], "filter": filter_text, "count": count}
+        resp = self.get('ValueSet/$expand', params=params)
+        logging.info(f'Terminology $expand {key[0]} filter="{filter_text}" -> {resp.status_code}')
+        resp.raise_for_status()
+
+        items = []
+        for item in resp.json().get("expansion", {}).get("contains", []):
+            code = item.get("code", "")
+            display = item.get("display") or code
+            if display:
+                items.append({"system": item.get("system", ""), "code": code, "display": display})
+                if code and item.get("display"):
+                    self.displays.set((item.get("system", ""), code), item["display"])
+        self.expansions.set(key, items)
+        return items
+
+    def cached_display(self, system: str, code: str) -> Optional[str]:
+        """Return the display seen for (system, code) in any cached expansion."""
+        return self.displays.get((system, code))
+
+    def render_fragment(self, valueset: str, filter_text: str,
+                        render: Callable[[List[Dict[str, str]]], str], variant: str = '') -> str:
+        """
+        Return the HTML fragment for an expansion, rendering it at most once per
+        (variant, ValueSet, filter) while the cache entry is live.
+        """
+        key = (variant, self.valueset_url(valueset), _normalise_filter(filter_text))
+        html = self.fragments.get(key)
+        if html is None:
+            html = render(self.expand(valueset, filter_text))
+            self.fragments.set(key, html)
+        return html
+
+    def lookup_displays(self, codings: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], str]:
+        """
+        Return canonical displays for (system, code) pairs.
+
+        Pairs already in the display cache are answered locally; the rest are
+        sent as a single batch Bundle of CodeSystem/$lookup calls. Codes the
+        server does not know map to an empty string. Pairs missing from the
+        result could not be checked (e.g. the server was unreachable).
+        """
+        results: Dict[Tuple[str, str], str] = {}
+        missing = []
+        for system, code in dict.fromkeys(codings):
+            known = self.displays.get((system, code))
+            if known is not None:
+                results[(system, code)] = known
+            elif system and code:
+                missing.append((system, code))
+        if not missing:
+            return results
+
+        batch = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": [{
+                "request": {
+                    "method": "GET",
+                    "url": f"CodeSystem/$lookup?system={quote(system, safe='')}&code={quote(code, safe='')}"
+                }
+            } for system, code in missing]
+        }
+        headers = {'Content-Type': 'application/fhir+json', 'Accept': 'application/fhir+json'}
+        try:
+            with self._slots:
+                resp = self.session.post(self.base_url, json=batch, headers=headers, timeout=self.timeout)
+            logging.info(f"Terminology batch $lookup of {len(missing)} codes -> {resp.status_code}")
+            resp.raise_for_status()
+            entries = resp.json().get('entry', [])
+        except Exception as e:
+            logging.warning(f"Terminology batch $lookup failed: {e}")
+            return results
+
+        for (system, code), entry in zip(missing, entries):
+            status = str(entry.get('response', {}).get('status', ''))
+            resource = entry.get('resource', {})
+            display = ''
+            if status.startswith('2') and resource.get('resourceType') == 'Parameters':
+                display = next((p.get('valueString', '') for p in resource.get('parameter', [])
+                                if p.get('name') == 'display'), '')
+            elif not status.startswith('4'):
+                continue  # server-side failure: leave unchecked
+            self.displays.set((system, code), display)
+            results[(system, code)] = display
+        return results
+
+    def apply_canonical_displays(self, tests: List[Dict], system: str = SNOMED_SYSTEM) -> List[Dict]:
+        """
+        Return copies of the selected tests with coding displays replaced by the
+        terminology server's canonical display, validated in one round-trip.
+
+        The clinician-facing 'text' is preserved (it falls back to the display
+        that was sent). Unknown codes are logged and left untouched.
+        """
+        if not self.validate_codes:
+            return tests
+        codes = [str(t.get('code') or '').strip() for t in tests]
+        displays = self.lookup_displays((system, code) for code in codes if code)
+
+        validated = []
+        for test, code in zip(tests, codes):
+            display = displays.get((system, code)) if code else None
+            if display:
+                test = dict(test)
+                if not test.get('text'):
+                    test['text'] = test.get('display', '') or display
+                test['display'] = display
+            elif display == '':
+                logging.warning(f"Code {code} is not known to {self.base_url}; keeping supplied display")
+            validated.append(test)
+        return validated
+
+    def resolve_code(self, display_text: str, valueset: str) -> str:
+        """
+        Resolve a display term to a code in a ValueSet.
+
+        Checks, in order: previously resolved terms, the SNOMED fallback table,
+        then a remote $expand (exact display match preferred, else the first
+        result). Returns an empty string when nothing matches or the server
+        cannot be reached. Codes are memoised for the cache TTL, misses for
+        the shorter TERMINOLOGY_MISS_TTL, so a repeated unknown term (or an
+        unreachable server) costs one round-trip per miss TTL.
+        """
+        if not display_text or not valueset:
+            return ""
+        term = _normalise_filter(display_text)
+        key = (self.valueset_url(valueset), term)
+        code = self.resolved.get(key)
+        if code is not None:
+            return code
+
+        code = SNOMED_FALLBACK_CODES.get(term)
+        if code is None:
+            try:
+                contains = self.expand(valueset, display_text, count=10)
+            except Exception as e:
+                logging.warning(f"Failed to lookup SNOMED code for '{display_text}': {e}")
+                contains = []
+            code = next((item["code"] for item in contains if item["display"].casefold() == term),
+                        contains[0]["code"] if contains else "")
+        self.resolved.set(key, code, ttl=None if code else self.miss_ttl)
+        return code
+
+    def resolve_codes(self, lookups: Dict[Hashable, Tuple[str, str]]) -> Dict[Hashable, str]:
+        """
+        Resolve several (display, ValueSet) pairs at once.
+
+        Cached and fallback answers are returned immediately; the remaining
+        terms are looked up concurrently on the shared pool, so the caller waits
+        for at most one round-trip rather than one per term.
+        """
+        results: Dict[Hashable, str] = {}
+        pending = {}
+        for name, (display_text, valueset) in lookups.items():
+            term = _normalise_filter(display_text)
+            known = self.resolved.get((self.valueset_url(valueset), term))
+            if known is None:
+                known = SNOMED_FALLBACK_CODES.get(term)
+            if known is not None or not display_text:
+                results[name] = known or ""
+            else:
+                pending[name] = (display_text, valueset)
+
+        if len(pending) == 1:
+            name, (display_text, valueset) = pending.popitem()
+            results[name] = self.resolve_code(display_text, valueset)
+        elif pending:
+            futures = {name: self.executor.submit(self.resolve_code, *args) for name, args in pending.items()}
+            for name, future in futures.items():
+                results[name] = future.result()
+        return results
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Thread pool for concurrent lookups, sized to the connection limit."""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                        thread_name_prefix='terminology')
+        return self._executor
+
+    def warm_cache(self, order_sets_dir: str, reason_terms=WARMUP_REASON_TERMS) -> int:
+        """
+        Pre-expand every order-set test (by short text and display) in its
+        test-name ValueSet, plus the common reason-for-request terms, so the
+        expansion and display caches are warm. Returns the number of searches.
+
+        Runs on its own pool of warmup_concurrency threads rather than the
+        shared executor, so it holds at most that many of the request slots.
+        """
+        searches = set()
+        for file_name, valueset in ORDER_SET_FILES:
+            path = os.path.join(order_sets_dir, file_name)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    order_sets = json.load(f).get('order_sets', {})
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logging.warning(f"Terminology warm-up could not read {path}: {e}")
+                continue
+            for tests in order_sets.values():
+                for test in tests:
+                    for term in (test.get('text'), test.get('display')):
+                        if term and term.strip():
+                            searches.add((valueset, term.strip()))
+        searches.update(('reason-for-request', term) for term in reason_terms)
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.warmup_concurrency, thread_name_prefix='terminology-warmup') as pool:
+            futures = [pool.submit(self.expand, valueset, term) for valueset, term in sorted(searches)]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception:
+                    failed += 1
+        logging.info(f"Terminology warm-up: {len(searches) - failed}/{len(searches)} searches cached")
+        return len(searches)
+
+    def export_cache(self) -> Dict[str, list]:
+        """
+        Snapshot the expansion, resolved-code and display caches as picklable
+        lists, e.g. to seed the terminology service of a worker process.
+        """
+        return {
+            'expansions': self.expansions.items(),
+            'resolved': [(key, code) for key, code in self.resolved.items() if code],
+            'displays': self.displays.items(),
+        }
+
+    def load_cache(self, snapshot: Dict[str, list]):
+        """Seed the caches from export_cache() output."""
+        self.expansions.update(snapshot.get('expansions', ()))
+        self.resolved.update(snapshot.get('resolved', ()))
+        self.displays.update(snapshot.get('displays', ()))
+
+    def clear(self):
+        """Drop all cached expansions, fragments, resolved codes and displays."""
+        self.expansions.clear()
+        self.fragments.clear()
+        self.resolved.clear()
+        self.displays.clear()
+
+
+_service: Optional[TerminologyService] = None
+_service_lock = threading.Lock()
+
+
+def get_terminology_service() -> TerminologyService:
+    """Return the process-wide TerminologyService, creating it on first use."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = TerminologyService()
+    return _service
+
+
+_warmup_running = False
+_warmup_rerun = False
+
+
+def _warmup_paths(service: TerminologyService, order_sets_dir: str) -> Tuple[str, str]:
+    """Lock file and cache snapshot shared by every process warming this server from these order sets."""
+    digest = hashlib.sha256(f"{service.base_url}|{os.path.abspath(order_sets_dir)}".encode()).hexdigest()[:16]
+    base = os.path.join(os.environ.get('TERMINOLOGY_WARMUP_DIR') or tempfile.gettempdir(),
+                        f'terminology-warmup-{digest}')
+    return base + '.lock', base + '.json'
+
+
+def _load_snapshot(service: TerminologyService, path: str, order_sets_dir: str) -> bool:
+    """Seed the caches from a snapshot newer than the order sets and the cache TTL; False if there is none."""
+    try:
+        written = os.path.getmtime(path)
+        if written < time.time() - service.cache_ttl:
+            return False
+        for file_name, _ in ORDER_SET_FILES:
+            order_set_path = os.path.join(order_sets_dir, file_name)
+            if os.path.exists(order_set_path) and os.path.getmtime(order_set_path) > written:
+                return False
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return False
+    service.load_cache({name: [(tuple(key), value) for key, value in pairs] for name, pairs in snapshot.items()})
+    logging.info(f"Terminology warm-up: loaded {len(snapshot.get('expansions', []))} searches from {path}")
+    return True
+
+
+def _save_snapshot(service: TerminologyService, path: str):
+    try:
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(service.export_cache(), f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logging.warning(f"Terminology warm-up could not write {path}: {e}")
+
+
+def warm_shared_cache(order_sets_dir: str, service: Optional[TerminologyService] = None) -> int:
+    """
+    Warm the cache once per host rather than once per worker process: the
+    first process to take the warm-up lock queries the terminology server and
+    writes a snapshot of its caches; processes waiting on the lock then load
+    that snapshot instead. Returns the number of remote searches made.
+    """
+    service = service or get_terminology_service()
+    if fcntl is None:
+        return service.warm_cache(order_sets_dir)
+    lock_path, snapshot_path = _warmup_paths(service, order_sets_dir)
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if _load_snapshot(service, snapshot_path, order_sets_dir):
+                return 0
+            searches = service.warm_cache(order_sets_dir)
+            _save_snapshot(service, snapshot_path)
+            return searches
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def start_cache_warmup(order_sets_dir: str) -> Optional[threading.Thread]:
+    """
+    Warm the terminology cache from the order sets on a background thread.
+
+    If a warm-up is already running it runs once more when it finishes, so
+    freshly saved order sets are picked up. Worker processes on one host share
+    a single warm-up (see warm_shared_cache). Disabled with TERMINOLOGY_WARMUP=false.
+    """
+    global _warmup_running, _warmup_rerun
+    if os.environ.get('TERMINOLOGY_WARMUP', 'true').lower() == 'false':
+        return None
+
+    def run():
+        global _warmup_running, _warmup_rerun
+        while True:
+            try:
+                warm_shared_cache(order_sets_dir)
+            except Exception as e:
+                logging.warning(f"Terminology warm-up failed: {e}")
+            with _service_lock:
+                if not _warmup_rerun:
+                    _warmup_running = False
+                    return
+                _warmup_rerun = False
+
+    with _service_lock:
+        if _warmup_running:
+            _warmup_rerun = True
+            return None
+        _warmup_running = True
+    thread = threading.Thread(target=run, name='terminology-warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def configure_terminology_service(**kwargs) -> TerminologyService:
+    """Replace the process-wide TerminologyService (e.g. to point at a local stand-in)."""
+    global _service
+    with _service_lock:
+        _service = TerminologyService(**kwargs)
+    return _service
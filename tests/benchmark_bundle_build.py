@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Benchmark request bundle construction for 1, 10 and 100-test orders.
+
+Usage: python tests/benchmark_bundle_build.py [iterations]
+"""
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import terminology
+from bundler import create_request_bundle
+
+
+def build_form(test_count, narrative='off'):
+    """
+    Form data for an order with test_count coded tests and every optional resource.
+    narrative is 'off', 'build' (rendered into the preview) or 'submit' (deferred).
+    """
+    return {
+        'patient_id': 'bench-patient',
+        'organisation': 'bench-org',
+        'organisationName': 'Bench Pathology',
+        'requestCategory': 'Pathology',
+        'selectedTests': [
+            {"code": str(26604007 + i), "display": f"Test {i}", "text": f"T{i}", "display_sequence": i + 1}
+            for i in range(test_count)
+        ],
+        'selectedReasons': [{"code": "84229001", "display": "Fatigue"}],
+        'clinicalContext': 'Tired all the time',
+        'isPregnant': 'true',
+        'billingCategory': 'PUBLICPOL',
+        'specimenCollected': 'true',
+        'specimenType': 'Blood',
+        'collectionMethod': 'Venipuncture',
+        'bodySite': 'Arm',
+        'copyTo': ['copy-role'],
+        'mhrConsentWithdrawn': 'true',
+        'doNotContactPatient': 'true',
+        'addNarrative': narrative != 'off',
+        'narrativeAtSubmit': 'true' if narrative == 'submit' else '',
+    }
+
+
+def run_benchmark(iterations=200):
+    """Print build and serialisation times per bundle"""
+    # Keep the benchmark offline: no code validation and no requester fetch
+    terminology.get_terminology_service().validate_codes = False
+
+    print(f"{'tests':>6} {'narrative':>10} {'entries':>8} {'build ms':>10} {'json ms':>9}")
+    for test_count in (1, 10, 100):
+        for narrative in ('off', 'build', 'submit'):
+            form = build_form(test_count, narrative)
+            runs = max(1, iterations // test_count)
+            bundle = create_request_bundle(form)
+
+            start = time.perf_counter()
+            for _ in range(runs):
+                bundle = create_request_bundle(form)
+            build_ms = (time.perf_counter() - start) * 1000 / runs
+
+            start = time.perf_counter()
+            for _ in range(runs):
+                json.dumps(bundle)
+            json_ms = (time.perf_counter() - start) * 1000 / runs
+
+            print(f"{test_count:>6} {narrative:>10} {len(bundle['entry']):>8} "
+                  f"{build_ms:>10.3f} {json_ms:>9.3f}")
+
+
+if __name__ == "__main__":
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
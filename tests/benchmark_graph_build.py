@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Benchmark diagram generation for large $everything-style bundles
+(1k and 10k entries, server fullUrls and relative references).
+
+Usage: python tests/benchmark_graph_build.py [entries ...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fhir_parser import extract_resources
+from graph_builder import build_graph
+from mermaid_generator import generate_mermaid
+
+BASE = "https://fhir.example.org/fhir"
+
+
+def everything_bundle(entry_count):
+    """
+    A searchset like Patient/$everything returns: one Patient, then
+    Encounters each followed by Observations and a DiagnosticReport.
+    """
+    def entry(resource):
+        return {"fullUrl": f"{BASE}/{resource['resourceType']}/{resource['id']}", "resource": resource}
+
+    entries = [entry({"resourceType": "Patient", "id": "pat-1"})]
+    encounter_id = None
+    observations = []
+    while len(entries) < entry_count:
+        index = len(entries)
+        if encounter_id is None or len(observations) == 8:
+            if observations:
+                entries.append(entry({"resourceType": "DiagnosticReport", "id": f"dr-{index}",
+                                      "subject": {"reference": "Patient/pat-1"},
+                                      "encounter": {"reference": f"Encounter/{encounter_id}"},
+                                      "result": [{"reference": f"Observation/{o}"} for o in observations]}))
+            encounter_id = f"enc-{index}"
+            observations = []
+            entries.append(entry({"resourceType": "Encounter", "id": encounter_id,
+                                  "subject": {"reference": f"{BASE}/Patient/pat-1"},
+                                  "serviceProvider": {"reference": "Organization/org-1"}}))
+        else:
+            observation_id = f"obs-{index}"
+            observations.append(observation_id)
+            entries.append(entry({"resourceType": "Observation", "id": observation_id, "status": "final",
+                                  "subject": {"reference": "Patient/pat-1"},
+                                  "encounter": {"reference": f"Encounter/{encounter_id}"},
+                                  "performer": [{"reference": "Practitioner/prac-1"}]}))
+    return {"resourceType": "Bundle", "type": "searchset", "entry": entries[:entry_count]}
+
+
+def run_benchmark(sizes=(1000, 10000)):
+    """Print parse, graph and Mermaid times per bundle size"""
+    for size in sizes:
+        bundle = everything_bundle(size)
+        started = time.perf_counter()
+        resources = extract_resources(bundle)
+        parsed = time.perf_counter()
+        graph = build_graph(resources)
+        built = time.perf_counter()
+        generate_mermaid(graph, "Benchmark")
+        finished = time.perf_counter()
+        print(f"{size:>6} entries: {len(graph.edges):>6} edges  "
+              f"parse {(parsed - started) * 1000:8.1f} ms  "
+              f"graph {(built - parsed) * 1000:8.1f} ms  "
+              f"mermaid {(finished - built) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    run_benchmark(tuple(int(arg) for arg in sys.argv[1:]) or (1000, 10000))
@@ -0,0 +1,152 @@
+"""Tests for the airport task board (/api/tasks/by-org)."""
+import json
+import os
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import app as app_module
+from app import app
+
+GROUP_TAG = {"system": "http://terminology.hl7.org.au/CodeSystem/resource-tag", "code": "fulfilment-task-group"}
+
+
+def _task(task_id, focus=None, part_of=None, group=False):
+    task = {"resourceType": "Task", "id": task_id, "status": "requested", "for": {"reference": "Patient/p1"}}
+    if focus:
+        task["focus"] = {"reference": f"ServiceRequest/{focus}"}
+    if part_of:
+        task["partOf"] = [{"reference": f"Task/{part_of}"}]
+    if group:
+        task["meta"] = {"tag": [GROUP_TAG]}
+    return task
+
+
+def _service_request(sr_id):
+    return {"resourceType": "ServiceRequest", "id": sr_id, "intent": "order",
+            "code": {"coding": [{"system": "http://snomed.info/sct", "code": sr_id, "display": f"Test {sr_id}"}]}}
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = json.dumps(payload)
+        self.url = ''
+
+    def json(self):
+        return self._payload
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = {'service_requests': {sr_id: _service_request(sr_id) for sr_id in ('1', '2', '3', '4')}, 'calls': [],
+              'capability': {"resourceType": "CapabilityStatement", "rest": [{"resource": [
+                  {"type": "Task", "searchInclude": ["Task:focus", "Task:patient", "Task:owner"],
+                   "searchRevInclude": ["Task:part-of"]}]}]},
+              'includes_fail': []}
+    tasks = [_task('g1', group=True), _task('c1', focus='1', part_of='g1'), _task('c2', focus='2', part_of='g1'),
+             _task('c3', focus='3', part_of='g1'), _task('t4', focus='4')]
+
+    def fake_get(url, params=None, **kwargs):
+        server['calls'].append((url, params))
+        if url.endswith('/metadata'):
+            return FakeResponse(server['capability'])
+        if url.endswith('/Task'):
+            with_includes = any(p[0] in ('_include', '_revinclude') for p in params or [])
+            if with_includes and server['includes_fail']:
+                return FakeResponse({"resourceType": "OperationOutcome"}, server['includes_fail'].pop(0))
+            # Only the first ServiceRequest comes back with _include
+            included = [server['service_requests']['1']] if with_includes else []
+            return FakeResponse({"resourceType": "Bundle", "total": 1,
+                                 "entry": [{"resource": r} for r in tasks + included]})
+        if url.endswith('/ServiceRequest'):
+            ids = dict(params)['_id'].split(',')
+            return FakeResponse({"resourceType": "Bundle", "entry": [
+                {"resource": server['service_requests'][sr_id]} for sr_id in ids]})
+        return FakeResponse({}, 404)
+
+    monkeypatch.setattr(app_module.requests, 'get', fake_get)
+    app_module._task_include_support.clear()
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        server['client'] = client
+        yield server
+
+
+def _board(server):
+    resp = server['client'].get('/api/tasks/by-org?org_identifier=8003624900039402',
+                                headers={'X-FHIR-Server-URL': 'http://fhir.test/fhir'})
+    assert resp.status_code == 200
+    return resp.get_json()
+
+
+def test_missing_service_requests_are_fetched_in_one_search(server):
+    board = _board(server)
+    sr_searches = [params for url, params in server['calls'] if url.endswith('/ServiceRequest')]
+    assert sr_searches == [[('_id', '2,3,4'), ('_count', '3')]]
+    assert not any('/ServiceRequest/' in url for url, _ in server['calls'])
+
+    group = board['groupTasks'][0]
+    assert sorted(group['serviceRequest']['codes']) == ['Test 1', 'Test 2', 'Test 3']
+    assert [child['codeDisplay'] for child in group['childTasks']] == ['Test 1', 'Test 2', 'Test 3']
+    single = next(task for task in board['tasks'] if task['id'] == 't4')
+    assert single['serviceRequest']['codes'] == ['Test 4']
+
+
+def test_large_batches_are_split_into_chunks(server, monkeypatch):
+    monkeypatch.setattr(app_module, 'SERVICE_REQUEST_SEARCH_CHUNK', 2)
+    board = _board(server)
+    sr_searches = sorted(dict(params)['_id'] for url, params in server['calls'] if url.endswith('/ServiceRequest'))
+    assert sr_searches == ['2,3', '4']
+    assert next(task for task in board['tasks'] if task['id'] == 't4')['serviceRequest']['codes'] == ['Test 4']
+
+
+def _task_searches(server):
+    return [params for url, params in server['calls'] if url.endswith('/Task')]
+
+
+def test_include_support_is_read_once_per_server(server):
+    for _ in range(3):
+        _board(server)
+    assert [url for url, _ in server['calls'] if url.endswith('/metadata')] == ['http://fhir.test/fhir/metadata']
+    searches = _task_searches(server)
+    assert len(searches) == 3
+    assert [p for p in searches[0] if p[0] in ('_include', '_revinclude', '_count')] == \
+        [('_count', '20'), ('_include', 'Task:focus'), ('_include', 'Task:patient'), ('_revinclude', 'Task:part-of')]
+
+    # Only what the CapabilityStatement declares is asked for
+    app_module._task_include_support.clear()
+    server['capability']['rest'][0]['resource'][0]['searchRevInclude'] = []
+    server['calls'].clear()
+    _board(server)
+    assert not any(p[0] == '_revinclude' for p in _task_searches(server)[0])
+
+
+def test_includes_are_dropped_after_the_first_failure(server):
+    server['capability'] = {"resourceType": "CapabilityStatement", "rest": [{"resource": [{"type": "Task"}]}]}
+    server['includes_fail'] = [400]
+    first = _board(server)
+    assert len(_task_searches(server)) == 2
+    assert next(task for task in first['tasks'] if task['id'] == 't4')['serviceRequest']['codes'] == ['Test 4']
+
+    server['calls'].clear()
+    _board(server)
+    searches = _task_searches(server)
+    assert len(searches) == 1 and not any(p[0] in ('_include', '_revinclude') for p in searches[0])
+
+
+def test_transient_include_failure_is_not_cached(server):
+    server['includes_fail'] = [500]
+    first = _board(server)
+    assert len(_task_searches(server)) == 2
+    assert next(task for task in first['tasks'] if task['id'] == 't4')['serviceRequest']['codes'] == ['Test 4']
+
+    server['calls'].clear()
+    _board(server)
+    searches = _task_searches(server)
+    assert len(searches) == 1 and ('_revinclude', 'Task:part-of') in searches[0]
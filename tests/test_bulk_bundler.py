@@ -0,0 +1,144 @@
+"""Tests for bulk bundle generation from NDJSON order specs."""
+import json
+import os
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import terminology
+import bulk_bundler
+from app import app
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        pass
+
+
+CANONICAL = {'26604007': 'Full blood count', '43396009': 'Haemoglobin A1c measurement'}
+
+
+@pytest.fixture
+def service(monkeypatch):
+    svc = terminology.configure_terminology_service(base_url='http://terminology.test/fhir')
+    posts = []
+
+    def fake_post(url, json=None, headers=None, timeout=None):
+        posts.append(json)
+        return FakeResponse({"resourceType": "Bundle", "entry": [{
+            "resource": {"resourceType": "Parameters", "parameter": [
+                {"name": "display", "valueString": CANONICAL[e['request']['url'].split('code=')[-1]]}]},
+            "response": {"status": "200 OK"}} for e in json['entry']]})
+
+    monkeypatch.setattr(svc.session, 'post', fake_post)
+    monkeypatch.setattr(svc.session, 'get', lambda *a, **k: pytest.fail("unexpected $expand"))
+    svc.posts = posts
+    yield svc
+    terminology.configure_terminology_service()
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    calls = []
+
+    def fake_fetch(role_ids, fhir_server_url=None, auth_credentials=None):
+        calls.extend(role_ids)
+        return {role_id: [{"resourceType": "PractitionerRole", "id": role_id},
+                          {"resourceType": "Practitioner", "id": f"prac-{role_id}"}]
+                for role_id in role_ids}
+
+    monkeypatch.setattr(bulk_bundler, 'fetch_directory', fake_fetch)
+    return calls
+
+
+def _spec(patient, code='26604007', **extra):
+    spec = {"patient": patient, "requester": "role-1", "organisation": "org-1",
+            "tests": [{"code": code, "display": "as typed", "text": "short"}],
+            "specimen": {"type": "Blood", "method": "Venipuncture"}}
+    spec.update(extra)
+    return json.dumps(spec)
+
+
+def _resources(bundle, resource_type):
+    return [e['resource'] for e in bundle['entry'] if e.get('resource', {}).get('resourceType') == resource_type]
+
+
+def test_order_spec_mapping():
+    form = bulk_bundler.order_spec_to_form_data({
+        "patient": "p1", "category": "Pathology", "tests": [], "reasons": ["Fatigue"],
+        "specimen": {"type": "Blood", "typeCode": "119297000"}, "copyTo": ["role-2"]})
+    assert form == {"patient_id": "p1", "requestCategory": "Pathology", "selectedTests": [],
+                    "selectedReasons": ["Fatigue"], "specimenCollected": "true", "specimenType": "Blood",
+                    "specimenTypeCode": "119297000", "copyTo": ["role-2"]}
+
+
+def test_inline_run_resolves_shared_lookups_once(service, fetches):
+    lines = [_spec('p1'), 'not json', '', json.dumps({"tests": []}), _spec('p2', code='43396009')]
+    run = bulk_bundler.BulkRun(lines, workers=1)
+    output = [json.loads(line) for line in run]
+
+    assert [o.get('line') for o in output] == [None, 2, 4, None]
+    assert 'error' in output[1] and 'error' in output[2]
+    assert fetches == ['role-1']
+    assert len(service.posts) == 1
+
+    first = output[0]
+    assert _resources(first, 'Patient') == []
+    assert _resources(first, 'PractitionerRole')[0]['id'] == 'role-1'
+    assert _resources(first, 'ServiceRequest')[0]['code']['coding'][0]['display'] == 'Full blood count'
+    assert run.report['orders'] == 4
+    assert run.report['bundles'] == 2
+    assert run.report['errors'] == 2
+    assert run.report['requesters'] == 1
+
+
+def test_process_pool_keeps_input_order(service, fetches):
+    lines = [_spec(f'p{i}', code='43396009' if i % 2 else '26604007') for i in range(6)]
+    run = bulk_bundler.BulkRun(lines, workers=2)
+    bundles = [json.loads(line) for line in run]
+
+    assert run.report['workers'] == 2
+    assert run.report['bundles'] == 6
+    assert len(service.posts) == 1
+    for i, bundle in enumerate(bundles):
+        service_request = _resources(bundle, 'ServiceRequest')[0]
+        assert service_request['subject']['reference'] == f'Patient/p{i}'
+        assert service_request['code']['coding'][0]['display'] == CANONICAL['43396009' if i % 2 else '26604007']
+        specimen = _resources(bundle, 'Specimen')[0]
+        assert specimen['type']['coding'][0]['code'] == '119297000'
+
+
+def test_bulk_endpoint_streams_ndjson_with_report(service, fetches):
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        resp = client.post('/fhir/diagnosticrequest/bundler/bulk?workers=1',
+                           data='\n'.join([_spec('p1'), _spec('p2')]))
+        assert resp.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        assert [line['resourceType'] for line in lines[:2]] == ['Bundle', 'Bundle']
+        assert lines[2]['report']['bundles'] == 2
+
+        assert client.post('/fhir/diagnosticrequest/bundler/bulk', data='').status_code == 400
+
+
+def test_bulk_endpoint_clamps_requested_workers(service, fetches, monkeypatch):
+    monkeypatch.setenv('BULK_BUNDLER_MAX_WORKERS', '1')
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        resp = client.post('/fhir/diagnosticrequest/bundler/bulk?workers=5000',
+                           data='\n'.join([_spec('p1'), _spec('p2'), _spec('p3')]))
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        assert lines[-1]['report']['workers'] == 1
+        assert lines[-1]['report']['bundles'] == 3
@@ -0,0 +1,122 @@
+"""Tests for the cached bundle diagram endpoints."""
+import json
+import os
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import bundle_diagram
+import graph_exporters
+from app import app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def body():
+    with open(os.path.join(ROOT, 'json', 'service_request_bundle.json'), 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    builds = []
+    original = bundle_diagram.build_graph
+
+    def counting_build(resources):
+        builds.append(len(resources))
+        return original(resources)
+
+    monkeypatch.setattr(bundle_diagram, 'build_graph', counting_build)
+    bundle_diagram.clear_cache()
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        client.builds = builds
+        yield client
+    bundle_diagram.clear_cache()
+
+
+def test_draw_then_download_builds_once(client, body):
+    drawn = client.post('/bundle/mermaid', data=body, content_type='application/json')
+    assert drawn.status_code == 200
+    assert drawn.get_data(as_text=True).startswith('flowchart')
+    etag = drawn.headers['ETag']
+
+    downloaded = client.post('/bundle/mermaid/download', data=body, content_type='application/json')
+    assert downloaded.status_code == 200
+    assert downloaded.headers['Content-Disposition'] == 'attachment; filename="fhir-bundle-diagram.mmd"'
+    assert downloaded.get_data() == drawn.get_data()
+    assert downloaded.headers['ETag'] == etag
+    assert len(client.builds) == 1
+
+
+def test_unchanged_bundle_revalidates_with_304(client, body):
+    etag = client.post('/bundle/mermaid', data=body, content_type='application/json').headers['ETag']
+    again = client.post('/bundle/mermaid', data=body, content_type='application/json',
+                        headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.get_data() == b''
+
+    changed = json.loads(body)
+    changed['entry'] = changed['entry'][:3]
+    redrawn = client.post('/bundle/mermaid', json=changed, headers={'If-None-Match': etag})
+    assert redrawn.status_code == 200
+    assert redrawn.headers['ETag'] != etag
+    assert len(client.builds) == 2
+
+
+def test_bad_bodies_are_rejected(client):
+    assert client.post('/bundle/mermaid', data=b'', content_type='application/json').status_code == 400
+    assert client.post('/bundle/mermaid', data=b'{not json', content_type='application/json').status_code == 400
+    resp = client.post('/bundle/mermaid/download', json={"resourceType": "Bundle", "entry": []})
+    assert resp.status_code == 400
+    assert 'No resources' in resp.get_data(as_text=True)
+
+
+def test_formats_share_the_cached_graph(client, body):
+    dot = client.post('/bundle/mermaid?format=dot', data=body, content_type='application/json')
+    assert dot.status_code == 200
+    assert dot.mimetype == 'text/vnd.graphviz'
+    text = dot.get_data(as_text=True)
+    assert text.startswith('digraph "Diagnostic Request Bundle" {') and text.rstrip().endswith('}')
+
+    graph = client.post('/bundle/mermaid?format=json', data=body, content_type='application/json').get_json()
+    cytoscape = client.post('/bundle/mermaid/download?format=cytoscape', data=body,
+                            content_type='application/json')
+    assert cytoscape.headers['Content-Disposition'] == 'attachment; filename="fhir-bundle-diagram.cyjs"'
+    elements = cytoscape.get_json()['elements']
+    assert len(client.builds) == 1
+
+    assert len(graph['nodes']) == len(elements['nodes']) == text.count('[label=') - text.count(' -> ')
+    assert len(graph['edges']) == len(elements['edges']) == text.count(' -> ')
+    node_ids = {node['id'] for node in graph['nodes']}
+    assert all(source in node_ids and target in node_ids for source, target, _ in graph['edges'])
+    assert {node['kind'] for node in graph['nodes']} >= {'resource', 'external'}
+    assert dot.headers['ETag'] != cytoscape.headers['ETag']
+
+    assert client.post('/bundle/mermaid?format=png', data=body, content_type='application/json').status_code == 400
+
+
+def test_exporter_failures_are_reported(client, body, monkeypatch, caplog):
+    mermaid = graph_exporters.FORMATS['mermaid']
+
+    def failing_at_once(graph, title):
+        raise RuntimeError("exporter broke")
+        yield
+
+    monkeypatch.setitem(bundle_diagram.FORMATS, 'mermaid', mermaid._replace(exporter=failing_at_once))
+    resp = client.post('/bundle/mermaid', data=body, content_type='application/json')
+    assert resp.status_code == 500 and 'exporter broke' in resp.get_data(as_text=True)
+
+    def failing_midway(graph, title):
+        yield 'flowchart LR' + ' ' * bundle_diagram.STREAM_CHUNK_SIZE
+        raise RuntimeError("exporter broke midway")
+
+    monkeypatch.setitem(bundle_diagram.FORMATS, 'mermaid', mermaid._replace(exporter=failing_midway))
+    with pytest.raises(RuntimeError):
+        client.post('/bundle/mermaid/download', data=body, content_type='application/json').get_data()
+    assert 'response cut short' in caplog.text
@@ -0,0 +1,118 @@
+"""Tests for the bundle diff engine and /bundle/diff."""
+import copy
+import json
+import os
+import sys
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import app as app_module
+from app import app
+from bundle_diff import align_entries, apply_patch, diff_bundles, json_patch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _sample():
+    with open(os.path.join(ROOT, 'json', 'service_request_bundle.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _regenerated(bundle):
+    """The same bundle with fresh urn:uuid fullUrls, as a second generation of an order would have."""
+    text = json.dumps(bundle)
+    for number, entry in enumerate(bundle['entry']):
+        if entry['fullUrl'].startswith('urn:uuid:'):
+            text = text.replace(entry['fullUrl'][9:], f"00000000-0000-4000-8000-{number:012d}")
+    return json.loads(text)
+
+
+def test_json_patch_is_minimal_and_applies():
+    source = {"status": "active", "code": {"coding": [{"system": "s", "code": "1"}, {"system": "s", "code": "2"}]},
+              "note": [{"text": "a"}, {"text": "b"}, {"text": "c"}], "a/b": 1}
+    target = {"status": "active", "code": {"coding": [{"system": "s", "code": "1"}, {"system": "s", "code": "3"}]},
+              "note": [{"text": "a"}, {"text": "c"}], "priority": "urgent"}
+    patch = json_patch(source, target)
+    assert patch == [
+        {"op": "remove", "path": "/a~1b"},
+        {"op": "replace", "path": "/code/coding/1/code", "value": "3"},
+        {"op": "remove", "path": "/note/1"},
+        {"op": "add", "path": "/priority", "value": "urgent"},
+    ]
+    assert apply_patch(source, patch) == target
+    assert json_patch(target, target) == []
+
+
+def test_regenerated_bundle_aligns_without_spurious_changes():
+    left = _sample()
+    right = _regenerated(left)
+    changed = next(entry for entry in right['entry'] if entry['resource']['resourceType'] == 'ServiceRequest')
+    changed['resource']['priority'] = 'urgent'
+    right['entry'].append({"fullUrl": "urn:uuid:new", "resource": {"resourceType": "Specimen", "id": "new"}})
+    # An unreferenced Task, so nothing else changes with it
+    removed = next(index for index, entry in enumerate(right['entry'])
+                   if entry['resource']['resourceType'] == 'Task' and entry['resource'].get('focus'))
+    del right['entry'][removed]
+
+    diff = diff_bundles(left, right)
+    assert diff['summary'] == {"unchanged": len(left['entry']) - 2, "changed": 1, "added": 1, "removed": 1}
+    by_status = {}
+    for entry in diff['entries']:
+        by_status.setdefault(entry['status'], []).append(entry)
+    assert by_status['changed'][0]['patch'] == [{"op": "add", "path": "/priority", "value": "urgent"}]
+    assert by_status['changed'][0]['matchedBy'] == 'identifier'
+    assert by_status['removed'][0]['left'] == left['entry'][removed]['fullUrl']
+    assert by_status['added'][0] == {"status": "added", "resourceType": "Specimen", "label": "Specimen",
+                                     "matchedBy": None, "left": None, "right": "urn:uuid:new"}
+    assert diff['entries'][-1]['status'] == 'added'
+
+    # Ignored elements are left out of the comparison
+    assert diff_bundles(left, right, ignore=['/priority'])['summary']['changed'] == 0
+
+
+def test_ambiguous_keys_fall_back_to_references_then_position():
+    def task(full_url, focus):
+        return {"fullUrl": full_url, "resource": {"resourceType": "Task", "code": {"text": "fulfill"},
+                                                  "focus": {"reference": focus}}}
+    left = [task("urn:uuid:a", "ServiceRequest/1"), task("urn:uuid:b", "ServiceRequest/2"),
+            task("urn:uuid:e", "ServiceRequest/9")]
+    right = [task("urn:uuid:c", "ServiceRequest/1"), task("urn:uuid:b", "ServiceRequest/3"),
+             task("urn:uuid:f", "ServiceRequest/8"), task("urn:uuid:g", "ServiceRequest/7")]
+    assert align_entries(left, right) == [(0, 0, "references"), (1, 1, "fullUrl"), (2, 2, "position"),
+                                          (None, 3, None)]
+
+
+def test_diff_endpoint():
+    app.config['TESTING'] = True
+    left = _sample()
+    right = _regenerated(left)
+    right['entry'][2]['resource']['status'] = 'revoked'
+    with app.test_client() as client:
+        resp = client.post('/bundle/diff', json={"left": left, "right": right})
+        assert resp.status_code == 200
+        body = resp.get_json()
+        assert body['success'] and body['summary']['changed'] == 1 and body['bundle'] == []
+
+        mermaid = client.post('/bundle/diff?format=mermaid', json={"left": left, "right": right})
+        text = mermaid.get_data(as_text=True)
+        assert text.startswith('flowchart LR') and '\n    classDef changed ' in text
+
+        assert client.post('/bundle/diff', json={"left": left}).status_code == 400
+        assert client.post('/bundle/diff', json={"left": left, "right": copy.deepcopy(left),
+                                                 "ignore": "meta"}).status_code == 400
+
+
+def test_diff_diagram_failure_is_an_error_response(monkeypatch):
+    def failing_diagram(left, right, ignore):
+        yield 'flowchart LR'
+        raise RuntimeError("diagram broke")
+
+    monkeypatch.setattr(app_module, 'iter_diff_mermaid', failing_diagram)
+    app.config['TESTING'] = True
+    left = _sample()
+    with app.test_client() as client:
+        resp = client.post('/bundle/diff?format=mermaid', json={"left": left, "right": _regenerated(left)})
+        assert resp.status_code == 500 and resp.get_json()['error'] == 'diagram broke'
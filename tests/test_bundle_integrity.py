@@ -0,0 +1,96 @@
+"""Tests for the local bundle reference integrity check run before submit."""
+import copy
+import os
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import terminology
+from bundle_integrity import check_bundle_references
+from bundler import create_request_bundle
+from app import app
+
+
+@pytest.fixture
+def bundle(monkeypatch):
+    monkeypatch.setattr(terminology.get_terminology_service(), 'validate_codes', False)
+    return create_request_bundle({
+        'patient_id': 'test-patient-123',
+        'organisation': 'org-1',
+        'requestCategory': 'Pathology',
+        'selectedTests': [{"code": "26604007", "display": "Full blood count"},
+                          {"code": "43396009", "display": "HbA1c"}],
+        'clinicalContext': 'Notes',
+        'isPregnant': 'true',
+        'billingCategory': 'PUBLICPOL',
+        'specimenCollected': 'true',
+        'specimenType': 'Blood',
+        'copyTo': ['role-2'],
+        'mhrConsentWithdrawn': 'true',
+        'doNotContactPatient': 'true',
+    })
+
+
+def _entry_index(bundle, resource_type):
+    return next(i for i, e in enumerate(bundle['entry'])
+                if e.get('resource', {}).get('resourceType') == resource_type)
+
+
+def test_generated_bundle_is_consistent(bundle):
+    assert check_bundle_references(bundle) == []
+
+
+def test_dangling_urn_reference(bundle):
+    bundle = copy.deepcopy(bundle)
+    index = _entry_index(bundle, 'ServiceRequest')
+    bundle['entry'][index]['resource']['encounter'] = {"reference": "urn:uuid:missing"}
+    issues = check_bundle_references(bundle)
+    assert [i['code'] for i in issues] == ['not-found']
+    assert issues[0]['expression'] == [f"Bundle.entry[{index}].resource.encounter.reference"]
+
+
+def test_relative_references(bundle):
+    bundle = copy.deepcopy(bundle)
+    index = _entry_index(bundle, 'ServiceRequest')
+    resource = bundle['entry'][index]['resource']
+    resource['basedOn'] = [{"reference": "CarePlan/abc"}]
+    resource['performer'] = [{"reference": "Organization/elsewhere"}]
+    resource['replaces'] = [{"reference": "not a reference"}]
+    issues = check_bundle_references(bundle)
+    assert sorted(i['code'] for i in issues) == ['invalid', 'not-found']
+    assert any('CarePlan/abc' in i['diagnostics'] for i in issues)
+
+    # A resource present in the bundle under Type/id resolves
+    bundle['entry'].insert(0, {"fullUrl": "https://fhir.example.org/CarePlan/abc",
+                               "resource": {"resourceType": "CarePlan", "id": "abc"},
+                               "request": {"method": "PUT", "url": "CarePlan/abc"}})
+    assert [i['code'] for i in check_bundle_references(bundle)] == ['invalid']
+
+
+def test_duplicate_full_url_and_task_group_order(bundle):
+    bundle = copy.deepcopy(bundle)
+    group = bundle['entry'].pop()
+    bundle['entry'].insert(0, group)
+    bundle['entry'].append(copy.deepcopy(bundle['entry'][1]))
+    codes = sorted(i['code'] for i in check_bundle_references(bundle))
+    assert codes == ['business-rule', 'duplicate']
+
+
+def test_submit_rejects_broken_bundle_locally(bundle, monkeypatch):
+    from bundle_submit import get_bundle_submitter
+    monkeypatch.setattr(get_bundle_submitter().session, 'post', lambda *a, **k: pytest.fail("should not upload"))
+    bundle = copy.deepcopy(bundle)
+    bundle['entry'][_entry_index(bundle, 'Task')]['resource']['focus'] = {"reference": "urn:uuid:gone"}
+
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        resp = client.post('/fhir/bundle/submit?async=true', json=bundle)
+    assert resp.status_code == 400
+    data = resp.get_json()
+    assert data['success'] is False
+    assert 'urn:uuid:gone' in data['error']
+    assert data['outcome']['resourceType'] == 'OperationOutcome'
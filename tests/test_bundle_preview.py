@@ -0,0 +1,104 @@
+"""Tests for the content-addressed bundle preview cache."""
+import html
+import json
+import os
+import re
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import terminology
+import app as app_module
+import bundle_preview
+from app import app
+
+PATIENT_ID = '0f8fad5b-d9cb-469f-a165-70867728950e'
+UUID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+FORM = {
+    'requester': 'role-1',
+    'organisation': 'org-1',
+    'requestCategory': 'Pathology',
+    'selectedTests': json.dumps([{"code": "26604007", "display": "Full blood count"}]),
+    'specimenCollected': 'true',
+    'specimenType': 'Blood',
+    'specimenTypeCode': '119297000',
+    'copyTo': 'role-2',
+    'addNarrative': 'true',
+}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    versions = {'role-1': '1'}
+    builds = []
+    original = app_module.create_request_bundle
+
+    def fake_directory(role_ids, fhir_server_url=None, auth_credentials=None):
+        return {r: [{"resourceType": "PractitionerRole", "id": r, "meta": {"versionId": versions[r]}}]
+                for r in role_ids}
+
+    def counting_build(*args, **kwargs):
+        builds.append(kwargs['form_data'])
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(terminology.get_terminology_service(), 'validate_codes', False)
+    monkeypatch.setattr(app_module, 'fetch_directory', fake_directory)
+    monkeypatch.setattr(app_module, 'create_request_bundle', counting_build)
+    bundle_preview.clear_cache()
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        client.builds = builds
+        client.versions = versions
+        yield client
+    bundle_preview.clear_cache()
+
+
+def _preview(client, **overrides):
+    resp = client.post(f'/fhir/diagnosticrequest/bundler/{PATIENT_ID}', data=dict(FORM, **overrides))
+    assert resp.status_code == 200
+    text = html.unescape(resp.get_data(as_text=True))
+    return json.loads(text[text.index('{'):text.rindex('}') + 1])
+
+
+def _shape(bundle):
+    """The bundle with every generated value blanked out."""
+    text = json.dumps(bundle).replace(PATIENT_ID, 'PATIENT')
+    text = UUID.sub('UUID', text).replace(bundle['timestamp'], 'NOW')
+    requisition = bundle['entry'][-1]['resource']['groupIdentifier']['value']
+    return text.replace(requisition, 'REQ')
+
+
+def test_identical_preview_is_rewritten_not_rebuilt(client):
+    first = _preview(client)
+    second = _preview(client)
+    assert len(client.builds) == 1
+
+    assert second['id'] != first['id']
+    assert {e['fullUrl'] for e in second['entry']}.isdisjoint(e['fullUrl'] for e in first['entry'])
+    assert _shape(second) == _shape(first)
+    # Ids that came from the form are not generated values
+    assert second['entry'][-1]['resource']['for']['reference'] == f'Patient/{PATIENT_ID}'
+    # References still resolve to the rewritten fullUrls
+    full_urls = {e['fullUrl'] for e in second['entry']}
+    tasks = [e['resource'] for e in second['entry'] if e.get('resource', {}).get('resourceType') == 'Task']
+    assert all(t['partOf'][0]['reference'] in full_urls for t in tasks if 'partOf' in t)
+
+
+def test_form_server_or_directory_change_misses(client):
+    _preview(client)
+    _preview(client, requestPriority='urgent')
+    assert len(client.builds) == 2
+
+    client.versions['role-1'] = '2'
+    _preview(client)
+    assert len(client.builds) == 3
+
+    resp = client.post(f'/fhir/diagnosticrequest/bundler/{PATIENT_ID}', data=FORM,
+                       headers={'X-FHIR-Server-URL': 'http://other.test/fhir'})
+    assert resp.status_code == 200
+    assert len(client.builds) == 4
@@ -0,0 +1,86 @@
+"""Tests for reading posted bundles entry by entry, within size limits."""
+import io
+import json
+import os
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import bundle_diagram
+import bundle_reader
+from app import app
+from bundle_reader import BundleTooLarge, load_bundle, read_body
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _sample_body():
+    with open(os.path.join(ROOT, 'json', 'service_request_bundle.json'), 'rb') as f:
+        return f.read()
+
+
+def test_load_bundle_matches_json_and_keeps_only_asked_fields():
+    body = _sample_body()
+    assert load_bundle(body) == json.loads(body)
+
+    bundle = load_bundle(b'\xef\xbb\xbf' + body, fields=('fullUrl', 'resource'), without_narrative=True)
+    original = json.loads(body)
+    assert {key: value for key, value in original.items() if key != 'entry'} == \
+        {key: value for key, value in bundle.items() if key != 'entry'}
+    assert all(set(entry) <= {'fullUrl', 'resource'} for entry in bundle['entry'])
+    assert [entry['fullUrl'] for entry in bundle['entry']] == [entry['fullUrl'] for entry in original['entry']]
+    assert not any('text' in entry['resource'] for entry in bundle['entry'])
+
+    assert load_bundle(b' {"resourceType": "Bundle", "entry": [ ] } ') == {"resourceType": "Bundle", "entry": []}
+    for bad in (b'{not json', b'{"entry": [{}] ', b'{"entry": []} []', b'{"a" 1}', b'\xff'):
+        with pytest.raises(ValueError, match='Invalid JSON'):
+            load_bundle(bad)
+    with pytest.raises(ValueError, match='not a FHIR Bundle'):
+        load_bundle(b'[{"resourceType": "Bundle"}]')
+    # Strict: nothing the posted bytes and the decoded bundle could disagree on
+    for ambiguous in (b'{"type": "batch", "type": "transaction"}', b'{"entry": [{"resource": {"id": 1, "id": 2}}]}',
+                      b'{"total": NaN}', b'{"entry": [{"x": -Infinity}]}', b'{"total": 1e400}'):
+        with pytest.raises(ValueError, match='Invalid JSON'):
+            load_bundle(ambiguous)
+
+
+def test_limits():
+    bundle = {"resourceType": "Bundle", "entry": [{"resource": {"resourceType": "Basic"}}] * 5}
+    body = json.dumps(bundle).encode('utf-8')
+    assert len(load_bundle(body, max_entries=5)['entry']) == 5
+    with pytest.raises(BundleTooLarge):
+        load_bundle(body, max_entries=4)
+
+    assert read_body(io.BytesIO(body), max_bytes=len(body)) == body
+    with pytest.raises(BundleTooLarge):
+        read_body(io.BytesIO(body), max_bytes=len(body) - 1)
+    # A declared length over the limit is refused before anything is read
+    stream = io.BytesIO(body)
+    with pytest.raises(BundleTooLarge):
+        read_body(stream, content_length=len(body), max_bytes=10)
+    assert stream.tell() == 0
+
+
+def test_endpoints_refuse_oversized_bundles(monkeypatch):
+    bundle_diagram.clear_cache()
+    app.config['TESTING'] = True
+    body = _sample_body()
+    with app.test_client() as client:
+        assert client.post('/bundle/mermaid', data=body, content_type='application/json').status_code == 200
+        monkeypatch.setattr(bundle_reader, 'MAX_BODY_BYTES', len(body) - 1)
+        for url in ('/bundle/mermaid', '/bundle/mermaid/download', '/fhir/bundle/submit'):
+            assert client.post(url, data=body, content_type='application/json').status_code == 413
+
+        monkeypatch.setattr(bundle_reader, 'MAX_BODY_BYTES', len(body))
+        monkeypatch.setattr(bundle_reader, 'MAX_ENTRIES', 2)
+        bundle_diagram.clear_cache()
+        resp = client.post('/bundle/mermaid', data=body, content_type='application/json')
+        assert resp.status_code == 413 and 'more than 2 entries' in resp.get_data(as_text=True)
+        assert client.post('/fhir/bundle/submit', data=body, content_type='application/json').status_code == 413
+        assert client.post('/fhir/bundle/submit', data=b'{not json',
+                           content_type='application/json').status_code == 400
+    bundle_diagram.clear_cache()
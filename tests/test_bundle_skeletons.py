@@ -0,0 +1,91 @@
+"""Tests for the precompiled, read-only resource skeletons used by the bundler."""
+import copy
+import json
+import os
+import pickle
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import terminology
+import bundler
+from bundler import create_request_bundle
+
+
+@pytest.fixture(autouse=True)
+def offline_terminology(monkeypatch):
+    monkeypatch.setattr(terminology.get_terminology_service(), 'validate_codes', False)
+
+
+def _form(**overrides):
+    form = {
+        'patient_id': 'test-patient-123',
+        'organisation': 'org-1',
+        'requestCategory': 'Pathology',
+        'selectedTests': [
+            {"code": "26604007", "display": "Full blood count", "text": "FBC"},
+            {"code": "43396009", "display": "Haemoglobin A1c measurement", "text": "HbA1c"},
+        ],
+        'billingCategory': 'PUBLICPOL',
+    }
+    form.update(overrides)
+    return form
+
+
+def _resources(bundle, resource_type):
+    return [e['resource'] for e in bundle['entry'] if e.get('resource', {}).get('resourceType') == resource_type]
+
+
+def test_skeletons_are_read_only():
+    with pytest.raises(TypeError):
+        bundler._TASK['status'] = 'draft'
+    with pytest.raises(TypeError):
+        bundler._TASK['meta']['profile'].append('http://example.org/profile')
+    with pytest.raises(TypeError):
+        bundler._ENCOUNTER['class'].update(code='IMP')
+
+
+def test_static_parts_shared_and_varying_parts_distinct():
+    bundle = create_request_bundle(_form())
+    first, second = _resources(bundle, 'ServiceRequest')
+    assert first is not second
+    assert first['meta'] is second['meta']
+    assert first['category'] is second['category']
+    assert first['identifier'] is not second['identifier']
+    assert first['code']['coding'][0]['code'] == '26604007'
+    assert second['code']['coding'][0]['code'] == '43396009'
+
+    task = _resources(bundle, 'Task')[0]
+    assert task['meta'] is bundler._TASK['meta']
+    assert list(task) == list(bundler._TASK)
+
+
+def test_resources_can_be_modified_after_build():
+    bundle = create_request_bundle(_form())
+    service_request = _resources(bundle, 'ServiceRequest')[0]
+    service_request['status'] = 'revoked'
+    service_request['note'] = [{"text": "Cancelled"}]
+
+    editable = copy.deepcopy(bundle)
+    editable['entry'][0]['request']['method'] = 'PUT'
+    assert bundler._POST_REQUEST['Coverage']['method'] == 'POST'
+    assert type(editable['entry'][0]['request']) is dict
+
+
+def test_one_timestamp_per_bundle():
+    bundle = create_request_bundle(_form(isPregnant='true', clinicalContext='Notes'))
+    stamps = {bundle['timestamp']}
+    for entry in bundle['entry']:
+        resource = entry.get('resource', {})
+        for field in ('authoredOn', 'effectiveDateTime', 'date'):
+            if field in resource:
+                stamps.add(resource[field])
+    assert len(stamps) == 1
+
+
+def test_bundle_serialises_and_pickles():
+    bundle = create_request_bundle(_form(addNarrative=True))
+    restored = pickle.loads(pickle.dumps(bundle))
+    assert json.loads(json.dumps(restored)) == json.loads(json.dumps(bundle))
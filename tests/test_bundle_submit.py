@@ -0,0 +1,196 @@
+"""Tests for pooled, gzip-compressed and job-based bundle submission."""
+import gzip
+import json
+import os
+import sys
+import threading
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import bundle_submit
+from app import app
+
+BUNDLE = {"resourceType": "Bundle", "type": "transaction", "entry": [
+    {"fullUrl": "urn:uuid:1", "resource": {"resourceType": "Encounter", "status": "planned"},
+     "request": {"method": "POST", "url": "Encounter"}}]}
+RESPONSE = {"resourceType": "Bundle", "type": "transaction-response",
+            "entry": [{"response": {"status": "201 Created", "location": "Encounter/1/_history/1"}}]}
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, payload=RESPONSE, headers=None):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = json.dumps(payload)
+        self.headers = headers or {}
+
+    def json(self):
+        return self._payload
+
+
+@pytest.fixture
+def submitter(monkeypatch):
+    svc = bundle_submit.configure_bundle_submitter(workers=2, max_pending=2, compress='true')
+    svc.posts = []
+    svc.release = threading.Event()
+    svc.release.set()
+    svc.status = 200
+
+    def fake_post(url, data=None, headers=None, **kwargs):
+        svc.release.wait(5)
+        svc.posts.append((url, data, headers, kwargs))
+        if svc.status == 415 and headers.get('Content-Encoding') == 'gzip':
+            return FakeResponse(415, {"resourceType": "OperationOutcome"})
+        return FakeResponse(200 if svc.status == 415 else svc.status)
+
+    monkeypatch.setattr(svc.session, 'post', fake_post)
+    yield svc
+    svc.release.set()
+    svc.executor.shutdown(wait=True)
+    bundle_submit.configure_bundle_submitter()
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+
+def test_sync_submit_sends_gzip(client, submitter):
+    resp = client.post('/fhir/bundle/submit', json=BUNDLE, headers={'X-FHIR-Server-URL': 'http://fhir.test/fhir/'})
+    result = resp.get_json()
+    assert result['success'] is True
+    assert result['response'] == RESPONSE
+    assert result['upload']['compressed'] is True
+    assert result['upload']['sent_bytes'] == len(submitter.posts[0][1])
+    url, data, headers, kwargs = submitter.posts[0]
+    assert url == 'http://fhir.test/fhir'
+    assert headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(data)) == BUNDLE
+
+
+def test_unchanged_bundle_is_sent_as_posted(client, submitter):
+    entry = dict(BUNDLE['entry'][0], fullUrl='urn:uuid:"quoted id"')
+    raw = json.dumps({"type": "transaction", "resourceType": "Bundle", "entry": [entry]}, indent=2).encode('utf-8')
+    upload = client.post('/fhir/bundle/submit', data=raw, content_type='application/json').get_json()['upload']
+    sent = gzip.decompress(submitter.posts[0][1])
+    # The posted bytes, key order and escapes included, minus the whitespace between tokens
+    assert sent == b'{"type":"transaction","resourceType":"Bundle","entry":[{"fullUrl":"urn:uuid:\\"quoted id\\"",' \
+        b'"resource":{"resourceType":"Encounter","status":"planned"},"request":{"method":"POST","url":"Encounter"}}]}'
+    assert upload['original_bytes'] == len(raw) and upload['minified_bytes'] == len(sent)
+
+
+def test_ambiguous_json_is_rejected_before_sending(client, submitter):
+    entry = json.dumps(BUNDLE['entry'][0])
+    for body in ('{"resourceType": "Bundle", "type": "transaction", "type": "batch", "entry": [%s]}' % entry,
+                 '{"resourceType": "Bundle", "type": "transaction", "entry": [%s], "total": NaN}' % entry,
+                 '{"resourceType": "Bundle", "type": "transaction", "entry": [{"resource": '
+                 '{"resourceType": "Encounter", "status": "planned", "status": "cancelled"}}]}'):
+        resp = client.post('/fhir/bundle/submit', data=body, content_type='application/json')
+        assert resp.status_code == 400 and 'Invalid JSON' in resp.get_json()['error']
+    assert submitter.posts == []
+
+
+def test_retries_uncompressed_on_415(submitter):
+    submitter.status = 415
+    resp, upload = submitter.post(BUNDLE, 'http://fhir.test/fhir')
+    assert resp.status_code == 200
+    assert upload['compressed'] is False
+    assert [h.get('Content-Encoding') for _, _, h, _ in submitter.posts] == ['gzip', None]
+    assert json.loads(submitter.posts[1][1]) == BUNDLE
+
+    # The refusal is remembered for that server
+    submitter.post(BUNDLE, 'http://fhir.test/fhir')
+    assert submitter.posts[2][2].get('Content-Encoding') is None
+
+
+def test_async_job_reports_transaction_response(client, submitter):
+    submitter.release.clear()
+    resp = client.post('/fhir/bundle/submit?async=true', json=BUNDLE,
+                       headers={'X-FHIR-Server-URL': 'http://fhir.test/fhir'})
+    assert resp.status_code == 202
+    job = resp.get_json()
+    assert job['status'] in ('queued', 'running')
+    assert job['entries'] == 1
+    assert job['status_url'] == f"/fhir/bundle/submit/{job['job_id']}"
+
+    assert client.get(job['status_url']).get_json()['status'] in ('queued', 'running')
+    submitter.release.set()
+    submitter.executor.shutdown(wait=True)
+
+    status = client.get(job['status_url']).get_json()
+    assert status['status'] == 'completed'
+    assert status['success'] is True
+    assert status['response'] == RESPONSE
+    assert status['duration'] >= 0
+
+
+def test_failed_job_and_unknown_job(client, submitter):
+    submitter.status = 500
+    job = submitter.submit(BUNDLE, 'http://fhir.test/fhir')
+    submitter.executor.shutdown(wait=True)
+    status = client.get(f"/fhir/bundle/submit/{job['job_id']}").get_json()
+    assert status['status'] == 'failed'
+    assert status['error'] == 'FHIR server returned HTTP 500'
+    assert client.get('/fhir/bundle/submit/nope').status_code == 404
+
+
+def test_queue_is_bounded(client, submitter):
+    submitter.release.clear()
+    for _ in range(2):
+        assert client.post('/fhir/bundle/submit?async=true', json=BUNDLE).status_code == 202
+    resp = client.post('/fhir/bundle/submit?async=true', json=BUNDLE)
+    assert resp.status_code == 503
+
+
+def test_auto_mode_checks_advertised_support_once(submitter, monkeypatch):
+    submitter.compress = 'auto'
+    probes = []
+
+    def fake_get(url, params=None, headers=None, **kwargs):
+        probes.append(url)
+        advertised = 'gzip, deflate' if 'gzip.test' in url else None
+        return FakeResponse(200, {"resourceType": "CapabilityStatement"},
+                            headers={'Accept-Encoding': advertised} if advertised else {})
+
+    monkeypatch.setattr(submitter.session, 'get', fake_get)
+    for _ in range(2):
+        submitter.post(BUNDLE, 'http://gzip.test/fhir')
+        submitter.post(BUNDLE, 'http://plain.test/fhir')
+    assert probes == ['http://gzip.test/fhir/metadata', 'http://plain.test/fhir/metadata']
+    assert [h.get('Content-Encoding') for _, _, h, _ in submitter.posts] == ['gzip', None, 'gzip', None]
+
+
+def test_prepare_upload_trims_without_modifying_the_bundle():
+    role = {"resourceType": "PractitionerRole", "id": "r1", "text": {"status": "generated", "div": "<div/>"},
+            "meta": {"lastUpdated": "2025-01-01T00:00:00Z"}}
+    bundle = json.loads(json.dumps({"resourceType": "Bundle", "type": "transaction", "entry": [
+        {"fullUrl": "urn:uuid:a", "resource": role, "request": {"method": "PUT", "url": "PractitionerRole/r1"}},
+        {"fullUrl": "urn:uuid:b", "resource": role, "request": {"method": "PUT", "url": "PractitionerRole/r1"}},
+        {"fullUrl": "urn:uuid:c", "resource": {"resourceType": "Task", "meta": {"profile": ["p"], "lastUpdated": "x"},
+                                              "requester": {"reference": "urn:uuid:b"}},
+         "request": {"method": "POST", "url": "Task"}},
+    ]}))
+    original = json.dumps(bundle)
+
+    prepared, stats = bundle_submit.prepare_upload(bundle, strip_narrative=True, strip_last_updated=True)
+    assert json.dumps(bundle) == original
+    assert stats == {'removed_entries': 1, 'stripped_narratives': 2, 'stripped_last_updated': 3}
+    assert [e['fullUrl'] for e in prepared['entry']] == ['urn:uuid:a', 'urn:uuid:c']
+    assert prepared['entry'][0]['resource'] == {"resourceType": "PractitionerRole", "id": "r1"}
+    assert prepared['entry'][1]['resource']['meta'] == {"profile": ["p"]}
+    assert prepared['entry'][1]['resource']['requester'] == {"reference": "urn:uuid:a"}
+
+
+def test_upload_reports_bytes_saved(client, submitter):
+    bundle = dict(BUNDLE, entry=[dict(BUNDLE['entry'][0], fullUrl=f"urn:uuid:{i}") for i in range(20)])
+    resp = client.post('/fhir/bundle/submit?strip_narrative=true', json=bundle)
+    upload = resp.get_json()['upload']
+    assert upload['removed_entries'] == 0
+    assert upload['sent_bytes'] < upload['minified_bytes'] < upload['original_bytes']
+    assert upload['saved_bytes'] == upload['original_bytes'] - upload['sent_bytes']
@@ -0,0 +1,119 @@
+"""Tests for offline structural validation of bundles against the fhirclient models."""
+import copy
+import json
+import os
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import terminology
+import bulk_bundler
+from bundle_validation import timing_report, validate_bundle, validate_resource
+from fhir_models import model_class
+from bundler import create_request_bundle
+from app import app
+
+
+FORM = {
+    'patient_id': 'test-patient-123',
+    'organisation': 'org-1',
+    'requestCategory': 'Pathology',
+    'selectedTests': [{"code": "26604007", "display": "Full blood count"}],
+    'clinicalContext': 'Notes',
+    'isPregnant': 'true',
+    'billingCategory': 'PUBLICPOL',
+    'specimenCollected': 'true',
+    'specimenType': 'Blood',
+    'specimenTypeCode': '119297000',
+    'copyTo': ['role-2'],
+    'mhrConsentWithdrawn': 'true',
+    'addNarrative': 'true',
+}
+
+
+@pytest.fixture
+def bundle(monkeypatch):
+    monkeypatch.setattr(terminology.get_terminology_service(), 'validate_codes', False)
+    return json.loads(json.dumps(create_request_bundle(dict(FORM))))
+
+
+def _resource(bundle, resource_type):
+    return next(e['resource'] for e in bundle['entry'] if e.get('resource', {}).get('resourceType') == resource_type)
+
+
+def test_generated_bundle_is_valid_and_timed(bundle):
+    timings = {}
+    assert validate_bundle(bundle, timings) == []
+    report = timing_report(timings)
+    assert report['ServiceRequest']['count'] == 1
+    assert report['Task']['count'] == 2
+    assert sum(t['count'] for t in report.values()) == sum(1 for e in bundle['entry'] if 'resource' in e)
+
+
+def test_cardinality_type_and_required_issues(bundle):
+    service_request = copy.deepcopy(_resource(bundle, 'ServiceRequest'))
+    service_request['code'] = [service_request['code']]
+    service_request['subject'] = {"reference": 5}
+    service_request['reasonCode'] = {"text": "not a list"}
+    service_request['authoredOn'] = 'yesterday'
+    service_request['colour'] = 'blue'
+    del service_request['intent']
+    issues = validate_resource(service_request)
+    assert sorted((i['code'], i['expression'][0]) for i in issues) == [
+        ('required', 'ServiceRequest.intent'),
+        ('structure', 'ServiceRequest.code'),
+        ('structure', 'ServiceRequest.colour'),
+        ('structure', 'ServiceRequest.reasonCode'),
+        ('structure', 'ServiceRequest.subject.reference'),
+        ('value', 'ServiceRequest.authoredOn'),
+    ]
+
+
+def test_bundle_paths_and_unknown_resource_type(bundle):
+    bundle['entry'][0]['resource'] = {"resourceType": "NotAResource"}
+    bundle['entry'][1]['request']['method'] = ['PUT']
+    issues = validate_bundle(bundle)
+    assert [i['expression'][0] for i in issues] == ['Bundle.entry[0].resource', 'Bundle.entry[1].request.method']
+    assert model_class('NotAResource') is None
+    assert model_class('fhirabstractbase') is None
+    assert model_class('Task').__name__ == 'Task'
+
+
+def test_bulk_validation_runs_in_workers(monkeypatch):
+    monkeypatch.setattr(terminology.get_terminology_service(), 'validate_codes', False)
+    spec = {"patient": "p1", "organisation": "org-1",
+            "tests": [{"code": "26604007", "display": "Full blood count"}],
+            "specimen": {"type": "Blood", "typeCode": "119297000"}}
+    lines = [json.dumps(spec), json.dumps(dict(spec, tests=[{"code": "26604007", "display": 5}]))]
+    run = bulk_bundler.BulkRun(lines, workers=2, validate=True)
+    output = [json.loads(line) for line in run]
+
+    assert output[0]['resourceType'] == 'Bundle'
+    assert output[1]['line'] == 2
+    assert {i['diagnostics'] for i in output[1]['issue']} == {'Expected a string, got number'}
+    assert run.report['errors'] == 1
+    assert run.report['validation']['ServiceRequest']['count'] == 2
+
+
+def test_validate_endpoint_and_submit_option(bundle, monkeypatch):
+    from bundle_submit import get_bundle_submitter
+    monkeypatch.setattr(get_bundle_submitter().session, 'post', lambda *a, **k: pytest.fail("should not upload"))
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        resp = client.post('/fhir/bundle/validate', json=bundle)
+        assert resp.status_code == 200
+        assert resp.get_json()['valid'] is True
+        assert 'Task' in resp.get_json()['timings']
+
+        _resource(bundle, 'Task')['status'] = 7
+        data = client.post('/fhir/bundle/validate', json=bundle).get_json()
+        assert data['valid'] is False
+        assert data['outcome']['issue'][0]['diagnostics'] == 'Expected a string, got number'
+
+        resp = client.post('/fhir/bundle/submit?validate=true', json=bundle)
+        assert resp.status_code == 400
+        assert resp.get_json()['outcome']['resourceType'] == 'OperationOutcome'
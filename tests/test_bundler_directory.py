@@ -0,0 +1,87 @@
+"""Tests for batched, memoised PractitionerRole resolution in the bundler."""
+import os
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import terminology
+import bundler
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self._payload = payload
+        self.status_code = status_code
+
+    def json(self):
+        return self._payload
+
+
+def _searchset(role_ids):
+    entries = []
+    for role_id in role_ids:
+        if role_id.startswith('missing'):
+            continue
+        entries.append({"resource": {"resourceType": "PractitionerRole", "id": role_id,
+                                     "practitioner": {"reference": f"Practitioner/prac-{role_id}"}}})
+        entries.append({"resource": {"resourceType": "Practitioner", "id": f"prac-{role_id}"}})
+    return {"resourceType": "Bundle", "type": "searchset", "entry": entries}
+
+
+@pytest.fixture
+def searches(monkeypatch):
+    calls = []
+
+    def fake_get(path, fhir_server_url=None, auth_credentials=None, timeout=None):
+        calls.append((fhir_server_url, path))
+        if 'fail' in path:
+            return FakeResponse({}, status_code=500)
+        ids = path.split('_id=')[1].split('&')[0].split(',')
+        return FakeResponse(_searchset(ids))
+
+    bundler.clear_directory_cache()
+    monkeypatch.setattr(bundler, 'fhir_get', fake_get)
+    monkeypatch.setattr(terminology.get_terminology_service(), 'validate_codes', False)
+    yield calls
+    bundler.clear_directory_cache()
+
+
+def test_one_search_resolves_many_roles(searches):
+    directory = bundler.fetch_directory(['r1', 'r2', 'r1', '', 'missing-1'], 'http://fhir.test')
+    assert len(searches) == 1
+    assert searches[0][1].startswith('/PractitionerRole?_id=r1,r2,missing-1&_include=PractitionerRole:practitioner')
+    assert [r['id'] for r in directory['r2']] == ['r2', 'prac-r2']
+    assert directory['missing-1'] is None
+
+
+def test_results_are_memoised_per_server(searches):
+    bundler.fetch_directory(['r1', 'r2'], 'http://fhir.test')
+    assert bundler.fetch_directory(['r2', 'r1'], 'http://fhir.test')['r1'][0]['id'] == 'r1'
+    assert len(searches) == 1
+
+    bundler.fetch_directory(['r1', 'r3'], 'http://other.test')
+    bundler.fetch_directory(['r1', 'r3', 'fail-1'], 'http://fhir.test')
+    assert [path.split('&')[0] for _, path in searches[1:]] == ['/PractitionerRole?_id=r1,r3',
+                                                               '/PractitionerRole?_id=r3,fail-1']
+    # A failed search is not cached
+    assert bundler.fetch_directory(['fail-1'], 'http://fhir.test') == {'fail-1': None}
+    assert len(searches) == 4
+
+
+def test_bundle_lookups_do_not_scale_with_copy_to(searches):
+    form = {'patient_id': 'p1', 'requester': 'r1', 'organisation': 'org-1',
+            'selectedTests': [{"code": "26604007", "display": "Full blood count"}],
+            'copyTo': [f'role-{i}' for i in range(20)]}
+    bundle = bundler.create_request_bundle(dict(form), fhir_server_url='http://fhir.test')
+    assert len(searches) == 1
+    puts = [e['request']['url'] for e in bundle['entry'] if e['request']['method'] == 'PUT']
+    assert puts == ['PractitionerRole/r1', 'Practitioner/prac-r1']
+    gets = [e['request']['url'] for e in bundle['entry'] if e['request']['method'] == 'GET']
+    assert len(gets) == 21
+
+    bundler.create_request_bundle(dict(form), fhir_server_url='http://fhir.test')
+    assert len(searches) == 1
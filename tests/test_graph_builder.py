@@ -0,0 +1,112 @@
+"""Tests for reference resolution and edges in the bundle graph builder."""
+import json
+import os
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fhir_parser import extract_resources
+from graph_builder import Graph, ReferenceIndex, build_graph, extract_references, reference_paths, resolve_reference
+from benchmark_graph_build import everything_bundle
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _resources():
+    return extract_resources({"resourceType": "Bundle", "entry": [
+        {"fullUrl": "urn:uuid:aaa", "resource": {"resourceType": "ServiceRequest", "id": "aaa"}},
+        {"fullUrl": "https://fhir.example.org/fhir/Patient/p1", "resource": {"resourceType": "Patient", "id": "p1"}},
+        {"fullUrl": "https://fhir.example.org/fhir/Practitioner/dr", "resource": {"resourceType": "Practitioner"}},
+        {"resource": {"resourceType": "Organization", "id": "org-1"}},
+    ]})
+
+
+def test_reference_index_resolves_every_form():
+    resources = _resources()
+    index = ReferenceIndex(resources)
+    assert index.resolve("urn:uuid:aaa") == "aaa"
+    assert index.resolve("Specimen/urn:uuid:bbb") == "bbb"
+    assert index.resolve("Patient/p1") == "p1"
+    assert index.resolve("Patient/p1/_history/3") == "p1"
+    assert index.resolve("https://fhir.example.org/fhir/Patient/p1") == "p1"
+    assert index.resolve("https://fhir.example.org/fhir/Practitioner/dr") == "https://fhir.example.org/fhir/Practitioner/dr"
+    assert index.resolve("Practitioner/dr") == "https://fhir.example.org/fhir/Practitioner/dr"
+    assert index.resolve("Organization/org-1") == "org-1"
+    assert index.resolve("Location/elsewhere") == ""
+    assert index.resolve("#contained") == ""
+    assert resolve_reference("Patient/p1", resources) == "p1"
+
+
+def test_large_bundle_edges_resolve_inside_the_bundle():
+    resources = extract_resources(everything_bundle(2000))
+    graph = build_graph(resources)
+    assert graph.external_refs == {"ext-Organization-org-1", "ext-Practitioner-prac-1"}
+    patient_edges = [edge for edge in graph.edges if edge[0] == "pat-1"]
+    # Every resource except the Patient points at it (Encounters by absolute URL)
+    assert len(patient_edges) == len(resources) - 1
+
+
+def test_sample_bundle_graph():
+    with open(os.path.join(ROOT, 'json', 'service_request_bundle.json'), 'r', encoding='utf-8') as f:
+        bundle = json.load(f)
+    resources = extract_resources(bundle)
+    graph = build_graph(resources)
+    assert set(resources) <= set(graph.nodes)
+    assert all(source in graph.nodes and target in resources for source, target, _ in graph.edges)
+
+
+def test_nested_references_are_extracted():
+    task = {"resourceType": "Task", "for": {"reference": "Patient/p1"},
+            "groupIdentifier": {"value": "1", "assigner": {"reference": "Organization/lab"}},
+            "input": [{"type": {"text": "x"}, "valueReference": {"reference": "urn:uuid:aaa"}},
+                      {"type": {"text": "y"}, "valueString": "no reference"}],
+            "extension": [{"url": "http://example.org", "valueReference": {"reference": "Basic/ignored"}}]}
+    assert extract_references(task) == {"for": ["Patient/p1"], "input.valueReference": ["urn:uuid:aaa"]}
+
+    specimen = {"resourceType": "Specimen", "subject": {"reference": "Patient/p1"},
+                "collection": {"collector": {"reference": "Practitioner/dr"}}}
+    assert extract_references(specimen) == {"collection.collector": ["Practitioner/dr"], "subject": ["Patient/p1"]}
+
+    document = {"resourceType": "DocumentReference",
+                "context": {"related": [{"reference": "ServiceRequest/1"}, {"reference": "ServiceRequest/2"}]}}
+    assert extract_references(document) == {"context.related": ["ServiceRequest/1", "ServiceRequest/2"]}
+
+
+def test_reference_paths_are_compiled_once_with_generic_fallback():
+    assert reference_paths("Questionnaire") is reference_paths("Questionnaire")
+    assert ("for", None) in reference_paths("Task")
+    assert reference_paths("NotAResource") is None
+    unknown = {"resourceType": "NotAResource", "link": {"target": [{"reference": "Patient/p1"}]},
+               "contained": [{"resourceType": "Patient", "managingOrganization": {"reference": "Organization/x"}}]}
+    assert extract_references(unknown) == {"link.target": ["Patient/p1"]}
+
+
+def test_compact_graph_core_and_views():
+    graph = Graph()
+    graph.add_node("p1", "Patient", resource_type="Patient")
+    graph.add_node("ext-x", "x (external)", is_external=True)
+    graph.add_node("t1", "Task Group", is_group_task=True, profiles=["http://example.org/StructureDefinition/t"])
+    graph.add_edge("p1", "t1", "for")
+    graph.add_edge("ext-x", "t1", "owner")
+    graph.add_edge("p1", "t1", "for")
+
+    assert graph.ids == ["p1", "ext-x", "t1"] and graph.index["t1"] == 2
+    assert graph.edge_sources.typecode == "I"
+    assert graph.edge_label_names == ["for", "owner"] and list(graph.edge_label_ids) == [0, 1, 0]
+    assert list(graph.iter_edges()) == [(0, 2, 0), (1, 2, 1), (0, 2, 0)]
+
+    assert dict(graph.nodes) == {"p1": "Patient", "ext-x": "x (external)", "t1": "Task Group"}
+    assert graph.edges == [("p1", "t1", "for"), ("ext-x", "t1", "owner"), ("p1", "t1", "for")]
+    assert graph.edges[1] == ("ext-x", "t1", "owner") and len(graph.edges) == 3
+    assert graph.external_refs == {"ext-x"} and graph.group_tasks == {"t1"}
+    assert graph.node_profiles == {"t1": ["http://example.org/StructureDefinition/t"]}
+    assert graph.node_types == {"p1": "Patient"}
+
+    # Adding a node again updates it in place
+    graph.add_node("p1", "Patient: renamed")
+    assert len(graph.nodes) == 3 and graph.nodes["p1"] == "Patient: renamed"
+    with pytest.raises(KeyError):
+        graph.add_edge("p1", "missing", "subject")
@@ -0,0 +1,113 @@
+"""Tests for clustering and grouping large bundle diagrams."""
+import json
+import os
+import sys
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ['TESTING'] = 'true'
+
+import bundle_diagram
+from app import app
+from fhir_parser import extract_resources
+from graph_builder import Graph, build_graph
+from graph_clustering import DiagramView, apply_view, cluster_graph, cluster_id, resolve_view
+from mermaid_generator import generate_mermaid
+from benchmark_graph_build import everything_bundle
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_identical_siblings_collapse_and_expand():
+    graph = build_graph(extract_resources(everything_bundle(200)))
+    clustered = cluster_graph(graph)
+    assert len(clustered.nodes) < len(graph.nodes) / 3
+    observations = [node_id for node_id, label in clustered.nodes.items() if label == "Observation ×8"]
+    assert observations and all(node_id in clustered.clusters for node_id in observations)
+    # A collapsed node keeps the connections its members share
+    collapsed = observations[0]
+    assert {label for source, target, label in clustered.edges if collapsed in (source, target)} == \
+        {"subject", "encounter", "performer", "result"}
+    assert collapsed == cluster_id("Observation", clustered.clusters[collapsed])
+
+    expanded = cluster_graph(graph, expand=frozenset({collapsed}))
+    assert collapsed not in expanded.nodes
+    assert set(clustered.clusters[collapsed]) <= set(expanded.nodes)
+    assert len(expanded.nodes) == len(clustered.nodes) + 7
+
+
+def test_diagram_size_is_bounded():
+    for entries in (2000, 10000):
+        graph = build_graph(extract_resources(everything_bundle(entries)))
+        clustered = cluster_graph(graph, max_nodes=50)
+        assert len(clustered.nodes) <= 50
+        assert sum(len(members) for members in clustered.clusters.values()) + \
+            len(set(clustered.nodes) - set(clustered.clusters)) == len(graph.nodes)
+
+    # Expanding a whole type brings back its identical-sibling clusters
+    observations = cluster_id("Observation")
+    assert observations in clustered.clusters
+    expanded = cluster_graph(graph, expand=frozenset({observations}), max_nodes=50)
+    assert observations not in expanded.nodes
+    assert any(label == "Observation ×8" for label in expanded.nodes.values())
+
+
+def test_task_groups_collapse_when_the_limit_is_still_exceeded():
+    graph = Graph()
+    graph.add_node('Patient/p1', 'Patient', resource_type='Patient')
+    for i in range(300):
+        graph.add_node(f'Task/g{i}', f'Group {i}', is_group_task=True, resource_type='Task')
+        graph.add_node(f'ServiceRequest/sr{i}', f'Request {i}', resource_type='ServiceRequest')
+        graph.add_edge(f'Task/g{i}', f'ServiceRequest/sr{i}', 'focus')
+        graph.add_edge(f'ServiceRequest/sr{i}', 'Patient/p1', 'subject')
+    clustered = cluster_graph(graph, max_nodes=50)
+    assert len(clustered.nodes) <= 50
+    tasks = cluster_id("Task")
+    assert len(clustered.clusters[tasks]) == 300
+    assert not clustered.group_tasks
+
+    # With room to spare, Task groups are still drawn on their own
+    roomy = cluster_graph(graph, max_nodes=320)
+    assert len(roomy.group_tasks) == 300 and len(roomy.nodes) <= 320
+
+
+def test_small_bundles_are_drawn_as_before_unless_asked():
+    with open(os.path.join(ROOT, 'json', 'service_request_bundle.json'), 'r', encoding='utf-8') as f:
+        graph = build_graph(extract_resources(json.load(f)))
+    view = resolve_view(graph)
+    assert view.is_plain and view.etag_suffix() == ''
+    assert resolve_view(graph, DiagramView(cluster=True)).cluster
+
+    grouped = apply_view(graph, resolve_view(graph, DiagramView(subgraphs=True)))
+    assert graph.subgraphs == {}
+    assert len(grouped.subgraphs) == 3
+    for group_id, node_ids in grouped.subgraphs.items():
+        assert node_ids[0] == group_id and graph.node_types[group_id] == 'ServiceRequest'
+        assert [graph.node_types[node_id] for node_id in node_ids[1:]] == ['Task']
+    text = generate_mermaid(grouped)
+    assert text.count('\n    subgraph sg_') == 3 and text.count('\n    end') == 3
+
+
+def test_endpoint_clusters_large_bundles_and_expands_on_request():
+    bundle_diagram.clear_cache()
+    app.config['TESTING'] = True
+    body = json.dumps(everything_bundle(400))
+    with app.test_client() as client:
+        drawn = client.post('/bundle/mermaid?format=json', data=body, content_type='application/json')
+        nodes = drawn.get_json()['nodes']
+        collapsed = next(node for node in nodes if node['kind'] == 'cluster')
+        assert collapsed['size'] > 1
+
+        expanded = client.post(f"/bundle/mermaid?format=json&expand={collapsed['id']}", data=body,
+                               content_type='application/json')
+        assert expanded.headers['ETag'] != drawn.headers['ETag']
+        assert collapsed['id'] not in {node['id'] for node in expanded.get_json()['nodes']}
+
+        plain = client.post('/bundle/mermaid?format=json&cluster=false', data=body,
+                            content_type='application/json').get_json()
+        assert len(plain['nodes']) == 402  # 400 resources and 2 external references
+        text = client.post('/bundle/mermaid', data=body, content_type='application/json').get_data(as_text=True)
+        assert f"class {collapsed['id']}," in text or f",{collapsed['id']}" in text
+    bundle_diagram.clear_cache()
@@ -0,0 +1,105 @@
+"""Tests for template-compiled, cached narrative generation."""
+import json
+import os
+import sys
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import narrative
+import terminology
+from bundler import create_request_bundle, generate_narrative_text
+from bundle_submit import configure_bundle_submitter
+from app import app
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(terminology.get_terminology_service(), 'validate_codes', False)
+    narrative.clear_cache()
+    yield
+    narrative.clear_cache()
+
+
+def _form(**overrides):
+    form = {
+        'patient_id': 'test-patient-123',
+        'requestCategory': 'Pathology',
+        'selectedTests': [{"code": "26604007", "display": "Full blood count", "text": "FBC", "display_sequence": i}
+                          for i in range(1, 4)],
+        'clinicalContext': 'Tired <all> the time',
+        'addNarrative': 'true',
+    }
+    form.update(overrides)
+    return form
+
+
+def _resources(bundle, resource_type):
+    return [e['resource'] for e in bundle['entry'] if e.get('resource', {}).get('resourceType') == resource_type]
+
+
+def test_service_request_narrative():
+    text = generate_narrative_text({
+        "resourceType": "ServiceRequest", "status": "active", "intent": "order",
+        "code": {"coding": [{"code": "26604007", "display": "Full blood count"}]},
+        "extension": [{"url": narrative.DISPLAY_SEQUENCE_URL, "valueInteger": 2}],
+        "reasonCode": [{"coding": [{"display": "Fatigue"}]}, {"text": "Follow up"}],
+    })
+    assert text["status"] == "generated"
+    assert text["div"] == (
+        '<div xmlns="http://www.w3.org/1999/xhtml"><h3>ServiceRequest</h3>'
+        '<p><strong>Status:</strong> active</p><p><strong>Intent:</strong> order</p>'
+        '<p><strong>Test:</strong> Full blood count</p><p><strong>Sequence:</strong> 2</p>'
+        '<p><strong>Reasons:</strong> Fatigue, Follow up</p></div>')
+
+
+def test_clinical_notes_are_decoded_and_escaped():
+    bundle = create_request_bundle(_form())
+    div = _resources(bundle, 'DocumentReference')[0]['text']['div']
+    assert 'Tired &lt;all&gt; the time' in div
+
+
+def test_identical_content_renders_once(monkeypatch):
+    bundle = create_request_bundle(_form(addNarrative=False))
+    renders = []
+    template = narrative._compiled['Task'][1]
+    original = template.render
+    monkeypatch.setattr(template, 'render', lambda **kw: renders.append(1) or original(**kw))
+
+    tasks = _resources(bundle, 'Task')
+    assert len(tasks) == 4
+    divs = {narrative.render_narrative(task)['div'] for task in tasks}
+    assert len(divs) == 1
+    assert len(renders) == 1
+
+
+def test_narrative_deferred_to_submit(monkeypatch):
+    bundle = create_request_bundle(_form(narrativeAtSubmit='true'))
+    assert all('text' not in e['resource'] for e in bundle['entry'] if 'resource' in e)
+
+    bundle['entry'][0]['resource']['text'] = {"status": "additional", "div": "<div>kept</div>"}
+    sent = {}
+
+    class FakeResponse:
+        status_code = 200
+
+        def json(self):
+            return {"resourceType": "Bundle", "type": "transaction-response"}
+
+    def fake_post(url, data=None, headers=None, **kwargs):
+        sent.update(json.loads(data))
+        return FakeResponse()
+
+    submitter = configure_bundle_submitter(compress='false')
+    monkeypatch.setattr(submitter.session, 'post', fake_post)
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        resp = client.post('/fhir/bundle/submit?narrative=true', json=bundle)
+    assert resp.get_json()['success'] is True
+    resources = [e['resource'] for e in sent['entry'] if 'resource' in e]
+    assert resources[0]['text']['div'] == "<div>kept</div>"
+    assert all(r['text']['status'] == 'generated' for r in resources[1:])
+    configure_bundle_submitter()
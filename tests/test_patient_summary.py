@@ -0,0 +1,169 @@
+"""Tests for streaming and caching the patient $summary."""
+import html
+import json
+import os
+import re
+import sys
+import threading
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import app as app_module
+import patient_summary
+from app import app
+
+SUMMARY = {"resourceType": "Bundle", "type": "document", "entry": [
+    {"fullUrl": "urn:uuid:1", "resource": {"resourceType": "Composition", "title": "Patient Summary <IPS> & \"more\" é"}},
+    {"fullUrl": "urn:uuid:2", "resource": {"resourceType": "Condition", "code": {"text": "x" * 100000}}}]}
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        # Small enough chunks that the two bytes of é arrive separately
+        for start in range(0, len(self.body), 3):
+            yield self.body[start:start + 3]
+
+    def json(self):
+        return json.loads(self.body)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def client(monkeypatch):
+    calls = []
+
+    def fake_get(path, fhir_server_url=None, auth_credentials=None, **kwargs):
+        calls.append((path, auth_credentials, kwargs.get('stream')))
+        if 'missing' in path or 'local' in path:
+            return FakeResponse(404, b'{"resourceType": "OperationOutcome"}')
+        return FakeResponse(200, json.dumps(SUMMARY, ensure_ascii=False).encode('utf-8'))
+
+    monkeypatch.setattr(app_module, '_original_fhir_get', fake_get)
+    # The local fallback finds no such patient either, unless a test says otherwise
+    monkeypatch.setattr(patient_summary, 'fhir_get', lambda path, **kwargs: FakeResponse(404, b'{}'))
+    patient_summary.clear_cache()
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        client.calls = calls
+        yield client
+    patient_summary.clear_cache()
+
+
+def _textarea_json(resp):
+    match = re.fullmatch(r'<textarea id="jsonData"[^>]* data-pretty-print="true" readonly>(.*)</textarea>',
+                         resp.get_data(as_text=True), re.S)
+    assert match
+    return json.loads(html.unescape(match.group(1)))
+
+
+def test_summary_is_streamed_escaped_and_cached(client):
+    headers = {'X-FHIR-Server-URL': 'http://fhir.test/fhir'}
+    resp = client.get('/fhir/Patient/p1/summary', headers=headers)
+    assert resp.is_streamed
+    assert '<IPS>' not in resp.get_data(as_text=True)
+    assert _textarea_json(resp) == SUMMARY
+    assert client.calls == [('/Patient/p1/$summary', None, True)]
+
+    # Served from the cache, the same as streamed
+    assert _textarea_json(client.get('/fhir/Patient/p1/summary', headers=headers)) == SUMMARY
+    assert len(client.calls) == 1
+
+    # Other credentials, patients and servers are not served from the cache
+    client.get('/fhir/Patient/p1/summary', headers=dict(headers, **{'X-FHIR-Username': 'u', 'X-FHIR-Password': 'p'}))
+    client.get('/fhir/Patient/p2/summary', headers=headers)
+    client.get('/fhir/Patient/p1/summary', headers={'X-FHIR-Server-URL': 'http://other.test/fhir'})
+    assert len(client.calls) == 4
+
+
+def test_failed_summary_is_reported_and_not_cached(client):
+    for _ in range(2):
+        text = html.unescape(client.get('/fhir/Patient/missing/summary').get_data(as_text=True))
+        assert '"http_status": 404' in text
+    assert len(client.calls) == 2
+
+
+class BrokenResponse(FakeResponse):
+    """Fails after `good` chunks, the way a dropped chunked connection does."""
+
+    def __init__(self, good):
+        super().__init__(200, json.dumps(SUMMARY).encode('utf-8'))
+        self.good = good
+
+    def iter_content(self, chunk_size):
+        for index, chunk in enumerate(super().iter_content(chunk_size)):
+            if index == self.good:
+                raise patient_summary.requests.exceptions.ChunkedEncodingError("connection broken")
+            yield chunk
+
+
+def test_broken_summary_is_flagged_and_not_cached(client, monkeypatch):
+    responses = []
+
+    def broken_get(path, **kwargs):
+        responses.append(BrokenResponse(good=len(responses) and 5))
+        return responses[-1]
+
+    monkeypatch.setattr(app_module, '_original_fhir_get', broken_get)
+    # Fails before anything was sent: an error response
+    early = client.get('/fhir/Patient/p1/summary')
+    assert early.status_code == 502
+    assert 'connection broken' in html.unescape(early.get_data(as_text=True))
+
+    # Fails partway: the streamed text ends with a visible marker
+    late = client.get('/fhir/Patient/p1/summary')
+    assert late.status_code == 200
+    text = html.unescape(late.get_data(as_text=True))
+    assert text.startswith('<textarea') and text.endswith('ChunkedEncodingError)</textarea>')
+    assert '!! Patient summary incomplete' in text
+    assert all(response.closed for response in responses)
+    # Nothing was cached, so the next request goes back to the server
+    client.get('/fhir/Patient/p1/summary')
+    assert len(responses) == 3
+
+
+def test_summary_is_synthesised_when_the_server_has_no_summary(client, monkeypatch):
+    searches = []
+    # Every search has to be in flight at once for any of them to get past the barrier
+    barrier = threading.Barrier(1 + sum(len(section[2]) for section in patient_summary.SECTIONS), timeout=5)
+
+    def fake_search(path, fhir_server_url=None, auth_credentials=None, bearer_token=None, **kwargs):
+        searches.append(path)
+        barrier.wait()
+        resource_type = path[1:].split('?')[0].split('/')[0]
+        if resource_type == 'Patient':
+            return FakeResponse(200, b'{"resourceType": "Patient", "id": "local-1"}')
+        if resource_type == 'Immunization':
+            return FakeResponse(500, b'{}')
+        entries = [] if resource_type == 'Procedure' else [{"resource": {
+            "resourceType": resource_type, "id": "1", "status": "active", "code": {"text": "<Asthma>"}}}]
+        return FakeResponse(200, json.dumps({"resourceType": "Bundle", "entry": entries}).encode('utf-8'))
+
+    monkeypatch.setattr(patient_summary, 'fhir_get', fake_search)
+    headers = {'X-FHIR-Server-URL': 'http://fhir.test/fhir'}
+    bundle = _textarea_json(client.get('/fhir/Patient/local-1/summary', headers=headers))
+    assert bundle['type'] == 'document'
+    composition = bundle['entry'][0]['resource']
+    assert composition['subject'] == {"reference": "Patient/local-1"}
+    sections = {section['code']['coding'][0]['code']: section for section in composition['section']}
+    assert [entry['reference'] for entry in sections['10160-0']['entry']] == \
+        ['MedicationStatement/1', 'MedicationRequest/1']
+    assert '&lt;Asthma&gt; (active)' in sections['11450-4']['text']['div']
+    assert sections['11369-6']['emptyReason']['coding'][0]['code'] == 'unavailable'
+    assert sections['47519-4']['emptyReason']['coding'][0]['code'] == 'nilknown'
+    assert 'http://fhir.test/fhir/Condition/1' in {entry['fullUrl'] for entry in bundle['entry']}
+    assert all('_elements=' in path for path in searches if '?' in path)
+
+    # Cached like a server summary
+    client.get('/fhir/Patient/local-1/summary', headers=headers)
+    assert len(client.calls) == 1 and len(searches) == barrier.parties
@@ -0,0 +1,117 @@
+"""Tests for memoised, batched specimen code resolution in the bundler."""
+import os
+import sys
+import threading
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import terminology
+from bundler import create_request_bundle, lookup_snomed_code
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def service(monkeypatch):
+    svc = terminology.configure_terminology_service(base_url='http://terminology.test/fhir')
+    calls = []
+    lock = threading.Lock()
+
+    def fake_get(url, params=None, timeout=None):
+        with lock:
+            calls.append(params['filter'])
+        return FakeResponse({"expansion": {"contains": [
+            {"system": "http://snomed.info/sct", "code": "999", "display": "Something else"},
+            {"system": "http://snomed.info/sct", "code": f"code-{params['filter'].lower()}",
+             "display": params['filter'].lower()},
+        ]}})
+
+    monkeypatch.setattr(svc.session, 'get', fake_get)
+    monkeypatch.setattr(svc, 'validate_codes', False)
+    svc.calls = calls
+    yield svc
+    terminology.configure_terminology_service()
+
+
+def _specimen(bundle):
+    for entry in bundle['entry']:
+        if entry.get('resource', {}).get('resourceType') == 'Specimen':
+            return entry['resource']
+    return None
+
+
+def _form(**overrides):
+    form = {
+        'patient_id': 'test-patient-123',
+        'requestCategory': 'Pathology',
+        'selectedTests': [{"code": "26604007", "display": "Full blood count", "text": "FBC"}],
+        'specimenCollected': 'true',
+        'specimenType': 'Blood',
+        'collectionMethod': 'Venipuncture',
+        'bodySite': 'Arm',
+    }
+    form.update(overrides)
+    return form
+
+
+def test_fallback_codes_need_no_remote_call(service):
+    specimen = _specimen(create_request_bundle(_form()))
+    assert specimen['type']['coding'][0]['code'] == '119297000'
+    assert specimen['collection']['method']['coding'][0]['code'] == '22778000'
+    assert specimen['collection']['bodySite']['coding'][0]['code'] == '53120007'
+    assert service.calls == []
+
+
+def test_unknown_terms_resolved_and_reused_across_bundles(service):
+    form = _form(specimenType='Sputum', collectionMethod='Expectoration', bodySite='Chest')
+    specimen = _specimen(create_request_bundle(form))
+    assert specimen['type']['coding'][0]['code'] == 'code-sputum'
+    assert specimen['collection']['method']['coding'][0]['code'] == 'code-expectoration'
+    assert specimen['collection']['bodySite']['coding'][0]['code'] == 'code-chest'
+    assert sorted(service.calls) == ['Chest', 'Expectoration', 'Sputum']
+
+    create_request_bundle(form)
+    assert len(service.calls) == 3
+
+
+def test_supplied_codes_are_not_looked_up(service):
+    create_request_bundle(_form(specimenType='Sputum', specimenTypeCode='119334006',
+                                collectionMethod='', bodySite=''))
+    assert service.calls == []
+
+
+def test_lookup_snomed_code_is_memoised(service):
+    assert lookup_snomed_code('Sputum', 'specimen-type') == 'code-sputum'
+    assert lookup_snomed_code('sputum', 'specimen-type') == 'code-sputum'
+    assert service.calls == ['Sputum']
+
+
+def test_misses_are_memoised_briefly(service, monkeypatch):
+    def failing_get(url, params=None, timeout=None):
+        service.calls.append(params['filter'])
+        raise terminology.requests.exceptions.ConnectionError("terminology server down")
+
+    monkeypatch.setattr(service.session, 'get', failing_get)
+    assert lookup_snomed_code('Unknown swab', 'specimen-type') == ''
+    assert lookup_snomed_code('Unknown swab', 'specimen-type') == ''
+    assert service.calls == ['Unknown swab']
+    assert service.export_cache()['resolved'] == []
+
+    # Once the miss TTL has passed the term is looked up again
+    key = (service.valueset_url('specimen-type'), 'unknown swab')
+    service.resolved.set(key, '', ttl=-1)
+    lookup_snomed_code('Unknown swab', 'specimen-type')
+    assert service.calls == ['Unknown swab', 'Unknown swab']
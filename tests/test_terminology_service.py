@@ -0,0 +1,262 @@
+"""Tests for the shared terminology service and the ValueSet picker routes."""
+import os
+import sys
+import time
+import threading
+import pytest
+
+# Ensure the project root is on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['TESTING'] = 'true'
+
+import terminology
+from app import app
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self._payload = payload
+        self.status_code = status_code
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise terminology.requests.exceptions.HTTPError(f"HTTP {self.status_code}", response=self)
+
+
+def _expansion(*items):
+    return {"expansion": {"contains": [
+        {"system": "http://snomed.info/sct", "code": code, "display": display} for code, display in items
+    ]}}
+
+
+@pytest.fixture
+def service(monkeypatch):
+    svc = terminology.configure_terminology_service(base_url='http://terminology.test/fhir/')
+    calls = []
+
+    def fake_get(url, params=None, timeout=None):
+        calls.append((url, dict(params or {})))
+        return FakeResponse(_expansion(("119297000", "Blood specimen"), ("119364003", "Serum <specimen>")))
+
+    monkeypatch.setattr(svc.session, 'get', fake_get)
+    svc.calls = calls
+    yield svc
+    terminology.configure_terminology_service()
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+
+class TestTerminologyService:
+
+    def test_uses_configured_server(self, service):
+        service.expand('specimen-type', 'blood')
+        url, params = service.calls[0]
+        assert url == 'http://terminology.test/fhir/ValueSet/$expand'
+        assert params['url'] == terminology.VALUESETS['specimen-type']['url']
+        assert params['count'] == 15
+
+    def test_expansion_is_cached_per_filter(self, service):
+        first = service.expand('specimen-type', 'Blood')
+        second = service.expand('specimen-type', '  blood ')
+        assert first == second
+        assert len(service.calls) == 1
+        service.expand('specimen-type', 'serum')
+        assert len(service.calls) == 2
+
+    def test_fragment_rendered_once(self, service):
+        renders = []
+
+        def render(items):
+            renders.append(items)
+            return f"<p>{len(items)}</p>"
+
+        assert service.render_fragment('body-site', 'arm', render) == "<p>2</p>"
+        assert service.render_fragment('body-site', 'arm', render) == "<p>2</p>"
+        assert len(renders) == 1
+
+
+class TestPickerRoutes:
+
+    def test_option_picker_escapes_display(self, client, service):
+        resp = client.get('/fhir/specimentype/expand?specimenType=blood')
+        body = resp.get_data(as_text=True)
+        assert 'data-code="119297000"' in body
+        assert 'Serum &lt;specimen&gt;' in body
+
+    def test_option_picker_empty_query(self, client, service):
+        resp = client.get('/fhir/bodysite/expand?bodySite=')
+        assert 'Start typing to search body sites' in resp.get_data(as_text=True)
+        assert service.calls == []
+
+    def test_test_name_picker_selects_valueset(self, client, service):
+        client.get('/fhir/diagvalueset/expand?testName=xray&requestCategory=Radiology')
+        assert service.calls[0][1]['url'] == terminology.VALUESETS['radiology-tests']['url']
+
+    def test_test_name_picker_rejects_unknown_category(self, client, service):
+        resp = client.get('/fhir/diagvalueset/expand?testName=fbc&requestCategory=Dental')
+        assert resp.status_code == 200
+        assert service.calls == []
+
+    def test_picker_error_response(self, client, service, monkeypatch):
+        monkeypatch.setattr(service.session, 'get', lambda *a, **k: FakeResponse({}, status_code=500))
+        resp = client.get('/fhir/collectionmethod/expand?collectionMethod=vene')
+        assert 'Error loading collection methods' in resp.get_data(as_text=True)
+
+
+class TestCacheWarmup:
+
+    @pytest.fixture
+    def order_sets_dir(self, tmp_path):
+        (tmp_path / 'pathology_common_orders.json').write_text(
+            '{"order_sets": {"Anaemia": [{"code": "26604007", "text": "FBC", "display": "Full blood count"}]}}')
+        (tmp_path / 'imaging_common_orders.json').write_text(
+            '{"order_sets": {"Chest": [{"code": "399208008", "text": "Chest X-ray"}]}}')
+        return str(tmp_path)
+
+    def test_warm_cache_expands_order_sets_and_reasons(self, service, order_sets_dir):
+        searches = service.warm_cache(order_sets_dir, reason_terms=('fatigue',))
+        assert searches == 4
+        filters = sorted((params['url'], params['filter']) for _, params in service.calls)
+        assert filters == sorted([
+            (terminology.VALUESETS['pathology-tests']['url'], 'FBC'),
+            (terminology.VALUESETS['pathology-tests']['url'], 'Full blood count'),
+            (terminology.VALUESETS['radiology-tests']['url'], 'Chest X-ray'),
+            (terminology.VALUESETS['reason-for-request']['url'], 'fatigue'),
+        ])
+        assert service.cached_display('http://snomed.info/sct', '119297000') == 'Blood specimen'
+
+    def test_warm_typeahead_needs_no_remote_call(self, client, service, order_sets_dir):
+        service.warm_cache(order_sets_dir, reason_terms=())
+        calls = len(service.calls)
+        resp = client.get('/fhir/diagvalueset/expand?testName=fbc&requestCategory=Pathology')
+        assert 'data-code="119297000"' in resp.get_data(as_text=True)
+        assert len(service.calls) == calls
+
+    def test_background_warmup(self, service, order_sets_dir, monkeypatch):
+        monkeypatch.setenv('TERMINOLOGY_WARMUP_DIR', order_sets_dir)
+        thread = terminology.start_cache_warmup(order_sets_dir)
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+        assert len(service.calls) >= 3
+
+    def test_warmup_leaves_slots_for_lookups(self, order_sets_dir, monkeypatch):
+        svc = terminology.configure_terminology_service(base_url='http://terminology.test/fhir', max_concurrency=4)
+        assert svc.warmup_concurrency == 1
+        warming = threading.Event()
+        release = threading.Event()
+        lock = threading.Lock()
+        in_flight = {'now': 0, 'max': 0}
+
+        def fake_get(url, params=None, timeout=None):
+            if params['url'] != terminology.VALUESETS['specimen-type']['url']:
+                with lock:
+                    in_flight['now'] += 1
+                    in_flight['max'] = max(in_flight['max'], in_flight['now'])
+                warming.set()
+                release.wait(5)
+                with lock:
+                    in_flight['now'] -= 1
+            return FakeResponse(_expansion(("119297000", "Blood specimen")))
+
+        monkeypatch.setattr(svc.session, 'get', fake_get)
+        try:
+            warmup = threading.Thread(target=svc.warm_cache, args=(order_sets_dir,))
+            warmup.start()
+            assert warming.wait(5)
+            # An interactive lookup is answered while the warm-up is still blocked
+            assert svc.expand('specimen-type', 'blood')[0]['code'] == '119297000'
+            release.set()
+            warmup.join(5)
+            assert in_flight['max'] == 1
+        finally:
+            release.set()
+            terminology.configure_terminology_service()
+
+    def test_warmup_runs_once_per_host(self, service, order_sets_dir, monkeypatch):
+        monkeypatch.setenv('TERMINOLOGY_WARMUP_DIR', order_sets_dir)
+        assert terminology.warm_shared_cache(order_sets_dir, service) > 0
+        calls = len(service.calls)
+
+        # Another worker process: seeded from the snapshot, no remote calls
+        other = terminology.TerminologyService(base_url='http://terminology.test/fhir/')
+        monkeypatch.setattr(other.session, 'get', service.session.get)
+        assert terminology.warm_shared_cache(order_sets_dir, other) == 0
+        assert len(service.calls) == calls
+        assert other.expand('pathology-tests', 'FBC')[0]['code'] == '119297000'
+        assert len(service.calls) == calls
+
+        # Saving the order sets makes the snapshot stale
+        path = os.path.join(order_sets_dir, 'imaging_common_orders.json')
+        os.utime(path, (time.time() + 5, time.time() + 5))
+        assert terminology.warm_shared_cache(order_sets_dir, other) > 0
+
+
+class TestBulkCodeValidation:
+
+    @pytest.fixture
+    def batch_posts(self, service, monkeypatch):
+        posts = []
+        known = {'26604007': 'Full blood count', '43396009': 'Haemoglobin A1c measurement'}
+
+        def fake_post(url, json=None, headers=None, timeout=None):
+            posts.append((url, json))
+            entries = []
+            for entry in json['entry']:
+                code = entry['request']['url'].split('code=')[-1]
+                if code in known:
+                    entries.append({
+                        "resource": {"resourceType": "Parameters", "parameter": [
+                            {"name": "name", "valueString": "SNOMED CT"},
+                            {"name": "display", "valueString": known[code]}]},
+                        "response": {"status": "200 OK"}})
+                else:
+                    entries.append({"resource": {"resourceType": "OperationOutcome"},
+                                    "response": {"status": "404 Not Found"}})
+            return FakeResponse({"resourceType": "Bundle", "type": "batch-response", "entry": entries})
+
+        monkeypatch.setattr(service, 'validate_codes', True)
+        monkeypatch.setattr(service.session, 'post', fake_post)
+        return posts
+
+    def test_single_batch_for_all_tests(self, service, batch_posts):
+        tests = [
+            {"code": "26604007", "display": "FBC please", "text": "FBC"},
+            {"code": "43396009", "display": "HbA1c"},
+            {"code": "000000", "display": "Made up"},
+            {"code": "", "display": "Free text test", "text": "Free text test"},
+        ]
+        validated = service.apply_canonical_displays(tests)
+
+        assert len(batch_posts) == 1
+        url, bundle = batch_posts[0]
+        assert url == 'http://terminology.test/fhir'
+        assert bundle['type'] == 'batch'
+        assert len(bundle['entry']) == 3
+        assert bundle['entry'][0]['request']['url'].startswith('CodeSystem/$lookup?system=http%3A%2F%2Fsnomed.info%2Fsct')
+
+        assert validated[0] == {"code": "26604007", "display": "Full blood count", "text": "FBC"}
+        assert validated[1] == {"code": "43396009", "display": "Haemoglobin A1c measurement", "text": "HbA1c"}
+        assert validated[2] == tests[2]
+        assert validated[3] == tests[3]
+        assert tests[0]['display'] == "FBC please"
+
+    def test_cached_displays_skip_the_server(self, service, batch_posts):
+        service.apply_canonical_displays([{"code": "26604007", "display": "x"}, {"code": "000000", "display": "y"}])
+        validated = service.apply_canonical_displays([{"code": "26604007", "display": "x"}, {"code": "000000", "display": "y"}])
+        assert len(batch_posts) == 1
+        assert validated[0]['display'] == "Full blood count"
+
+    def test_server_failure_keeps_supplied_displays(self, service, monkeypatch):
+        monkeypatch.setattr(service, 'validate_codes', True)
+        monkeypatch.setattr(service.session, 'post', lambda *a, **k: FakeResponse({}, status_code=503))
+        tests = [{"code": "26604007", "display": "FBC"}]
+        assert service.apply_canonical_displays(tests) == tests